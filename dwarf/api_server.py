@@ -16,6 +16,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import Queue
 import bottle
 import logging
 import socket
@@ -23,9 +24,16 @@ import threading
 import time
 import urllib2
 
-from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from wsgiref.simple_server import ServerHandler, WSGIServer, \
+    WSGIRequestHandler
 
+from dwarf import compress
 from dwarf import config
+from dwarf import db
+from dwarf import event_server
+from dwarf import exception
+from dwarf import task
+from dwarf import utils
 
 from dwarf.compute import api as api_compute
 from dwarf.identity import api as api_identity
@@ -34,20 +42,461 @@ from dwarf.image import api as api_image
 CONF = config.Config()
 LOG = logging.getLogger(__name__)
 
+# The running (worker pool) HTTP server, for the statistics
+_SERVER = None
+
+# Idle keep-alive connections of the threads engine hold a worker, so they're
+# closed sooner than api_keepalive_timeout
+_THREADS_KEEPALIVE_TIMEOUT = 5
+
+
+def _db_purge():
+    """
+    Periodic database purge job
+    """
+    try:
+        db.Controller().purge(CONF.db_purge_age, limit=CONF.db_purge_limit)
+    except Exception:   # pylint: disable=W0703
+        LOG.exception('Failed to purge the database')
+
+
+def _db_backup():
+    """
+    Periodic database backup job
+    """
+    try:
+        db.Controller().backup()
+    except Exception:   # pylint: disable=W0703
+        LOG.exception('Failed to back up the database')
+
+
+def _db_flush():
+    """
+    Periodic job that writes the queued database updates
+    """
+    try:
+        db.Controller().flush()
+    except Exception:   # pylint: disable=W0703
+        LOG.exception('Failed to flush the database updates')
+
+
+def _route_name(environ):
+    """
+    Return the name of the bottle route that handled a request
+    """
+    route = environ.get('bottle.route')
+    if route is None:
+        return 'unmatched'
+    return '%s %s' % (route.method, route.rule)
+
+
+class _DbStatsMiddleware(object):
+    """
+    Collect the database statistics of every request and add them to the
+    response headers. Unlike bottle's after_request hook, this also covers
+    the responses of raised HTTPResponse and HTTPError exceptions.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        db.begin_request()
+
+        def _start_response(status, headers, exc_info=None):
+            stats = db.end_request(_route_name(environ))
+            if stats is not None:
+                headers = headers + [
+                    ('X-Dwarf-DB-Queries', str(stats['statements'])),
+                    ('X-Dwarf-DB-Time', '%.3f' % (stats['time'] * 1000))]
+            return start_response(status, headers, exc_info)
+
+        try:
+            return self.app(environ, _start_response)
+        finally:
+            # In case no response was started
+            db.end_request(_route_name(environ))
+
+
+@exception.catchall
+def _route_stats():
+    """
+    Route:  /stats
+    Method: GET
+    """
+    utils.show_request(bottle.request)
+
+    stats = {'db': db.stats(), 'routes': db.route_stats()}
+    srv = _SERVER
+    if srv is not None:
+        stats['api'] = srv.workers.stats()
+        if hasattr(srv, 'connections'):
+            stats['api']['connections'] = srv.connections()
+    return stats
+
+
+class _Input(object):
+    """
+    Request body stream that doesn't read beyond the end of the body, so that
+    the next request on the connection can be read after it
+    """
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size) if size else ''
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.readline(size) if size else ''
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, ''))
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def drain(self):
+        """
+        Skip the part of the body that the application didn't read
+        """
+        while self.read(65536):
+            pass
+
+
+class _ServerHandler(ServerHandler):
+    """
+    HTTP/1.1 response handler. A response without a Content-Length is sent
+    with chunked transfer encoding or, for HTTP/1.0 clients, ends with the
+    connection.
+    """
+    http_version = '1.1'
+    chunked = False
+    framing = False
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        handler = self.request_handler
+        if ('Content-Length' not in self.headers and
+                self.status[:3] not in ('204', '304') and
+                self.environ['REQUEST_METHOD'] != 'HEAD'):
+            if handler.request_version == 'HTTP/1.1':
+                self.headers['Transfer-Encoding'] = 'chunked'
+                self.chunked = True
+            else:
+                handler.close_connection = 1
+        self.headers['Connection'] = ('close' if handler.close_connection
+                                      else 'keep-alive')
+
+    def send_headers(self):
+        ServerHandler.send_headers(self)
+        self.framing = self.chunked
+
+    def _write(self, data):
+        if self.framing and data:
+            data = '%x\r\n%s\r\n' % (len(data), data)
+        # Not SimpleHandler._write(), which replaces itself with
+        # stdout.write()
+        self.stdout.write(data)
+
+    def finish_content(self):
+        ServerHandler.finish_content(self)
+        if self.framing:
+            self.framing = False
+            self._write('0\r\n\r\n')
+            self._flush()
+
+    def handle_error(self):
+        # The response might be cut short
+        self.request_handler.close_connection = 1
+        ServerHandler.handle_error(self)
+
 
 class _HTTPRequestHandler(WSGIRequestHandler):
     """
-    Custom logging for the request handler
+    HTTP/1.1 request handler with persistent connections and custom logging
     """
+    protocol_version = 'HTTP/1.1'
+    requests = 0
+
+    # The response is written in pieces, which would otherwise wait for the
+    # delayed ACK of the client on a persistent connection
+    disable_nagle_algorithm = True
+
     def log_request(self, code='-', size='-'):
-        LOG.info('%s from %s to http://%s:%s%s %s %s',
+        LOG.info('%s from %s:%s to http://%s:%s%s %s %s (request %d)',
                  self.command,
                  self.client_address[0],
+                 self.client_address[1],
                  self.server.server_address[0],
                  self.server.server_address[1],
                  self.path,
                  code,
-                 size)
+                 size,
+                 self.requests)
+
+    def handle(self):
+        self.close_connection = 0
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        """
+        Read and handle the next request of the connection
+        """
+        self.close_connection = 1
+        if not self.server.idle(self.connection, True):
+            return
+        if self.requests:
+            # Wait for the next request of a persistent connection
+            self.connection.settimeout(min(CONF.api_keepalive_timeout,
+                                           _THREADS_KEEPALIVE_TIMEOUT))
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.error:
+            # The idle timeout expired or the client has gone away
+            return
+        finally:
+            self.server.idle(self.connection, False)
+            self.connection.settimeout(None)
+
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.raw_requestline or not self.parse_request():
+            return
+
+        self.requests += 1
+        max_requests = CONF.api_keepalive_requests
+        if (not self.server.keep_alive() or
+                (max_requests > 0 and self.requests >= max_requests)):
+            self.close_connection = 1
+
+        # Only bodies with a Content-Length can be skipped to the next
+        # request. Other (chunked) bodies are read from the connection by the
+        # application, which is closed afterwards.
+        length = self.headers.getheader('Content-Length', '0')
+        if 'Transfer-Encoding' in self.headers or not length.isdigit():
+            self.close_connection = 1
+            stdin = self.rfile
+        else:
+            stdin = _Input(self.rfile, int(length))
+        if (self.request_version == 'HTTP/1.1' and
+                self.headers.getheader('Expect', '').lower() ==
+                '100-continue'):
+            self.wfile.write('HTTP/1.1 100 Continue\r\n\r\n')
+
+        handler = _ServerHandler(stdin, self.wfile, self.get_stderr(),
+                                 self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        if not self.close_connection:
+            stdin.drain()
+
+
+class _WorkerPool(object):
+    """
+    A fixed number of threads that call handler() for the items put into a
+    bounded queue. Items are rejected if the queue is full.
+    """
+
+    def __init__(self, workers, queue_size, handler):
+        self.workers = workers
+        self.handler = handler
+
+        self._queue = Queue.Queue(queue_size)
+        self._threads = []
+
+        # Statistics
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._busy = 0
+        self._busy_time = 0.0
+        self._max_queued = 0
+        self._requests = 0
+        self._rejected = 0
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            with self._lock:
+                self._busy += 1
+            start = time.time()
+            try:
+                self.handler(*item)
+            except Exception:   # pylint: disable=W0703
+                LOG.exception('Worker failed to handle %s', item)
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                    self._busy_time += time.time() - start
+                    self._requests += 1
+
+    def start(self):
+        """
+        Start the worker threads
+        """
+        self._started = time.time()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name='api-worker-%d' % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        """
+        Stop the worker threads after they've handled the queued items
+        """
+        for dummy in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def put(self, *item):
+        """
+        Queue an item for the workers. Returns False if the queue is full.
+        """
+        try:
+            self._queue.put_nowait(item)
+        except Queue.Full:
+            with self._lock:
+                self._rejected += 1
+            return False
+
+        with self._lock:
+            self._max_queued = max(self._max_queued, self._queue.qsize())
+        return True
+
+    def stats(self):
+        """
+        Return the queue depth and worker utilization statistics
+        """
+        with self._lock:
+            elapsed = time.time() - self._started
+            return {
+                'workers': self.workers,
+                'busy': self._busy,
+                'queued': self._queue.qsize(),
+                'max_queued': self._max_queued,
+                'requests': self._requests,
+                'rejected': self._rejected,
+                'utilization': (self._busy_time /
+                                (self.workers * elapsed) if elapsed else 0.0),
+            }
+
+
+class _WSGIServer(WSGIServer):
+    """
+    WSGI server that handles one connection at a time, so it doesn't keep
+    them open between requests
+    """
+
+    def keep_alive(self):
+        """
+        Check if a connection can be kept open after the current request
+        """
+        return False
+
+    def idle(self, dummy_sock, dummy_idle):
+        """
+        Mark a connection as waiting for the next request. Returns False if
+        the connection should be closed instead.
+        """
+        return True
+
+
+class _ThreadPoolWSGIServer(_WSGIServer):
+    """
+    WSGI server that hands the accepted connections to a worker pool instead
+    of handling them one at a time
+    """
+    workers = None
+
+    def __init__(self, *args, **kwargs):
+        _WSGIServer.__init__(self, *args, **kwargs)
+        self._idle = set()
+        self._idle_lock = threading.Lock()
+        self._closing = False
+
+    def keep_alive(self):
+        """
+        Keep a connection open only while there are free workers for the
+        other clients. The worker that checks counts as busy, so at least one
+        worker is never held by an idle connection.
+        """
+        if CONF.api_keepalive_timeout <= 0:
+            return False
+        stats = self.workers.stats()
+        return stats['queued'] == 0 and stats['busy'] < stats['workers']
+
+    def idle(self, sock, idle):
+        with self._idle_lock:
+            if not idle:
+                self._idle.discard(sock)
+            elif self._closing:
+                return False
+            else:
+                self._idle.add(sock)
+        return True
+
+    def shutdown(self):
+        """
+        Stop serve_forever() and close the idle persistent connections, so
+        that the workers finish
+        """
+        _WSGIServer.shutdown(self)
+        with self._idle_lock:
+            self._closing = True
+            for sock in self._idle:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+    def process_request(self, request, client_address):
+        if self.workers.put(request, client_address):
+            return
+
+        LOG.warn('Rejecting request from %s, all %d workers are busy',
+                 client_address[0], self.workers.workers)
+        try:
+            request.sendall('HTTP/1.0 503 Service Unavailable\r\n'
+                            'Retry-After: 1\r\n'
+                            'Content-Length: 0\r\n'
+                            'Connection: close\r\n\r\n')
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address):
+        """
+        Handle a connection in a worker thread
+        """
+        try:
+            self.finish_request(request, client_address)
+        except Exception:   # pylint: disable=W0703
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def handle_error(self, request, client_address):
+        LOG.exception('Failed to handle request from %s', client_address[0])
 
 
 class _HTTPServer(bottle.ServerAdapter):
@@ -59,15 +508,47 @@ class _HTTPServer(bottle.ServerAdapter):
     app = None
 
     def run(self, handler):
+        global _SERVER   # pylint: disable=W0603
+
         # Handle the TIME_WAIT state for quick server restarts
         WSGIServer.allow_reuse_address = 1
 
         # Create the server and start it
-        self.srv = WSGIServer((self.host, self.port), _HTTPRequestHandler)
+        workers = None
+        if CONF.api_engine == 'event':
+            # The workers are the executor of the event loop, which needs at
+            # least one
+            self.srv = event_server.EventWSGIServer(
+                (self.host, self.port),
+                idle_timeout=CONF.api_keepalive_timeout,
+                max_requests=CONF.api_keepalive_requests)
+            workers = _WorkerPool(max(CONF.api_workers, 1),
+                                  CONF.api_queue_size,
+                                  self.srv.process_request)
+        elif CONF.api_engine != 'threads':
+            raise exception.Failure(reason='Invalid API engine: %s' %
+                                    CONF.api_engine)
+        elif CONF.api_workers > 0:
+            self.srv = _ThreadPoolWSGIServer((self.host, self.port),
+                                             _HTTPRequestHandler)
+            workers = _WorkerPool(CONF.api_workers, CONF.api_queue_size,
+                                  self.srv.process_request_thread)
+        else:
+            self.srv = _WSGIServer((self.host, self.port),
+                                   _HTTPRequestHandler)
+
+        if workers is not None:
+            self.srv.workers = workers
+            workers.start()
+            _SERVER = self.srv
         self.srv.set_app(self.app)
         try:
             self.srv.serve_forever()
         finally:
+            # Finish the accepted requests
+            if workers is not None:
+                _SERVER = None
+                workers.stop()
             self.srv.server_close()
 
     def stop(self):
@@ -87,21 +568,42 @@ class ApiServer(threading.Thread):
 
         self.daemon = True
         self.server = None
-        self.app = bottle.Bottle()
         self.host = CONF.bind_host
         self.port = CONF.bind_port
 
         # Set the routes for the different services
-        api_compute.set_routes(self.app)
-        api_identity.set_routes(self.app)
-        api_image.set_routes(self.app)
+        app = bottle.Bottle()
+        api_compute.set_routes(app)
+        api_identity.set_routes(app)
+        api_image.set_routes(app)
+        app.route('/stats', method='GET', callback=_route_stats)
+
+        # Add the database statistics of every request and compress the
+        # responses for clients that accept it
+        self.app = compress.CompressMiddleware(
+            _DbStatsMiddleware(app), min_size=CONF.api_compress_min_size,
+            types=CONF.api_compress_types)
 
     def setup(self):
+        db.Controller().check()
         api_compute.setup()
         api_identity.setup()
         api_image.setup()
 
+        if CONF.db_purge_interval > 0:
+            task.start('db-purge', CONF.db_purge_interval, None, _db_purge)
+        if CONF.db_backup_interval > 0:
+            task.start('db-backup', CONF.db_backup_interval, None, _db_backup)
+        if CONF.db_flush_interval > 0:
+            task.start('db-flush', CONF.db_flush_interval, None, _db_flush)
+
     def teardown(self):
+        task.stop('db-purge')
+        task.stop('db-backup')
+        task.stop('db-flush')
+
+        # Don't lose the queued updates
+        _db_flush()
         api_compute.teardown()
         api_identity.teardown()
         api_image.teardown()
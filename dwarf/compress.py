@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2017 Hewlett Packard Enterprise Development, L.P.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# WSGI middleware for response compression, negotiated via the
+# Accept-Encoding request header
+#
+
+import zlib
+
+# zlib window bits of the supported content codings, in order of preference
+_ENCODINGS = [
+    ('gzip', 16 + zlib.MAX_WBITS),
+    ('deflate', zlib.MAX_WBITS),
+]
+
+
+def _negotiate(accept_encoding):
+    """
+    Return the preferred content coding of an Accept-Encoding header that we
+    support, or None
+    """
+    qvalues = {}
+    for item in accept_encoding.split(','):
+        params = item.split(';')
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            (name, dummy, value) = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+
+    best = None
+    for (coding, dummy) in _ENCODINGS:
+        q = qvalues.get(coding, qvalues.get('*', 0.0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (coding, q)
+    return None if best is None else best[0]
+
+
+class _CompressedResult(object):
+    """
+    Iterable that compresses the response body chunk by chunk
+    """
+
+    def __init__(self, result, state):
+        self.result = result
+        self.state = state
+
+    def __iter__(self):
+        compressor = None
+        for data in self.result:
+            # start_response() may be called with the first chunk
+            compressor = self.state['compressor']
+            if compressor is None:
+                yield data
+                continue
+            data = compressor.compress(data)
+            if data:
+                yield data
+        compressor = self.state['compressor']
+        if compressor is not None:
+            yield compressor.flush()
+
+    def close(self):
+        if hasattr(self.result, 'close'):
+            self.result.close()
+
+
+class CompressMiddleware(object):
+    """
+    Compress the responses with gzip or deflate if the client accepts it.
+    Only responses with one of the content 'types' and at least 'min_size'
+    bytes long (or of unknown length) are compressed, while they're sent.
+    """
+
+    def __init__(self, app, min_size=1024, types=None, level=6):
+        self.app = app
+        self.min_size = min_size
+        self.types = set(t.lower() for t in types or ['application/json'])
+        self.level = level
+
+    def _compress(self, status, headers):
+        """
+        Check if a response should be compressed
+        """
+        if status[:3] in ('204', '304'):
+            return False
+
+        content_type = ''
+        for (name, value) in headers:
+            name = name.lower()
+            if name == 'content-encoding':
+                return False
+            if name == 'content-type':
+                content_type = value.split(';')[0].strip().lower()
+            if name == 'content-length' and int(value) < self.min_size:
+                return False
+        return content_type in self.types
+
+    def __call__(self, environ, start_response):
+        encoding = _negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if (encoding is None or self.min_size < 0 or
+                environ['REQUEST_METHOD'] == 'HEAD'):
+            return self.app(environ, start_response)
+
+        state = {'compressor': None, 'started': False}
+
+        def _start_response(status, headers, exc_info=None):
+            state['started'] = True
+            if not self._compress(status, headers):
+                state['compressor'] = None
+                return start_response(status, headers, exc_info)
+
+            wbits = dict(_ENCODINGS)[encoding]
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, wbits)
+            state['compressor'] = compressor
+
+            vary = [v for (n, v) in headers if n.lower() == 'vary']
+            headers = [(n, v) for (n, v) in headers
+                       if n.lower() not in ('content-length', 'vary')]
+            headers.append(('Content-Encoding', encoding))
+            headers.append(('Vary', ', '.join(vary + ['Accept-Encoding'])))
+            write = start_response(status, headers, exc_info)
+
+            def _write(data):
+                write(compressor.compress(data))
+            return _write
+
+        result = self.app(environ, _start_response)
+        if state['started'] and state['compressor'] is None:
+            # Pass uncompressed responses through as they are
+            return result
+        return _CompressedResult(result, state)
@@ -21,12 +21,14 @@ import json
 import logging
 
 from dwarf import config
+from dwarf import db
 from dwarf import exception
 from dwarf import utils
 
 from dwarf.compute import api_response
 from dwarf.compute import flavors
 from dwarf.compute import keypairs
+from dwarf.compute import limits
 from dwarf.compute import servers
 
 CONF = config.Config()
@@ -34,8 +36,48 @@ LOG = logging.getLogger(__name__)
 
 FLAVORS = flavors.Controller()
 KEYPAIRS = keypairs.Controller()
+LIMITS = limits.Controller()
 SERVERS = servers.Controller()
 
+# Supported list query parameters and their database filters
+FLAVORS_FILTERS = {
+    'minDisk': ('disk', db.FILTER_GE),
+    'minRam': ('ram', db.FILTER_GE),
+}
+SERVERS_FILTERS = {
+    'name': ('name', db.FILTER_PREFIX),
+    'image': ('image_id', db.FILTER_EQ),
+    'flavor': ('flavor_id', db.FILTER_EQ),
+    'tags': ('tags', db.FILTER_ALL),
+    'tags-any': ('tags', db.FILTER_ANY),
+}
+
+
+def _list_servers(details):
+    """
+    List servers, filtered by the request query parameters
+    """
+    params = utils.get_pagination(bottle.request)
+    params['filters'] = utils.get_filters(bottle.request, SERVERS_FILTERS)
+
+    # Changes (including deletions) since the given time
+    changes_since = bottle.request.query.get('changes-since', None)
+    if changes_since is not None:
+        params['changes_since'] = utils.parse_timestamp(changes_since)
+
+    servers = SERVERS.list(details=details, **params)
+    next_url = utils.get_next_url(bottle.request, servers, params['limit'])
+
+    # The server status is refreshed from libvirt so it can't be filtered in
+    # the database. Filter after computing the next link so that a page
+    # without matching servers doesn't end the pagination.
+    status = bottle.request.query.get('status', None)
+    if status is not None:
+        servers = [s for s in servers if s['status'] == status.lower()]
+
+    return api_response.list_servers(servers, details=details,
+                                     next_url=next_url)
+
 
 # -----------------------------------------------------------------------------
 # Bottle Versions API routes
@@ -81,7 +123,13 @@ def _route_flavors_id(flavor_id):
 
     # nova flavor-list
     if flavor_id == 'detail':
-        return api_response.list_flavors(FLAVORS.list(), details=True)
+        params = utils.get_pagination(bottle.request)
+        params['filters'] = utils.get_filters(bottle.request, FLAVORS_FILTERS)
+        flavors = FLAVORS.list(**params)
+        next_url = utils.get_next_url(bottle.request, flavors,
+                                      params['limit'])
+        return api_response.list_flavors(flavors, details=True,
+                                         next_url=next_url)
 
     # nova flavor-show <flavor_id>
     return api_response.show_flavor(FLAVORS.show(flavor_id))
@@ -101,7 +149,12 @@ def _route_flavors():
         return api_response.create_flavor(FLAVORS.create(body['flavor']))
 
     # nova flavor-list (no details)
-    return api_response.list_flavors(FLAVORS.list(), details=False)
+    params = utils.get_pagination(bottle.request)
+    params['filters'] = utils.get_filters(bottle.request, FLAVORS_FILTERS)
+    flavors = FLAVORS.list(**params)
+    next_url = utils.get_next_url(bottle.request, flavors, params['limit'])
+    return api_response.list_flavors(flavors, details=False,
+                                     next_url=next_url)
 
 
 # -----------------------------------------------------------------------------
@@ -121,7 +174,11 @@ def _route_os_keypairs():
         return api_response.create_keypair(KEYPAIRS.create(body['keypair']))
 
     # nova keypair-list
-    return api_response.list_keypairs(KEYPAIRS.list())
+    params = utils.get_pagination(bottle.request)
+    keypairs = KEYPAIRS.list(**params)
+    next_url = utils.get_next_url(bottle.request, keypairs, params['limit'],
+                                  key='name')
+    return api_response.list_keypairs(keypairs, next_url=next_url)
 
 
 @exception.catchall
@@ -154,15 +211,17 @@ def _route_servers_id(server_id):
 
     # nova delete <server_id>
     if bottle.request.method == 'DELETE':
-        SERVERS.delete(server_id)
+        SERVERS.delete(server_id, version=utils.get_if_match(bottle.request))
+        bottle.response.status = 204
         return
 
     # nova list
     if server_id == 'detail':
-        return api_response.list_servers(SERVERS.list(), details=True)
+        return _list_servers(details=True)
 
     # nova show <server_id>
-    return api_response.show_server(SERVERS.show(server_id))
+    server = utils.set_etag(bottle.response, SERVERS.show(server_id))
+    return api_response.show_server(server)
 
 
 @exception.catchall
@@ -176,10 +235,13 @@ def _route_servers():
     # nova boot
     if bottle.request.method == 'POST':
         body = json.load(bottle.request.body)
-        return api_response.create_server(SERVERS.create(body['server']))
+        server = utils.set_etag(bottle.response,
+                                SERVERS.create(body['server']))
+        bottle.response.status = 202
+        return api_response.create_server(server)
 
     # nova list (no details)
-    return api_response.list_servers(SERVERS.list(), details=False)
+    return _list_servers(details=False)
 
 
 @exception.catchall
@@ -199,22 +261,132 @@ def _route_servers_id_action(server_id):
     # nova start
     elif 'os-start' in body:
         SERVERS.start(server_id)
+        bottle.response.status = 202
         return
 
     # nova stop
     elif 'os-stop' in body:
         SERVERS.stop(server_id)
+        bottle.response.status = 202
         return
 
     # nova reboot
     elif 'reboot' in body:
         hard = body['reboot']['type'].lower() == 'hard'
         SERVERS.reboot(server_id, hard)
+        bottle.response.status = 202
         return
 
     raise exception.BadRequest(reason='Unsupported request')
 
 
+@exception.catchall
+def _route_servers_id_metadata(server_id):
+    """
+    Route:  /compute/v2.0/servers/<server_id>/metadata
+    Method: GET, POST, PUT
+    """
+    utils.show_request(bottle.request)
+
+    # nova meta <server_id> set (POST updates, PUT replaces the metadata)
+    if bottle.request.method in ('POST', 'PUT'):
+        body = json.load(bottle.request.body)
+        replace = bottle.request.method == 'PUT'
+        return api_response.show_server_metadata(
+            SERVERS.set_metadata(server_id, body['metadata'],
+                                 replace=replace))
+
+    return api_response.show_server_metadata(SERVERS.list_metadata(server_id))
+
+
+@exception.catchall
+def _route_servers_id_metadata_key(server_id, key):
+    """
+    Route:  /compute/v2.0/servers/<server_id>/metadata/<key>
+    Method: GET, PUT, DELETE
+    """
+    utils.show_request(bottle.request)
+
+    # nova meta <server_id> delete <key>
+    if bottle.request.method == 'DELETE':
+        SERVERS.delete_metadata(server_id, key)
+        return
+
+    if bottle.request.method == 'PUT':
+        body = json.load(bottle.request.body)
+        meta = body['meta']
+        if meta.keys() != [key]:
+            raise exception.BadRequest(reason='Request body and URI '
+                                       'mismatch')
+        metadata = SERVERS.set_metadata(server_id, meta)
+        return api_response.show_server_metadata_item({key: metadata[key]})
+
+    return api_response.show_server_metadata_item(
+        SERVERS.show_metadata(server_id, key))
+
+
+@exception.catchall
+def _route_servers_id_tags(server_id):
+    """
+    Route:  /compute/v2.0/servers/<server_id>/tags
+    Method: GET, PUT, DELETE
+    """
+    utils.show_request(bottle.request)
+
+    # nova server-tag-delete-all <server_id>
+    if bottle.request.method == 'DELETE':
+        SERVERS.delete_tag(server_id)
+        return
+
+    # nova server-tag-set <server_id> <tags>
+    if bottle.request.method == 'PUT':
+        body = json.load(bottle.request.body)
+        return api_response.list_server_tags(
+            SERVERS.set_tags(server_id, body['tags']))
+
+    # nova server-tag-list <server_id>
+    return api_response.list_server_tags(SERVERS.list_tags(server_id))
+
+
+@exception.catchall
+def _route_servers_id_tags_tag(server_id, tag):
+    """
+    Route:  /compute/v2.0/servers/<server_id>/tags/<tag>
+    Method: GET, PUT, DELETE
+    """
+    utils.show_request(bottle.request)
+
+    # nova server-tag-delete <server_id> <tag>
+    if bottle.request.method == 'DELETE':
+        SERVERS.delete_tag(server_id, tag)
+        return
+
+    # nova server-tag-add <server_id> <tag>
+    if bottle.request.method == 'PUT':
+        if SERVERS.add_tag(server_id, tag):
+            bottle.response.status = 201
+            bottle.response.set_header('Location', bottle.request.url)
+            return
+    else:
+        SERVERS.show_tag(server_id, tag)
+    bottle.response.status = 204
+
+
+# -----------------------------------------------------------------------------
+# Bottle Limits API routes
+
+@exception.catchall
+def _route_limits():
+    """
+    Route:  /compute/v2.0/limits
+    Method: GET
+    """
+    utils.show_request(bottle.request)
+
+    # nova limits
+    return api_response.show_limits(LIMITS.show())
+
+
 # -----------------------------------------------------------------------------
 # Compute API exports
 
@@ -240,12 +412,27 @@ def set_routes(app):
     app.route('/compute/v2.0/servers/<server_id>/action',
               method='POST',
               callback=_route_servers_id_action)
+    app.route('/compute/v2.0/servers/<server_id>/metadata',
+              method=('GET', 'POST', 'PUT'),
+              callback=_route_servers_id_metadata)
+    app.route('/compute/v2.0/servers/<server_id>/metadata/<key>',
+              method=('GET', 'PUT', 'DELETE'),
+              callback=_route_servers_id_metadata_key)
+    app.route('/compute/v2.0/servers/<server_id>/tags',
+              method=('GET', 'PUT', 'DELETE'),
+              callback=_route_servers_id_tags)
+    app.route('/compute/v2.0/servers/<server_id>/tags/<tag>',
+              method=('GET', 'PUT', 'DELETE'),
+              callback=_route_servers_id_tags_tag)
     app.route('/compute/v2.0/flavors/<flavor_id>',
               method=('GET', 'DELETE'),
               callback=_route_flavors_id)
     app.route('/compute/v2.0/flavors',
               method=('GET', 'POST'),
               callback=_route_flavors)
+    app.route('/compute/v2.0/limits',
+              method='GET',
+              callback=_route_limits)
 
 
 def setup():
@@ -24,6 +24,16 @@ CONF = config.Config()
 DETAILS = ('created_at', 'deleted', 'deleted_at', 'updated_at')
 
 
+def _list(key, items, next_url):
+    """
+    Create a list response with a link to the next page (if any)
+    """
+    resp = {key: items}
+    if next_url is not None:
+        resp['%s_links' % key] = [{'href': next_url, 'rel': 'next'}]
+    return resp
+
+
 # -----------------------------------------------------------------------------
 # Versions
 
@@ -72,9 +82,9 @@ def create_flavor(data):
     return {'flavor': utils.json_render(FLAVOR, data, _details=True)}
 
 
-def list_flavors(data, details=True):
-    return {'flavors': [utils.json_render(FLAVOR, d, _details=details)
-                        for d in data]}
+def list_flavors(data, details=True, next_url=None):
+    return _list('flavors', [utils.json_render(FLAVOR, d, _details=details)
+                             for d in data], next_url)
 
 
 def show_flavor(data):
@@ -105,9 +115,9 @@ def create_keypair(data):
     return {'keypair': utils.json_render(KEYPAIR, data, _details=False)}
 
 
-def list_keypairs(data):
-    return {'keypairs': [utils.json_render(KEYPAIR, d, _details=False)
-                         for d in data]}
+def list_keypairs(data, next_url=None):
+    return _list('keypairs', [utils.json_render(KEYPAIR, d, _details=False)
+                              for d in data], next_url)
 
 
 def show_keypair(data):
@@ -119,6 +129,9 @@ def show_keypair(data):
 
 SERVER = """{
 % if _details:
+% if defined('task_state') and task_state:
+    "OS-EXT-STS:task_state": "{{task_state}}",
+% end
     "created_at": "{{created_at}}",
     "deleted": "{{deleted}}",
     "deleted_at": "{{deleted_at}}",
@@ -134,6 +147,12 @@ SERVER = """{
     },
     "config_drive": "{{config_drive}}",
     "flavor": {
+% if defined('flavor_name'):
+        "disk": "{{flavor_disk}}",
+        "original_name": "{{flavor_name}}",
+        "ram": "{{flavor_ram}}",
+        "vcpus": "{{flavor_vcpus}}",
+% end
         "id": "{{flavor_id}}",
         "links": [
             {
@@ -144,6 +163,9 @@ SERVER = """{
     },
     "id": "{{id}}",
     "image": {
+% if defined('image_name'):
+        "name": "{{image_name}}",
+% end
         "id": "{{image_id}}",
         "links": [
             {
@@ -162,9 +184,9 @@ def create_server(data):
     return {'server': utils.json_render(SERVER, data, _details=True)}
 
 
-def list_servers(data, details=True):
-    return {'servers': [utils.json_render(SERVER, d, _details=details)
-                        for d in data]}
+def list_servers(data, details=True, next_url=None):
+    return _list('servers', [utils.json_render(SERVER, d, _details=details)
+                             for d in data], next_url)
 
 
 def show_server(data):
@@ -173,3 +195,39 @@ def show_server(data):
 
 def show_console_log(data):
     return {'output': data}
+
+
+def show_server_metadata(data):
+    return {'metadata': data}
+
+
+def show_server_metadata_item(data):
+    return {'meta': data}
+
+
+def list_server_tags(data):
+    return {'tags': data}
+
+
+# -----------------------------------------------------------------------------
+# Limits
+
+LIMITS = """{
+    "absolute": {
+        "maxTotalCores": {{vcpus['limit']}},
+        "maxTotalImageBytes": {{image_bytes['limit']}},
+        "maxTotalImages": {{images['limit']}},
+        "maxTotalInstances": {{servers['limit']}},
+        "maxTotalRAMSize": {{ram['limit']}},
+        "totalCoresUsed": {{vcpus['used']}},
+        "totalImageBytesUsed": {{image_bytes['used']}},
+        "totalImagesUsed": {{images['used']}},
+        "totalInstancesUsed": {{servers['used']}},
+        "totalRAMUsed": {{ram['used']}}
+    },
+    "rate": []
+}"""
+
+
+def show_limits(data):
+    return {'limits': utils.json_render(LIMITS, data)}
@@ -44,12 +44,16 @@ class Controller(object):
         LOG.info('delete(flavor_id=%s)', flavor_id)
         return self.db.flavors.delete(id=flavor_id)
 
-    def list(self):
+    def list(self, limit=None, marker=None, sort_key=None, sort_dir='asc',
+             filters=None):
         """
-        List all flavors
+        List flavors
         """
-        LOG.info('list()')
-        return self.db.flavors.list()
+        LOG.info('list(limit=%s, marker=%s, sort_key=%s, sort_dir=%s, '
+                 'filters=%s)', limit, marker, sort_key, sort_dir, filters)
+        return self.db.flavors.list(limit=limit, marker=marker,
+                                    sort_key=sort_key, sort_dir=sort_dir,
+                                    filters=filters)
 
     def show(self, flavor_id):
         """
@@ -92,12 +92,15 @@ class Controller(object):
         LOG.info('delete(name=%s)', keypair_name)
         return self.db.keypairs.delete(name=keypair_name)
 
-    def list(self):
+    def list(self, limit=None, marker=None, sort_key=None, sort_dir='asc'):
         """
-        List all keypairs
+        List keypairs, the marker is a keypair name
         """
-        LOG.info('list()')
-        return self.db.keypairs.list()
+        LOG.info('list(limit=%s, marker=%s, sort_key=%s, sort_dir=%s)', limit,
+                 marker, sort_key, sort_dir)
+        return self.db.keypairs.list(limit=limit, marker=marker,
+                                     marker_key='name', sort_key=sort_key,
+                                     sort_dir=sort_dir)
 
     def show(self, keypair_name):
         """
@@ -25,6 +25,7 @@ import time
 
 from dwarf import config
 from dwarf import db
+from dwarf import exception
 from dwarf import task
 from dwarf import utils
 
@@ -43,6 +44,27 @@ SERVER_STOPPED = 'stopped'
 SERVER_PAUSED = 'paused'
 SERVER_SUSPENDED = 'suspended'
 SERVER_ERROR = 'error'
+SERVER_DELETED = 'deleted'
+SERVER_REBOOTING = 'rebooting'
+SERVER_DELETING = 'deleting'
+
+# Task states of the servers with a queued or running operation
+TASK_SPAWNING = 'spawning'
+TASK_DELETING = 'deleting'
+TASK_REBOOTING = 'rebooting'
+TASK_REBOOTING_HARD = 'rebooting_hard'
+TASK_POWERING_ON = 'powering-on'
+TASK_POWERING_OFF = 'powering-off'
+
+# Server columns of the list without details, the integer ID is needed to
+# refresh the status from libvirt
+_LIST_COLS = ['id', 'int_id', 'name', 'status', 'ip', 'config_drive',
+              'flavor_id', 'image_id', 'key_name', 'deleted', 'task_state']
+
+# Limits of the server metadata and tags (the same as nova's)
+_MAX_METADATA_LEN = 255
+_MAX_TAG_LEN = 60
+_MAX_TAGS = 50
 
 _VIRT_SERVER_STATE = {
     virt.DOMAIN_NOSTATE: SERVER_BUILDING,
@@ -53,6 +75,18 @@ _VIRT_SERVER_STATE = {
     virt.DOMAIN_SUSPENDED: SERVER_SUSPENDED,
 }
 
+# Server status while an operation is in progress, other task states keep
+# the status of the domain
+_TASK_SERVER_STATE = {
+    TASK_SPAWNING: SERVER_BUILDING,
+    TASK_DELETING: SERVER_DELETING,
+    TASK_REBOOTING: SERVER_REBOOTING,
+    TASK_REBOOTING_HARD: SERVER_REBOOTING,
+}
+
+# Background queue of the server operations
+_QUEUE = task.WorkQueue('compute', CONF.compute_workers)
+
 
 def _generate_mac():
     """
@@ -65,6 +99,40 @@ def _generate_mac():
     return ':'.join(['%02x' % x for x in mac])
 
 
+def _check_metadata(metadata):
+    """
+    Validate server metadata items
+    """
+    if not isinstance(metadata, dict):
+        raise exception.BadRequest(reason='Metadata must be a dict')
+    for (key, val) in metadata.iteritems():
+        if not isinstance(key, basestring) or not key:
+            raise exception.BadRequest(reason='Invalid metadata key: %s' %
+                                       key)
+        if not isinstance(val, basestring):
+            raise exception.BadRequest(reason='Metadata value of %s must be '
+                                       'a string' % key)
+        if len(key) > _MAX_METADATA_LEN or len(val) > _MAX_METADATA_LEN:
+            raise exception.BadRequest(reason='Metadata item %s is longer '
+                                       'than %d characters' %
+                                       (key, _MAX_METADATA_LEN))
+
+
+def _check_tags(tags):
+    """
+    Validate server tags
+    """
+    if not isinstance(tags, list):
+        raise exception.BadRequest(reason='Tags must be a list')
+    for tag in tags:
+        if (not isinstance(tag, basestring) or not tag or
+                len(tag) > _MAX_TAG_LEN or ',' in tag or '/' in tag):
+            raise exception.BadRequest(reason='Invalid tag: %s' % tag)
+    if len(set(tags)) > _MAX_TAGS:
+        raise exception.BadRequest(reason='Servers can have at most %d '
+                                   'tags' % _MAX_TAGS)
+
+
 def _create_disks(server, image, flavor):
     """
     Create the base (backing) and server disk images
@@ -123,7 +191,7 @@ def _create_config_drive(server, keypair):
     """
     Create the config drive for the server
     """
-    if not (CONF.force_config_drive or server['config_drive'] == 'True'):
+    if not (CONF.force_config_drive or server['config_drive']):
         return
 
     # Config drive data
@@ -179,6 +247,12 @@ class Controller(object):
         self.keypairs = keypairs.Controller()
         self.virt = virt.Controller()
 
+    def _check_server(self, server_id):
+        """
+        Check that a server exists
+        """
+        self.db.servers.show(id=server_id, cols=['id'])
+
     def _update_ip(self, server):
         """
         Update the DHCP assigned IP address
@@ -188,19 +262,185 @@ class Controller(object):
         if lease is None:
             return
 
-        # Update the database
-        server = self.db.servers.update(id=server['id'], ip=lease['ip'])
+        # Queue the database update
+        self.db.servers.queue_update(id=server['id'], ip=lease['ip'])
         return lease['ip']
 
+    def _joins(self):
+        """
+        Return the flavor and image columns of the detailed server views
+        """
+        return [(self.db.flavors, 'flavor_id', ['name', 'disk', 'ram',
+                                                'vcpus']),
+                (self.db.images, 'image_id', ['name'])]
+
     def _update_status(self, server):
         """
         Update the (volatile) status of the server
         """
+        if server.get('task_state') in _TASK_SERVER_STATE:
+            server['status'] = _TASK_SERVER_STATE[server['task_state']]
+            return server
+
         info = self.virt.info_server(server)
         if info and 'state' in info:
             server['status'] = _VIRT_SERVER_STATE[info['state']]
         return server
 
+    def _begin_task(self, server_id, task_state, version=None):
+        """
+        Set the task state of a server that has no operation in progress and
+        return the updated server. A delete takes over from any other
+        operation, which then doesn't end its task (see _end_task()).
+        """
+        server = self.db.servers.show(id=server_id)
+        if version is not None and server['version'] != version:
+            raise exception.Conflict(reason='server %s has version %s, not '
+                                     '%s' % (server_id, server['version'],
+                                             version))
+        if server['task_state'] and (task_state != TASK_DELETING or
+                                     server['task_state'] == TASK_DELETING):
+            raise exception.Conflict(reason='server %s is in task state %s' %
+                                     (server_id, server['task_state']))
+        return self.db.servers.update(id=server_id, task_state=task_state,
+                                      expected_version=server['version'])
+
+    def _end_task(self, server_id, task_state, **kwargs):
+        """
+        Clear the task state of a server, and update the columns in 'kwargs',
+        if the server is still in task state 'task_state'. Returns the updated
+        server or None if the server has been deleted or is being deleted.
+        """
+        while True:
+            try:
+                server = self.db.servers.show(id=server_id,
+                                              cols=['task_state', 'version'])
+                if server['task_state'] != task_state:
+                    LOG.info('Server %s went from task state %s to %s',
+                             server_id, task_state, server['task_state'])
+                    return None
+                return self.db.servers.update(
+                    id=server_id, task_state='',
+                    expected_version=server['version'], **kwargs)
+            except exception.NotFound:
+                LOG.info('Server %s has been deleted', server_id)
+                return None
+            except exception.Conflict:
+                # The server was updated in the meantime, check again
+                continue
+
+    def _queue(self, func, server, *args):
+        """
+        Queue a server operation
+        """
+        _QUEUE.put(self._run, func, server, *args)
+
+    def _run(self, func, server, *args):
+        """
+        Run a queued server operation, a failed operation puts the server
+        into error state
+        """
+        try:
+            func(server, *args)
+        except Exception:   # pylint: disable=W0703
+            LOG.exception('Failed to run %s for server %s', func.__name__,
+                          server['id'])
+            self._end_task(server['id'], server['task_state'],
+                           status=SERVER_ERROR)
+
+    def _create(self, server, image, flavor, keypair):
+        """
+        Create the disks and the domain of a new server
+        """
+        server_id = server['id']
+
+        # Create the server directory
+        basepath = os.path.join(CONF.instances_dir, server_id)
+        os.makedirs(basepath)
+
+        # Create the server disk images and config drive
+        _create_disks(server, image, flavor)
+        _create_config_drive(server, keypair)
+
+        # Finally create the server
+        self.virt.create_server(server, flavor)
+        updated = self._end_task(server_id, TASK_SPAWNING)
+        if updated is None:
+            # The server is being deleted. If the delete already ran, the new
+            # domain and files are left to clean up.
+            try:
+                self._check_server(server_id)
+            except exception.NotFound:
+                self._destroy(server)
+            return
+        server = updated
+
+        # Start a task to wait for the server to get its DHCP IP address
+        task.start(server_id, 2, 60 / 2, self._update_ip, server)
+
+    def _destroy(self, server):
+        """
+        Delete the domain and the files of a server
+        """
+        server_id = server['id']
+
+        # Stop all running tasks associated with this server
+        task.stop(server_id)
+
+        # Kill the running server
+        self.virt.delete_server(server)
+
+        # Purge all server files
+        basepath = os.path.join(CONF.instances_dir, server_id)
+        if os.path.exists(basepath):
+            shutil.rmtree(basepath)
+
+    def _delete(self, server):
+        """
+        Delete the domain, the files and the database entry of a server
+        """
+        self._destroy(server)
+
+        # Delete the database entry
+        self.db.servers.delete(id=server['id'])
+
+    def _reboot(self, server, hard):
+        """
+        Shut a server down and start it again
+        """
+        self.virt.stop_server(server, hard)
+
+        # Check the status of the server
+        running = False
+        for dummy in range(0, CONF.server_soft_reboot_timeout / 2):
+            info = self.virt.info_server(server)
+            running = bool(info) and info.get('state') == virt.DOMAIN_RUNNING
+            if not running:
+                break
+            time.sleep(2)
+
+        # Shut the server down hard if it ignored the soft request
+        if hard is False and running:
+            self.virt.stop_server(server, True)
+            time.sleep(2)
+
+        self.virt.start_server(server)
+        self._end_task(server['id'], server['task_state'])
+
+    def _start(self, server):
+        """
+        Start the domain of a server
+        """
+        self.virt.start_server(server)
+        self._end_task(server['id'], server['task_state'])
+
+    def _stop(self, server, hard):
+        """
+        Stop the domain of a server
+        """
+        self.virt.stop_server(server, hard)
+        self._end_task(server['id'], server['task_state'])
+
     # -------------------------------------------------------------------------
     # Server operations (public)
 
@@ -212,12 +452,38 @@ class Controller(object):
 
         self.virt.create_network()
 
+        # The operations that were interrupted by a restart won't finish
+        for server in self.db.servers.list(cols=['id', 'task_state']):
+            if server['task_state']:
+                LOG.warn('Server %s was interrupted in task state %s',
+                         server['id'], server['task_state'])
+                self.db.servers.update(id=server['id'], status=SERVER_ERROR,
+                                       task_state='')
+
     def teardown(self):
         """
         Teardown on exit
         """
         LOG.info('teardown()')
 
+        # Finish the queued server operations
+        self.wait()
+
+    def add_tag(self, server_id, tag):
+        """
+        Add a tag to a server. Returns True if the tag was added, False if the
+        server already has it.
+        """
+        LOG.info('add_tag(server_id=%s, tag=%s)', server_id, tag)
+
+        self._check_server(server_id)
+        tags = self.db.server_tags.get(server_id).keys()
+        if tag in tags:
+            return False
+        _check_tags(tags + [tag])
+        self.db.server_tags.set(server_id, {tag: ''})
+        return True
+
     def console_log(self, server_id):
         """
         Return the server console log
@@ -236,7 +502,8 @@ class Controller(object):
 
     def create(self, server):
         """
-        Create a new server
+        Create a new server. The server is built in the background, in task
+        state 'spawning'.
         """
         LOG.info('create(server=%s)', server)
 
@@ -258,85 +525,131 @@ class Controller(object):
         server = self.db.servers.create(name=name, image_id=image_id,
                                         flavor_id=flavor_id, key_name=key_name,
                                         config_drive=config_drive,
-                                        status=SERVER_BUILDING)
-        server_id = server['id']
+                                        status=SERVER_BUILDING,
+                                        task_state=TASK_SPAWNING,
+                                        vcpus=flavor['vcpus'],
+                                        ram=flavor['ram'],
+                                        disk=flavor['disk'])
 
         # Generate some more server properties and update the database
         mac_address = _generate_mac()
-        server = self.db.servers.update(id=server_id, mac_address=mac_address)
+        server = self.db.servers.update(id=server['id'],
+                                        mac_address=mac_address)
 
-        # Create the server directory
-        basepath = os.path.join(CONF.instances_dir, server_id)
-        os.makedirs(basepath)
+        self._queue(self._create, server, image, flavor, keypair)
+        return self._update_status(server)
 
-        # Create the server disk images and config drive
-        _create_disks(server, image, flavor)
-        _create_config_drive(server, keypair)
+    def delete(self, server_id, version=None):
+        """
+        Delete a server in the background, also while another operation (like
+        its build) is in progress
+        """
+        LOG.info('delete(server_id=%s, version=%s)', server_id, version)
 
-        # Finally create the server
-        self.virt.create_server(server, flavor)
+        server = self._begin_task(server_id, TASK_DELETING, version=version)
+        self._queue(self._delete, server)
 
-        # Start a task to wait for the server to get its DHCP IP address
-        task.start(server_id, 2, 60 / 2, self._update_ip, server)
+    def delete_metadata(self, server_id, key):
+        """
+        Delete a server metadata item
+        """
+        LOG.info('delete_metadata(server_id=%s, key=%s)', server_id, key)
 
-        return self._update_status(server)
+        self._check_server(server_id)
+        self.db.server_metadata.delete(server_id, key=key)
 
-    def delete(self, server_id):
+    def delete_tag(self, server_id, tag=None):
         """
-        Delete a server
+        Delete a server tag, or all tags if no tag is given
         """
-        LOG.info('delete(server_id=%s)', server_id)
+        LOG.info('delete_tag(server_id=%s, tag=%s)', server_id, tag)
 
-        server = self.db.servers.show(id=server_id)
+        self._check_server(server_id)
+        self.db.server_tags.delete(server_id, key=tag)
 
-        # Stop all running tasks associated with this server
-        task.stop(server_id)
+    def list(self, limit=None, marker=None, sort_key=None, sort_dir='asc',
+             filters=None, changes_since=None, details=True):
+        """
+        List servers, including the deleted servers if 'changes_since' is
+        given. Only the matching servers are refreshed from libvirt. Detailed
+        lists include the flavor and image of the servers, other lists only
+        the columns of the basic view.
+        """
+        LOG.info('list(limit=%s, marker=%s, sort_key=%s, sort_dir=%s, '
+                 'filters=%s, changes_since=%s, details=%s)', limit, marker,
+                 sort_key, sort_dir, filters, changes_since, details)
 
-        # Kill the running server
-        self.virt.delete_server(server)
+        if details:
+            (cols, joins) = (None, self._joins())
+        else:
+            (cols, joins) = (_LIST_COLS, None)
 
-        # Purge all server files
-        basepath = os.path.join(CONF.instances_dir, server_id)
-        if os.path.exists(basepath):
-            shutil.rmtree(basepath)
+        servers = []
+        for s in self.db.servers.list(limit=limit, marker=marker,
+                                      sort_key=sort_key, sort_dir=sort_dir,
+                                      filters=filters,
+                                      changes_since=changes_since,
+                                      cols=cols, joins=joins):
+            if s['deleted']:
+                s['status'] = SERVER_DELETED
+                servers.append(s)
+            else:
+                servers.append(self._update_status(s))
 
-        # Delete the database entry
-        self.db.servers.delete(id=server['id'])
+        return servers
 
-    def list(self):
+    def list_metadata(self, server_id):
         """
-        List all servers
+        List the metadata of a server
         """
-        LOG.info('list()')
+        LOG.info('list_metadata(server_id=%s)', server_id)
 
-        servers = []
-        for s in self.db.servers.list():
-            servers.append(self._update_status(s))
+        self._check_server(server_id)
+        return self.db.server_metadata.get(server_id)
 
-        return servers
+    def list_tags(self, server_id):
+        """
+        List the tags of a server
+        """
+        LOG.info('list_tags(server_id=%s)', server_id)
+
+        self._check_server(server_id)
+        return self.db.server_tags.get(server_id).keys()
 
     def reboot(self, server_id, hard=False):
         """
-        Reboot a server
+        Reboot a server in the background
         """
         LOG.info('reboot(server_id=%s, hard=%s)', server_id, hard)
 
-        self.stop(server_id, hard=hard)
+        server = self._begin_task(server_id, (TASK_REBOOTING_HARD if hard
+                                              else TASK_REBOOTING))
+        self._queue(self._reboot, server, hard)
 
-        # Check the status of the server
-        server = self.db.servers.show(id=server_id)
-        for dummy in range(0, CONF.server_soft_reboot_timeout / 2):
-            server = self._update_status(server)
-            if server['status'] != SERVER_ACTIVE:
-                break
-            time.sleep(2)
+    def set_metadata(self, server_id, metadata, replace=False):
+        """
+        Add or update server metadata items, or replace all items if
+        'replace' is True
+        """
+        LOG.info('set_metadata(server_id=%s, metadata=%s, replace=%s)',
+                 server_id, metadata, replace)
 
-        # Shut the server down hard if it ignored the soft request
-        if hard is False and server['status'] == SERVER_ACTIVE:
-            self.stop(server_id, hard=True)
-            time.sleep(2)
+        _check_metadata(metadata)
+        self._check_server(server_id)
+        return self.db.server_metadata.set(server_id, metadata,
+                                           replace=replace)
 
-        self.start(server_id)
+    def set_tags(self, server_id, tags):
+        """
+        Replace the tags of a server
+        """
+        LOG.info('set_tags(server_id=%s, tags=%s)', server_id, tags)
+
+        _check_tags(tags)
+        self._check_server(server_id)
+        return self.db.server_tags.set(server_id,
+                                       dict((tag, '') for tag in tags),
+                                       replace=True).keys()
 
     def show(self, server_id):
         """
@@ -344,23 +657,52 @@ class Controller(object):
         """
         LOG.info('show(server_id=%s)', server_id)
 
-        server = self.db.servers.show(id=server_id)
+        server = self.db.servers.show(id=server_id, joins=self._joins())
         return self._update_status(server)
 
+    def show_metadata(self, server_id, key):
+        """
+        Show a server metadata item
+        """
+        LOG.info('show_metadata(server_id=%s, key=%s)', server_id, key)
+
+        metadata = self.list_metadata(server_id)
+        if key not in metadata:
+            raise exception.NotFound(reason='metadata item %s not found' %
+                                     key)
+        return {key: metadata[key]}
+
+    def show_tag(self, server_id, tag):
+        """
+        Check that a server has a tag
+        """
+        LOG.info('show_tag(server_id=%s, tag=%s)', server_id, tag)
+
+        if tag not in self.list_tags(server_id):
+            raise exception.NotFound(reason='tag %s not found' % tag)
+
     def start(self, server_id):
         """
-        Start a server
+        Start a server in the background
         """
         LOG.info('start(server_id=%s)', server_id)
 
-        server = self.db.servers.show(id=server_id)
-        self.virt.start_server(server)
+        server = self._begin_task(server_id, TASK_POWERING_ON)
+        self._queue(self._start, server)
 
     def stop(self, server_id, hard=False):
         """
-        Stop a server
+        Stop a server in the background
         """
         LOG.info('stop(server_id=%s, hard=%s)', server_id, hard)
 
-        server = self.db.servers.show(id=server_id)
-        self.virt.stop_server(server, hard)
+        server = self._begin_task(server_id, TASK_POWERING_OFF)
+        self._queue(self._stop, server, hard)
+
+    def wait(self):
+        """
+        Wait for the queued server operations to finish
+        """
+        LOG.info('wait()')
+
+        _QUEUE.join()
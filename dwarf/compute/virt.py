@@ -19,8 +19,10 @@
 import libvirt
 import logging
 import os
+import threading
 import uuid
 
+from functools import wraps
 from string import Template
 
 from dwarf import config
@@ -47,8 +49,24 @@ _LIBVIRT_DOMAIN_STATE = {
 }
 
 
+# Serializes the libvirt operations of the API worker threads, which share the
+# libvirt connection
+_LIBVIRT_LOCK = threading.RLock()
+
+
+def _synchronized(func):
+    """
+    Decorator that holds the libvirt lock while calling a method
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with _LIBVIRT_LOCK:
+            return func(*args, **kwargs)
+    return wrapper
+
+
 def _name(sid):
-    return 'dwarf-%08x' % int(sid)
+    return 'dwarf-%08x' % sid
 
 
 def _xml_snippet(name, enable):
@@ -88,7 +106,7 @@ def _create_domain_xml(server, flavor, force=False):
             'domain_type': CONF.libvirt_domain_type,
             'uuid': server['id'],
             'name': _name(server['int_id']),
-            'memory': int(flavor['ram']) * 1024,
+            'memory': flavor['ram'] * 1024,
             'vcpus': flavor['vcpus'],
             'basepath': basepath,
             'mac_addr': server['mac_address'],
@@ -98,7 +116,7 @@ def _create_domain_xml(server, flavor, force=False):
         # Enable/disable the config drive
         config_drive = _xml_snippet('config_drive',
                                     (CONF.force_config_drive or
-                                     server['config_drive'] == 'True'))
+                                     server['config_drive']))
         xml_info.update(config_drive)
 
         xml = Template(xml_template).substitute(xml_info)
@@ -242,6 +260,7 @@ class Controller(object):
     # -------------------------------------------------------------------------
     # Server operations (public)
 
+    @_synchronized
     def create_server(self, server, flavor):
         """
         Create a server
@@ -252,6 +271,7 @@ class Controller(object):
         xml = _create_domain_xml(server, flavor)
         self._create_domain(xml)
 
+    @_synchronized
     def delete_server(self, server):
         """
         Delete a server
@@ -263,6 +283,7 @@ class Controller(object):
         self._destroy_domain(domain)
         self._undefine_domain(domain)
 
+    @_synchronized
     def start_server(self, server):
         """
         Start a server
@@ -273,6 +294,7 @@ class Controller(object):
         domain = self._get_domain(server)
         self._start_domain(domain)
 
+    @_synchronized
     def stop_server(self, server, hard=False):
         """
         Stop a server
@@ -283,6 +305,7 @@ class Controller(object):
         domain = self._get_domain(server)
         self._shutdown_domain(domain, hard)
 
+    @_synchronized
     def info_server(self, server):
         """
         Return the server info
@@ -295,6 +318,7 @@ class Controller(object):
         LOG.info('info = %s', info)
         return info
 
+    @_synchronized
     def create_network(self):
         """
         Create the network
@@ -320,6 +344,7 @@ class Controller(object):
         if net.isActive() == 0:
             net.create()
 
+    @_synchronized
     def get_dhcp_lease(self, server):
         """
         Get DHCP lease information
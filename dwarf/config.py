@@ -28,6 +28,7 @@ _BASE_CONFIG = {
     'instances_dir': '/var/lib/dwarf/instances',
     'instances_base_dir': '/var/lib/dwarf/instances/_base',
     'images_dir': '/var/lib/dwarf/images',
+    'backups_dir': '/var/lib/dwarf/backups',
 
     # Database and logfile
     'dwarf_db': '/var/lib/dwarf/dwarf.db',
@@ -44,9 +45,44 @@ _DEFAULT_CONFIG = {
 
     'bind_host': '127.0.0.1',
     'bind_port': 5000,
+    'api_engine': 'threads',
+    'api_workers': 8,
+    'api_queue_size': 32,
+    'api_keepalive_timeout': 60,
+    'api_keepalive_requests': 100,
+    'api_compress_min_size': 1024,
+    'api_compress_types': ['application/json', 'text/plain'],
 
     'server_soft_reboot_timeout': 30,
+    'compute_workers': 2,
     'force_config_drive': True,
+
+    'api_max_limit': 1000,
+
+    'quota_instances': -1,
+    'quota_cores': -1,
+    'quota_ram': -1,
+    'quota_images': -1,
+    'quota_image_bytes': -1,
+
+    'db_engine': 'sqlite',
+    'db_journal_mode': 'wal',
+    'db_synchronous': 'normal',
+    'db_cache_size': -2000,
+    'db_mmap_size': 0,
+    'db_busy_timeout': 5000,
+    'db_row_cache_size': 1000,
+    'db_flush_interval': 1,
+    'db_debug_queries': False,
+    'db_repeated_calls': 2,
+
+    'db_purge_age': 30,
+    'db_purge_interval': 86400,
+    'db_purge_limit': 1000,
+
+    'db_backup_interval': 0,
+    'db_backup_keep': 7,
+    'db_backup_pages': 256,
 }
 
 
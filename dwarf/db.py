@@ -17,12 +17,23 @@
 
 from __future__ import print_function
 
+import csv
+import glob
+import json
 import logging
 import os
+import shutil
 import sqlite3 as sq3
+import sys
+import threading
 import uuid
+import weakref
 
-from time import gmtime, strftime
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial, wraps
+from time import gmtime, strftime, time
 
 from dwarf import exception
 from dwarf import config
@@ -31,61 +42,2074 @@ CONF = config.Config()
 LOG = logging.getLogger(__name__)
 
 _DB_COLS = ['created_at', 'updated_at', 'deleted_at', 'deleted', 'id',
-            'int_id']
+            'int_id', 'version']
 
 DB_SERVERS_COLS = _DB_COLS + ['name', 'status', 'image_id', 'flavor_id',
-                              'key_name', 'mac_address', 'ip', 'config_drive']
+                              'key_name', 'mac_address', 'ip', 'config_drive',
+                              'vcpus', 'ram', 'disk', 'task_state']
 DB_KEYPAIRS_COLS = _DB_COLS + ['name', 'fingerprint', 'public_key']
 DB_IMAGES_COLS = _DB_COLS + ['name', 'disk_format', 'container_format', 'size',
                              'status', 'file', 'checksum', 'min_disk',
                              'min_ram', 'owner', 'protected', 'visibility']
 DB_FLAVORS_COLS = _DB_COLS + ['name', 'disk', 'ram', 'vcpus']
 
-TRUE = 'True'
-FALSE = 'False'
+# Booleans are stored as integers
+TRUE = 1
+FALSE = 0
+
+# Version of the database schema created by this code, stored in the database
+# as the sqlite user_version. Bump it and add a migration function to
+# _MIGRATIONS (at the end of the file) when changing the schema.
+SCHEMA_VERSION = 7
+
+# Indexes for list() (which returns the rows in insertion order unless sorted
+# by one of the other indexed columns), the lookups in show() and delete() and
+# the uniqueness check in create()
+_DB_INDEXES = [('deleted', ), ('deleted', 'id'), ('deleted', 'name'),
+               ('deleted', 'created_at'), ('deleted', 'updated_at'),
+               ('updated_at', )]
+
+# Columns and indexes of the journal table. The sequence number is the rowid.
+JOURNAL_COLS = ['seq', 'created_at', 'resource', 'resource_id', 'operation',
+                'changes']
+_JOURNAL_INDEXES = [('resource', 'seq'), ('resource_id', 'seq')]
+
+# Columns and indexes of the metadata tables. The primary key (id, key)
+# serves the lookups by row, the (key, value) index those by key (and value).
+METADATA_COLS = ['id', 'key', 'value']
+_METADATA_INDEXES = [('key', 'value')]
+
+# Usage counters and the options of the quotas that limit them (-1 means
+# unlimited)
+USAGE_COUNTERS = ['servers', 'vcpus', 'ram', 'disk', 'images', 'image_bytes']
+_QUOTAS = {
+    'servers': 'quota_instances',
+    'vcpus': 'quota_cores',
+    'ram': 'quota_ram',
+    'images': 'quota_images',
+    'image_bytes': 'quota_image_bytes',
+}
+
+# Supported list() filter operators
+FILTER_EQ = 'eq'
+FILTER_GE = 'ge'
+FILTER_PREFIX = 'prefix'
+# Rows with all or any of a list of tags
+FILTER_ALL = 'all'
+FILTER_ANY = 'any'
+
+# Number of prepared statements that sqlite keeps per connection
+_CACHED_STATEMENTS = 100
+
+_JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+_SYNCHRONOUS = ('off', 'normal', 'full', 'extra')
+
+# Output formats of dump() and the number of rows it fetches at a time
+DUMP_FORMATS = ('text', 'csv', 'json')
+_DUMP_CHUNK = 500
+
+# sqlite auto_vacuum value of incremental vacuum mode
+_AUTO_VACUUM_INCREMENTAL = 2
+
+
+def _encode(obj):
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    return obj
+
+
+def _fetch_rows(cur):
+    """
+    Iterate over the result rows of a statement, fetching them in chunks
+    """
+    while True:
+        rows = cur.fetchmany(_DUMP_CHUNK)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+def _check_file(db):
+    """
+    Run the sqlite integrity check on a database file and return the schema
+    version and the list of problems found
+    """
+    # Use a plain connection, the pool would change the journal mode
+    con = sq3.connect(db)
+    try:
+        version = con.execute('PRAGMA user_version').fetchone()[0]
+        errors = [r[0] for r in con.execute('PRAGMA integrity_check')]
+    except sq3.DatabaseError as e:
+        return (None, [str(e)])
+    finally:
+        con.close()
+
+    if errors == ['ok']:
+        errors = []
+    return (version, errors)
+
+
+def _write_rows(out, fmt, cols, rows):
+    """
+    Write rows to a file object as they arrive
+    """
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(cols)
+        for row in rows:
+            writer.writerow([_encode(r) for r in row])
+    elif fmt == 'json':
+        for row in rows:
+            out.write(json.dumps(dict(zip(cols, row)), sort_keys=True) + '\n')
+    else:
+        for row in rows:
+            out.write(' | '.join(str(_encode(r)) for r in row) + '\n')
+
+
+def _get_from_dict(keys, **kwargs):
+    """
+    Find key in dict and return (key, val) pair
+    """
+    for key in keys:
+        val = kwargs.get(key, None)
+        if val is not None:
+            return (key, val)
+
+
+def _pragmas():
+    """
+    Return the (validated) pragma statements for new connections
+    """
+    journal_mode = str(CONF.db_journal_mode).lower()
+    if journal_mode not in _JOURNAL_MODES:
+        raise exception.Failure(reason='Invalid db_journal_mode: %s' %
+                                CONF.db_journal_mode)
+
+    synchronous = str(CONF.db_synchronous).lower()
+    if synchronous not in _SYNCHRONOUS:
+        raise exception.Failure(reason='Invalid db_synchronous: %s' %
+                                CONF.db_synchronous)
+
+    # auto_vacuum only takes effect for new databases, existing databases
+    # are converted by migrate()
+    return ['PRAGMA auto_vacuum = incremental',
+            'PRAGMA journal_mode = %s' % journal_mode,
+            'PRAGMA synchronous = %s' % synchronous,
+            'PRAGMA cache_size = %d' % int(CONF.db_cache_size),
+            'PRAGMA mmap_size = %d' % int(CONF.db_mmap_size),
+            'PRAGMA busy_timeout = %d' % int(CONF.db_busy_timeout)]
+
+
+def _now():
+    # Microseconds so that changes-since queries don't miss changes within
+    # the same second
+    return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def _days_ago(days):
+    return strftime('%Y-%m-%d %H:%M:%S', gmtime(time() - days * 86400))
+
+
+def _to_bool(obj):
+    if isinstance(obj, (bool, int, long)):
+        return bool(obj)
+    return str(obj).lower() in ['1', 'yes', 'true', 'on']
+
+
+def _to_int(key, obj):
+    if obj is None or obj == '':
+        return None
+    try:
+        return int(obj)
+    except (TypeError, ValueError):
+        raise exception.BadRequest(reason='Invalid %s: %s' % (key, obj))
+
+
+class _RequestStats(object):
+    """
+    Database statistics of a single API request
+    """
+
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+        self.time = 0.0
+        self.calls = {}
+        self.depth = 0
+
+
+# Statistics of the request handled by the current thread and totals by route
+_REQUEST = threading.local()
+_ROUTES = {}
+_ROUTES_LOCK = threading.Lock()
+
+
+def begin_request():
+    """
+    Start collecting the database statistics of the current thread's request
+    """
+    _REQUEST.stats = _RequestStats()
+
+
+def end_request(route):
+    """
+    Stop collecting the database statistics of the current thread's request
+    and add them to the totals of its route. Returns the statistics of the
+    request. In debug mode, Table methods that were called repeatedly are
+    logged as possible N+1 query patterns.
+    """
+    stats = getattr(_REQUEST, 'stats', None)
+    _REQUEST.stats = None
+    if stats is None:
+        return None
+
+    with _ROUTES_LOCK:
+        total = _ROUTES.setdefault(route, {'requests': 0, 'statements': 0,
+                                           'rows': 0, 'time': 0.0})
+        total['requests'] += 1
+        total['statements'] += stats.statements
+        total['rows'] += stats.rows
+        total['time'] += stats.time
+
+    calls = dict(('%s.%s' % key, count)
+                 for (key, count) in stats.calls.iteritems())
+    if CONF.db_debug_queries:
+        for (call, count) in sorted(calls.iteritems()):
+            if count >= CONF.db_repeated_calls:
+                LOG.warn('%s : %s() called %d times, possible N+1 query '
+                         'pattern', route, call, count)
+
+    return {'statements': stats.statements, 'rows': stats.rows,
+            'time': stats.time, 'calls': calls}
+
+
+def route_stats():
+    """
+    Return the database statistics totals by route
+    """
+    with _ROUTES_LOCK:
+        return dict((route, dict(total))
+                    for (route, total) in _ROUTES.iteritems())
+
+
+def _instrumented(func):
+    """
+    Decorator that records the calls of a Table method, the rows it returns
+    and its elapsed time in the statistics of the current request. Nested
+    calls, i.e., the read-back of a written row, are counted as calls but
+    their rows and time are part of the outer call.
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        stats = getattr(_REQUEST, 'stats', None)
+        if stats is None:
+            return func(self, *args, **kwargs)
+
+        key = (self.table, func.__name__)
+        stats.calls[key] = stats.calls.get(key, 0) + 1
+        if stats.depth > 0:
+            return func(self, *args, **kwargs)
+
+        stats.depth += 1
+        start = time()
+        try:
+            result = func(self, *args, **kwargs)
+        finally:
+            stats.depth -= 1
+            stats.time += time() - start
+
+        if isinstance(result, list):
+            stats.rows += len(result)
+        elif isinstance(result, dict):
+            stats.rows += 1
+        return result
+    return wrapper
+
+
+class _Cursor(sq3.Cursor):
+    """
+    Cursor that counts the statements it executes, a batch (executemany())
+    counts as one statement
+    """
+    def _count(self):
+        _POOL.count('statements')
+        stats = getattr(_REQUEST, 'stats', None)
+        if stats is not None:
+            stats.statements += 1
+
+    def execute(self, *args):
+        self._count()
+        return super(_Cursor, self).execute(*args)
+
+    def executemany(self, *args):
+        self._count()
+        return super(_Cursor, self).executemany(*args)
+
+
+class _Connection(sq3.Connection):
+    """
+    Connection that hands out counting cursors
+    """
+    def cursor(self, factory=_Cursor):
+        return super(_Connection, self).cursor(factory)
+
+
+class _ThreadOwner(object):
+    """
+    Marker object in the thread-local state of a thread. It's freed when the
+    thread ends, which closes the connections of the thread.
+    """
+
+
+class _ConnectionPool(object):
+    """
+    Persistent database connections, one per thread and database file. The
+    connections are shared by all Table objects so that sqlite's prepared
+    statement cache actually gets used.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._generation = 0
+        # The connections of the threads, by a weak reference to the owner
+        # object of each thread
+        self._connections = {}
+        self._stats = {'connections': 0, 'statements': 0, 'transactions': 0}
+
+    def _thread_local(self):
+        """
+        Return the (valid) connection state of the current thread
+        """
+        local = self._local
+        if getattr(local, 'generation', None) != self._generation:
+            local.generation = self._generation
+            local.connections = {}
+            local.depth = {}
+            local.after_commit = {}
+            local.owner = _ThreadOwner()
+            with self._lock:
+                self._connections[weakref.ref(local.owner, self._release)] = \
+                    local.connections
+        return local
+
+    def _release(self, ref):
+        """
+        Close the connections of a thread that has ended
+        """
+        with self._lock:
+            connections = self._connections.pop(ref, {})
+        self._close(connections.values())
+
+    @staticmethod
+    def _close(connections):
+        """
+        Close connections, ignoring errors
+        """
+        for con in connections:
+            try:
+                con.close()
+            except sq3.Error:
+                pass
+
+    def count(self, key):
+        """
+        Increment a statistics counter
+        """
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self):
+        """
+        Return a copy of the statistics counters
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['open_connections'] = sum(len(c) for c in
+                                            self._connections.itervalues())
+            return stats
+
+    def connection(self, db):
+        """
+        Return the connection of the current thread, open it if necessary
+        """
+        local = self._thread_local()
+        con = local.connections.get(db)
+        if con is None:
+            LOG.debug('Opening database connection to %s', db)
+            # Transactions are handled explicitly, see transaction() below
+            con = sq3.connect(db, factory=_Connection, isolation_level=None,
+                              check_same_thread=False,
+                              cached_statements=_CACHED_STATEMENTS)
+            con.row_factory = sq3.Row
+            for pragma in _pragmas():
+                con.execute(pragma)
+            with self._lock:
+                local.connections[db] = con
+                self._stats['connections'] += 1
+        return con
+
+    def cursor(self, db):
+        """
+        Return a cursor for running statements outside of a transaction
+        """
+        return self.connection(db).cursor()
+
+    @contextmanager
+    def transaction(self, db):
+        """
+        Context manager that runs the enclosed statements in a single write
+        transaction. Nested transactions join the outermost one.
+        """
+        con = self.connection(db)
+        local = self._thread_local()
+        depth = local.depth.get(db, 0)
+
+        cur = con.cursor()
+        if depth == 0:
+            # Take the write lock right away so that concurrent writers
+            # serialize instead of failing on lock upgrades
+            cur.execute('BEGIN IMMEDIATE')
+            self.count('transactions')
+        local.depth[db] = depth + 1
+
+        success = False
+        try:
+            yield cur
+            success = True
+        finally:
+            local.depth[db] = depth
+            if depth == 0:
+                try:
+                    cur.execute('COMMIT' if success else 'ROLLBACK')
+                finally:
+                    for func in local.after_commit.pop(db, []):
+                        func()
+
+    def in_transaction(self, db):
+        """
+        Check if the current thread has an open transaction
+        """
+        return self._thread_local().depth.get(db, 0) > 0
+
+    def after_commit(self, db, func):
+        """
+        Call func when the current transaction ends (or right away if there
+        is none)
+        """
+        local = self._thread_local()
+        if local.depth.get(db, 0) == 0:
+            func()
+        else:
+            local.after_commit.setdefault(db, []).append(func)
+
+    def reset(self):
+        """
+        Close all connections, i.e., when the database file is (re)moved
+        """
+        with self._lock:
+            self._generation += 1
+            connections = [con for cons in self._connections.itervalues()
+                           for con in cons.values()]
+            self._connections = {}
+        self._close(connections)
+
+
+_POOL = _ConnectionPool()
+
+
+class _RowCache(object):
+    """
+    LRU cache of show() and list() results of rarely changing tables. The
+    entries of a table are invalidated when a write transaction to the table
+    ends. Entries read before the invalidation are not stored, this is
+    tracked with a per-table generation number.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._epoch = 0
+        self._generations = {}
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def get(self, name, key):
+        """
+        Return the cached value (or None) and the current generation of the
+        table
+        """
+        with self._lock:
+            generation = (self._epoch, self._generations.get(name, 0))
+            val = self._items.pop((name, key), None)
+            if val is None:
+                self._stats['misses'] += 1
+            else:
+                self._items[(name, key)] = val
+                self._stats['hits'] += 1
+            return (val, generation)
+
+    def put(self, name, key, val, generation):
+        """
+        Store a value unless the table has been invalidated since it was
+        read
+        """
+        size = int(CONF.db_row_cache_size)
+        with self._lock:
+            if (self._epoch, self._generations.get(name, 0)) != generation:
+                return
+            self._items[(name, key)] = val
+            while len(self._items) > size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, name):
+        """
+        Drop the cached values of a table
+        """
+        with self._lock:
+            self._generations[name] = self._generations.get(name, 0) + 1
+            self._stats['invalidations'] += 1
+            for key in [k for k in self._items if k[0] == name]:
+                del self._items[key]
+
+    def clear(self):
+        """
+        Drop all cached values
+        """
+        with self._lock:
+            self._epoch += 1
+            self._items.clear()
+
+    def stats(self):
+        """
+        Return a copy of the statistics counters
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._items)
+            return stats
+
+
+_CACHE = _RowCache()
+
+
+class _WriteQueue(object):
+    """
+    Queued row updates by database and table name. Multiple updates of the
+    same row are merged.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows = {}
+
+    def put(self, name, kwargs):
+        with self._lock:
+            rows = self._rows.setdefault(name, OrderedDict())
+            rows.setdefault(str(kwargs['id']), {}).update(kwargs)
+
+    def take(self, name):
+        """
+        Remove and return the queued updates of a table
+        """
+        with self._lock:
+            rows = self._rows.pop(name, None)
+        return [] if rows is None else rows.values()
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+
+    def size(self):
+        with self._lock:
+            return sum(len(rows) for rows in self._rows.itervalues())
+
+
+_QUEUE = _WriteQueue()
+
+
+def stats():
+    """
+    Return the database statistics counters
+    """
+    result = _POOL.stats()
+    for (key, val) in _CACHE.stats().iteritems():
+        result['cache_' + key] = val
+    result['queued_updates'] = _QUEUE.size()
+    return result
+
+
+class BaseTable(object):
+    """
+    Interface of the tables of a storage engine. The engines implement the
+    row operations, the validation and conversion of column values, the
+    usage counting and the journaling are common.
+    """
+
+    def __init__(self, db, table, cols, is_unique=None, is_bool=None,
+                 is_int=None, indexes=None, is_cached=False, journal=None,
+                 usage=None, counters=None, tags=None):
+        self.db = db
+        self.table = table
+        self.cols = cols
+        self.is_unique = is_unique
+        self.is_cached = is_cached
+        self.journal = journal
+
+        # Usage counters maintained by the table, the counted column or None
+        # to count the rows
+        self.usage = usage
+        if counters is None:
+            self.counters = {}
+        else:
+            self.counters = counters
+
+        # Tags of the rows, for the FILTER_ALL and FILTER_ANY filters
+        self.tags = tags
+        if is_bool is None:
+            self.is_bool = []
+        else:
+            self.is_bool = is_bool
+        if is_int is None:
+            self.is_int = []
+        else:
+            self.is_int = is_int
+        if indexes is None:
+            self.indexes = []
+        else:
+            self.indexes = indexes
+
+        # list() can only sort by indexed columns
+        self.sort_keys = [i[1] for i in self.indexes
+                          if len(i) == 2 and i[0] == 'deleted']
+
+    def _col_type(self, col):
+        if col in self.is_bool or col in self.is_int:
+            return 'INTEGER'
+        return 'TEXT'
+
+    def _to_db(self, col, val):
+        """
+        Convert a column value to its database representation
+        """
+        if col in self.is_bool:
+            return TRUE if _to_bool(val) else FALSE
+        if col in self.is_int:
+            return _to_int(col, val)
+        if isinstance(val, basestring):
+            # Don't encode unicode text as ASCII
+            return val
+        return str(val)
+
+    def _from_db(self, sq3_row):
+        """
+        Convert a database row (an sqlite row or a dict) to a dict. Integer
+        columns without a value are returned as empty strings, just like text
+        columns.
+        """
+        row = dict((k, sq3_row[k]) for k in sq3_row.keys())
+        for c in self.is_bool:
+            if c in row:
+                row[c] = bool(row[c])
+        for c in self.is_int:
+            if row.get(c, '') is None:
+                row[c] = ''
+        return row
+
+    def _journal(self, cur, operation, rows):
+        """
+        Append the changed columns of written rows (dicts of column values)
+        to the journal, within the write transaction of the change
+        """
+        if self.journal is None:
+            return
+        records = []
+        for kwargs in rows:
+            changes = dict((c, self._to_db(c, kwargs[c])) for c in self.cols
+                           if c in kwargs and c not in _DB_COLS)
+            records.append((self.table, str(kwargs['id']), operation,
+                            changes))
+        self.journal.append(cur, records)
+
+    def _usage(self, rows, sign):
+        """
+        Return the usage counter changes for adding (sign 1) or removing
+        (sign -1) rows (dicts of database values)
+        """
+        deltas = {}
+        for row in rows:
+            for (name, col) in self.counters.iteritems():
+                amount = 1 if col is None else (row.get(col) or 0)
+                deltas[name] = deltas.get(name, 0) + sign * amount
+        return deltas
+
+    def _count(self, cur, deltas):
+        """
+        Apply usage counter changes, within the write transaction of the
+        counted rows. Raises Forbidden if a quota is exceeded.
+        """
+        if self.usage is not None and any(deltas.values()):
+            self.usage.add(cur, deltas)
+
+    def init(self):
+        """
+        Initialize (create) the table
+        """
+        raise NotImplementedError()
+
+    def dump(self, deleted=True):
+        """
+        Iterate over all table rows, including the deleted rows unless
+        'deleted' is False
+        """
+        raise NotImplementedError()
+
+    def create(self, **kwargs):
+        """
+        Create a new table row
+        """
+        raise NotImplementedError()
+
+    def create_many(self, rows):
+        """
+        Create new table rows (dicts of create() arguments). Either all or none
+        of the rows are created.
+        """
+        raise NotImplementedError()
+
+    def update(self, expected_version=None, **kwargs):
+        """
+        Update a table row. If 'expected_version' is given, the row is only
+        updated if its version still matches.
+        """
+        raise NotImplementedError()
+
+    def update_many(self, rows, skip_missing=False):
+        """
+        Update table rows (dicts of update() arguments, including an optional
+        'expected_version'). Either all or none of the rows are updated, unless
+        'skip_missing' is set which skips rows that don't exist (anymore).
+        """
+        raise NotImplementedError()
+
+    def delete(self, expected_version=None, **kwargs):
+        """
+        Delete a table row by ID or name. If several rows have the same name,
+        the oldest one is deleted. If 'expected_version' is given, the row is
+        only deleted if its version still matches.
+        """
+        raise NotImplementedError()
+
+    def purge(self, before, limit=None):
+        """
+        Archive at most 'limit' rows that were deleted before 'before'. Returns
+        the number of purged rows.
+        """
+        raise NotImplementedError()
+
+    def list(self, limit=None, marker=None, marker_key='id', sort_key=None,
+             sort_dir='asc', filters=None, changes_since=None, cols=None,
+             joins=None):
+        """
+        Get table rows, converted to an array of dicts. Rows are paginated by
+        'limit' and 'marker', the value of the 'marker_key' column of the last
+        row of the previous page, and filtered by a list of (column, operator,
+        value) filters. If 'changes_since' is given, only the rows updated
+        since then are returned, including the deleted rows. 'cols' limits the
+        returned columns and 'joins' adds columns of other tables, a list of
+        (table, col, join_cols) tuples.
+        """
+        raise NotImplementedError()
+
+    def show(self, cols=None, joins=None, **kwargs):
+        """
+        Get a single table row by ID, name or IP, converted to a dict. 'cols'
+        and 'joins' are the same as for list().
+        """
+        raise NotImplementedError()
+
+    def _check_filters(self, filters):
+        """
+        Validate a list of (column, operator, value) filters and convert the
+        values to their database representation
+        """
+        result = []
+        for (col, op, val) in filters:
+            if op in (FILTER_ALL, FILTER_ANY):
+                if col != 'tags' or self.tags is None:
+                    raise exception.BadRequest(reason='Invalid filter: %s' %
+                                               col)
+                # A list of tags or a comma-separated string
+                if isinstance(val, basestring):
+                    val = val.split(',')
+                val = tuple(sorted(set(v for v in val if v)))
+                if not val:
+                    raise exception.BadRequest(reason='Invalid filter value '
+                                               'for %s' % col)
+                result.append((col, op, val))
+                continue
+
+            if col not in self.cols:
+                raise exception.BadRequest(reason='Invalid filter: %s' % col)
+
+            if op in (FILTER_EQ, FILTER_GE):
+                val = self._to_db(col, val)
+            elif op != FILTER_PREFIX or self._col_type(col) != 'TEXT':
+                raise exception.BadRequest(reason='Invalid filter operator '
+                                           '%s for %s' % (op, col))
+            result.append((col, op, val))
+        return result
+
+    def _sort_key(self, sort_key, sort_dir, changes_since):
+        """
+        Validate the sort key and direction of list() and return the sort key
+        """
+        if sort_key is None:
+            # Return changes in the order they happened
+            sort_key = 'rowid' if changes_since is None else 'updated_at'
+        elif sort_key not in self.sort_keys:
+            raise exception.BadRequest(reason='Invalid sort key: %s' %
+                                       sort_key)
+        if sort_dir not in ('asc', 'desc'):
+            raise exception.BadRequest(reason='Invalid sort direction: %s' %
+                                       sort_dir)
+        return sort_key
+
+    def _check_cols(self, cols):
+        for c in cols:
+            if c not in self.cols:
+                raise exception.BadRequest(reason='Invalid column: %s' % c)
+
+    def _from_joins(self, row, joins):
+        """
+        Convert the joined columns of a row. Columns of missing rows are
+        returned as empty strings.
+        """
+        for (table, _col, join_cols) in joins or []:
+            for c in join_cols:
+                key = '%s_%s' % (table.table.rstrip('s'), c)
+                if row[key] is None:
+                    row[key] = ''
+                elif c in table.is_bool:
+                    row[key] = bool(row[key])
+        return row
+
+    def queue_update(self, **kwargs):
+        """
+        Queue a row update that is written by the next flush(). Updates are
+        written right away if background flushing is disabled.
+        """
+        if CONF.db_flush_interval <= 0:
+            self.update(**kwargs)
+            return
+        LOG.debug('%s : queue_update(%s)', self.table, kwargs)
+        _QUEUE.put((self.db, self.table), kwargs)
+
+    def flush(self):
+        """
+        Write the queued updates in a single transaction. Updates of rows that
+        have been deleted in the meantime are dropped. Returns the number of
+        updated rows.
+        """
+        rows = _QUEUE.take((self.db, self.table))
+        if not rows:
+            return 0
+        return len(self.update_many(rows, skip_missing=True))
+
+
+class Table(BaseTable):
+    """
+    Table of the sqlite engine
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Table, self).__init__(*args, **kwargs)
+
+        # Purged rows are archived in the shadow table
+        self.shadow = 'shadow_' + self.table
+
+    def _cache_get(self, key):
+        """
+        Look up a cached show() or list() result. Results without a key are
+        never cached. Within a write transaction, the cache is bypassed
+        because it doesn't reflect the uncommitted changes.
+        """
+        if (not self.is_cached or key is None or
+                _POOL.in_transaction(self.db)):
+            return (None, None)
+        return _CACHE.get((self.db, self.table), key)
+
+    def _cache_put(self, key, val, generation):
+        """
+        Store a show() or list() result, unless it was read within a write
+        transaction and might still be rolled back
+        """
+        if (self.is_cached and key is not None and generation is not None and
+                not _POOL.in_transaction(self.db)):
+            _CACHE.put((self.db, self.table), key, val, generation)
+
+    def _invalidate(self):
+        """
+        Invalidate the cached results when the current write transaction ends
+        """
+        if self.is_cached:
+            _POOL.after_commit(self.db, partial(_CACHE.invalidate,
+                                                (self.db, self.table)))
+
+    def _exists(self, cur, table):
+        cur.execute('SELECT name FROM sqlite_master WHERE type=? AND name=?',
+                    ('table', table))
+        return cur.fetchone() is not None
+
+    def _schema(self):
+        """
+        Convert the cols array to an sqlite formatting string, i.e.,:
+        'id TEXT, int_id INTEGER, name TEXT, deleted INTEGER'
+        """
+        return ','.join(['%s %s' % (c, self._col_type(c)) for c in self.cols])
+
+    def _next_int_id(self, cur, count=1):
+        """
+        Allocate the next 'count' integer IDs from the table's sequence and
+        return the first one. Must be called from within a (write)
+        transaction.
+        """
+        cur.execute('UPDATE sequences SET value=value+? WHERE name=?',
+                    (count, self.table))
+        cur.execute('SELECT value FROM sequences WHERE name=?', (self.table, ))
+        return cur.fetchone()[0] - count + 1
+
+    def init(self):
+        """
+        Initialize (create) the table
+        """
+        LOG.info('%s : init()', self.table)
+
+        with _POOL.transaction(self.db) as cur:
+            cur.execute('CREATE TABLE %s (%s)' % (self.table, self._schema()))
+            self.init_sequence()
+            self.init_indexes()
+            self.init_shadow()
+
+    def init_sequence(self):
+        """
+        Create the (missing) integer ID sequence, starting after the largest
+        integer ID in use
+        """
+        LOG.info('%s : init_sequence()', self.table)
+
+        with _POOL.transaction(self.db) as cur:
+            cur.execute('CREATE TABLE IF NOT EXISTS sequences '
+                        '(name TEXT PRIMARY KEY, value INTEGER)')
+            cur.execute('INSERT OR IGNORE INTO sequences SELECT ?, '
+                        'coalesce(max(int_id), 0) FROM %s' % self.table,
+                        (self.table, ))
+
+    def init_shadow(self):
+        """
+        Create the (missing) shadow table for purged rows
+        """
+        LOG.info('%s : init_shadow()', self.table)
+
+        with _POOL.transaction(self.db) as cur:
+            cur.execute('CREATE TABLE IF NOT EXISTS %s (%s)' %
+                        (self.shadow, self._schema()))
+
+    def init_indexes(self):
+        """
+        Create the (missing) table indexes
+        """
+        LOG.info('%s : init_indexes()', self.table)
+
+        with _POOL.transaction(self.db) as cur:
+            for cols in self.indexes:
+                cur.execute('CREATE INDEX IF NOT EXISTS %s_%s_idx ON %s (%s)' %
+                            (self.table, '_'.join(cols), self.table,
+                             ','.join(cols)))
+
+    def rebuild(self):
+        """
+        Rebuild the table (and its shadow table) to match the current column
+        definitions and convert the existing rows
+        """
+        LOG.info('%s : rebuild()', self.table)
+
+        with _POOL.transaction(self.db) as cur:
+            self._rebuild(cur, self.table)
+            if self._exists(cur, self.shadow):
+                self._rebuild(cur, self.shadow)
+            self.init_indexes()
+
+    def _rebuild(self, cur, table):
+        """
+        Rebuild a single table
+        """
+        cur.execute('PRAGMA table_info(%s)' % table)
+        old_types = dict((r['name'], r['type']) for r in cur.fetchall())
+
+        # Create the SQL expressions that convert the old columns
+        exprs = []
+        for c in self.cols:
+            old_type = old_types.get(c)
+            if old_type is None:
+                # New column
+                if c in self.is_bool:
+                    exprs.append(str(FALSE))
+                elif c in self.is_int:
+                    exprs.append('NULL')
+                else:
+                    exprs.append("''")
+            elif old_type == self._col_type(c):
+                exprs.append(c)
+            elif c in self.is_bool:
+                exprs.append("CASE WHEN lower(%s) IN ('1', 'yes', 'true', "
+                             "'on') THEN %d ELSE %d END" % (c, TRUE,
+                                                            FALSE))
+            else:
+                exprs.append("CAST(NULLIF(trim(%s), '') AS INTEGER)" % c)
+
+        cur.execute('CREATE TABLE %s_new (%s)' % (table, self._schema()))
+        cur.execute('INSERT INTO %s_new (%s) SELECT %s FROM %s' %
+                    (table, ','.join(self.cols), ','.join(exprs), table))
+        cur.execute('DROP TABLE %s' % table)
+        cur.execute('ALTER TABLE %s_new RENAME TO %s' % (table, table))
+
+    @_instrumented
+    def dump(self, deleted=True):
+        """
+        Iterate over all table rows, including the deleted rows unless
+        'deleted' is False
+        """
+        LOG.info('%s : dump(deleted=%s)', self.table, deleted)
+
+        sql = 'SELECT %s FROM %s' % (','.join(self.cols), self.table)
+        args = ()
+        if not deleted:
+            sql += ' WHERE deleted=?'
+            args = (FALSE, )
+
+        cur = _POOL.cursor(self.db)
+        cur.execute(sql + ' ORDER BY rowid', args)
+        return _fetch_rows(cur)
+
+    def _insert(self, cur, rows):
+        """
+        Insert new table rows within a write transaction and return their
+        IDs
+        """
+        rows = [dict(kwargs) for kwargs in rows]
+
+        # Check if the rows already exist, in the table or in the batch
+        if self.is_unique:
+            key = self.is_unique
+            seen = set()
+            for kwargs in rows:
+                val = kwargs.get(key, None)
+                if val is None:
+                    continue
+                cur.execute('SELECT * FROM %s WHERE %s=? AND deleted=?' %
+                            (self.table, key), (val, FALSE))
+                if cur.fetchone() or self._to_db(key, val) in seen:
+                    raise exception.Conflict(reason='%s %s already exists' %
+                                             (self.table.rstrip('s'), val))
+                seen.add(self._to_db(key, val))
+
+        # Allocate the integer IDs of the whole batch at once
+        int_id = self._next_int_id(cur, count=len(rows))
+
+        now = _now()
+        vals = []
+        for kwargs in rows:
+            # Create a new (UU)ID if necessary
+            if 'id' not in kwargs:
+                kwargs['id'] = str(uuid.uuid4())
+
+            # Fill in the missing row properties
+            kwargs['int_id'] = int_id
+            kwargs['created_at'] = now
+            kwargs['updated_at'] = now
+            kwargs['deleted'] = FALSE
+            kwargs['version'] = 1
+            int_id += 1
+
+            # Create the array of table row values (in the right column order)
+            vals.append([self._to_db(c, kwargs.get(c, '')) for c in self.cols])
+
+        self._count(cur, self._usage([dict(zip(self.cols, v)) for v in vals],
+                                     1))
+
+        # Create the sqlite formatting string, i.e., '?,?,?,?'
+        fmt = ('?,' * len(self.cols)).rstrip(',')
+
+        # Insert the new rows
+        cur.executemany('INSERT into %s values (%s)' % (self.table, fmt), vals)
+        self._journal(cur, 'create', rows)
+        return [kwargs['id'] for kwargs in rows]
+
+    @_instrumented
+    def create(self, **kwargs):
+        """
+        Create a new table row
+        """
+        LOG.info('%s : create(%s)', self.table, kwargs)
+
+        with _POOL.transaction(self.db) as cur:
+            self._invalidate()
+            (row_id, ) = self._insert(cur, [kwargs])
+
+            # Read back the new row within the same transaction
+            return self.show(id=row_id)
+
+    @_instrumented
+    def create_many(self, rows):
+        """
+        Create new table rows (dicts of create() arguments) in a single
+        transaction. Either all or none of the rows are created.
+        """
+        LOG.info('%s : create_many(%s)', self.table, rows)
+
+        with _POOL.transaction(self.db) as cur:
+            self._invalidate()
+            row_ids = self._insert(cur, rows)
+
+            # Read back the new rows within the same transaction
+            return [self.show(id=row_id) for row_id in row_ids]
+
+    def _update(self, cur, expected_version, kwargs):
+        """
+        Update a table row within a write transaction. Returns False if the
+        row doesn't exist.
+        """
+        # Fill in the missing row properties, the version is incremented on
+        # every write
+        now = _now()
+        kwargs['updated_at'] = now
+        kwargs.pop('version', None)
+
+        # Read the old values of updated counted columns
+        counted = [col for col in self.counters.values() if col in kwargs]
+        old = None
+        if counted:
+            cur.execute('SELECT %s FROM %s WHERE id=? AND deleted=?' %
+                        (','.join(counted), self.table),
+                        (str(kwargs['id']), FALSE))
+            old = cur.fetchone()
+
+        # Create the sqlite formatting string and values
+        fmt = ''
+        vals = []
+        for c in self.cols:
+            if c in kwargs:
+                fmt = '%s,%s=?' % (fmt, c)
+                vals.append(self._to_db(c, kwargs[c]))
+        fmt = fmt.lstrip(',') + ',version=version+1'
+        vals.append(str(kwargs['id']))
+        vals.append(FALSE)
+
+        # Update the row
+        sql = 'UPDATE %s SET %s WHERE id=? AND deleted=?' % (self.table, fmt)
+        if expected_version is not None:
+            sql += ' AND version=?'
+            vals.append(_to_int('version', expected_version))
+        cur.execute(sql, vals)
+        if cur.rowcount > 0:
+            if old is not None:
+                new = dict((c, self._to_db(c, kwargs[c])) for c in counted)
+                self._count(cur, dict(
+                    (name, (new[col] or 0) - (old[col] or 0))
+                    for (name, col) in self.counters.iteritems()
+                    if col in new))
+            self._journal(cur, 'update', [kwargs])
+            return True
+
+        if expected_version is not None:
+            cur.execute('SELECT version FROM %s WHERE id=? AND deleted=?' %
+                        self.table, (str(kwargs['id']), FALSE))
+            row = cur.fetchone()
+            if row is not None:
+                raise exception.Conflict(reason='%s %s has version %s, not '
+                                         '%s' % (self.table.rstrip('s'),
+                                                 kwargs['id'], row[0],
+                                                 expected_version))
+        return False
+
+    @_instrumented
+    def update(self, expected_version=None, **kwargs):
+        """
+        Update a table row. If 'expected_version' is given, the row is only
+        updated if its version still matches.
+        """
+        LOG.info('%s : update(expected_version=%s, %s)', self.table,
+                 expected_version, kwargs)
+
+        with _POOL.transaction(self.db) as cur:
+            self._invalidate()
+            self._update(cur, expected_version, kwargs)
+
+            # Read back the updated row within the same transaction, raises
+            # NotFound if the row doesn't exist
+            return self.show(id=kwargs['id'])
+
+    @_instrumented
+    def update_many(self, rows, skip_missing=False):
+        """
+        Update table rows (dicts of update() arguments, including an optional
+        'expected_version') in a single transaction. Either all or none of the
+        rows are updated, unless 'skip_missing' is set which skips rows that
+        don't exist (anymore).
+        """
+        LOG.info('%s : update_many(%s, skip_missing=%s)', self.table, rows,
+                 skip_missing)
+
+        with _POOL.transaction(self.db) as cur:
+            self._invalidate()
+            result = []
+            for kwargs in rows:
+                kwargs = dict(kwargs)
+                expected_version = kwargs.pop('expected_version', None)
+                if (self._update(cur, expected_version, kwargs) or
+                        not skip_missing):
+                    # Raises NotFound if the row doesn't exist
+                    result.append(self.show(id=kwargs['id']))
+            return result
+
+    @_instrumented
+    def delete(self, expected_version=None, **kwargs):
+        """
+        Delete a table row. If 'expected_version' is given, the row is only
+        deleted if its version still matches.
+        """
+        LOG.info('%s : delete(expected_version=%s, %s)', self.table,
+                 expected_version, kwargs)
+        (key, val) = _get_from_dict(['id', 'name'], **kwargs)
+
+        with _POOL.transaction(self.db) as cur:
+            self._invalidate()
+
+            # The oldest row if names aren't unique
+            cur.execute('SELECT * FROM %s WHERE %s=? AND deleted=? ORDER BY '
+                        'rowid LIMIT 1' % (self.table, key), (val, FALSE))
+            sq3_row = cur.fetchone()
+
+            # Check if the row exists
+            if not sq3_row:
+                raise exception.NotFound(reason='%s %s not found' %
+                                         (self.table.rstrip('s'), val))
+
+            # Check if the row is protected
+            row = self._from_db(sq3_row)
+            if row.get('protected', False):
+                raise exception.Forbidden(reason='%s %s is protected' %
+                                          (self.table.rstrip('s'), val))
+
+            # Check if the row has been modified
+            if (expected_version is not None and
+                    row['version'] != _to_int('version', expected_version)):
+                raise exception.Conflict(reason='%s %s has version %s, not '
+                                         '%s' % (self.table.rstrip('s'), val,
+                                                 row['version'],
+                                                 expected_version))
+
+            # Delete the row, by ID since names aren't necessarily unique
+            now = _now()
+            cur.execute('UPDATE %s SET deleted_at=?, updated_at=?, deleted=?, '
+                        'version=version+1 WHERE id=? AND deleted=?' %
+                        self.table, (now, now, TRUE, row['id'], FALSE))
+            self._count(cur, self._usage([row], -1))
+            self._journal(cur, 'delete', [{'id': row['id']}])
+
+    @_instrumented
+    def purge(self, before, limit=None):
+        """
+        Move at most 'limit' rows that were deleted before 'before' to the
+        shadow table. Returns the number of purged rows.
+        """
+        LOG.info('%s : purge(before=%s, limit=%s)', self.table, before, limit)
+
+        rows = ('SELECT rowid FROM %s WHERE deleted=? AND deleted_at<? '
+                'ORDER BY rowid LIMIT ?' % self.table)
+        args = (TRUE, before, -1 if limit is None else limit)
+
+        with _POOL.transaction(self.db) as cur:
+            cur.execute('INSERT INTO %s (%s) SELECT %s FROM %s WHERE rowid IN '
+                        '(%s)' % (self.shadow, ','.join(self.cols),
+                                  ','.join(self.cols), self.table, rows),
+                        args)
+            cur.execute('DELETE FROM %s WHERE rowid IN (%s)' % (self.table,
+                                                                rows), args)
+            return cur.rowcount
+
+    def _filter_sql(self, filters):
+        """
+        Convert a list of (column, operator, value) filters to SQL conditions
+        and arguments
+        """
+        where = []
+        args = []
+        for (col, op, val) in self._check_filters(filters):
+            if op in (FILTER_ALL, FILTER_ANY):
+                (sql, sql_args) = self.tags.select_sql(val, op == FILTER_ALL)
+                where.append('%s.id IN (%s)' % (self.table, sql))
+                args.extend(sql_args)
+                continue
+
+            col = '%s.%s' % (self.table, col)
+            if op == FILTER_EQ:
+                where.append('%s = ?' % col)
+                args.append(val)
+            elif op == FILTER_GE:
+                where.append('%s >= ?' % col)
+                args.append(val)
+            elif val:
+                # Use a range rather than LIKE so that indexes can be used
+                where.append('%s >= ? AND %s < ?' % (col, col))
+                args.extend([val, val[:-1] + unichr(ord(val[-1]) + 1)])
+        return (where, args)
+
+    def _select(self, cols, joins):
+        """
+        Create the SELECT statement (without WHERE clause) and its arguments
+        for the given columns (all if None) and joins. 'joins' is a list of
+        (table, col, join_cols) tuples. Each joins the undeleted row of
+        'table' whose ID is in column 'col' and returns its 'join_cols'
+        columns, prefixed with the singular table name, i.e., 'flavor_name'.
+        """
+        if cols is None:
+            cols = self.cols
+        self._check_cols(cols)
+
+        select = ['%s.%s' % (self.table, c) for c in cols]
+        tables = [self.table]
+        args = []
+        for (n, (table, col, join_cols)) in enumerate(joins or []):
+            self._check_cols([col])
+            table._check_cols(join_cols)   # pylint: disable=W0212
+            alias = 'j%d' % n
+            select.extend(['%s.%s AS %s_%s' % (alias, c,
+                                               table.table.rstrip('s'), c)
+                           for c in join_cols])
+            tables.append('LEFT JOIN {0} AS {1} ON {1}.id={2}.{3} AND '
+                          '{1}.deleted=?'.format(table.table, alias,
+                                                 self.table, col))
+            args.append(FALSE)
+
+        return ('SELECT %s FROM %s' % (','.join(select), ' '.join(tables)),
+                args)
+
+    @_instrumented
+    def list(self, limit=None, marker=None, marker_key='id', sort_key=None,
+             sort_dir='asc', filters=None, changes_since=None, cols=None,
+             joins=None):
+        """
+        Get table rows, converted to an array of dicts. Rows are paginated
+        by 'limit' and 'marker', the value of the 'marker_key' column of the
+        last row of the previous page, and filtered by a list of (column,
+        operator, value) filters. If 'changes_since' is given, only the rows
+        updated since then are returned, including the deleted rows. 'cols'
+        limits the returned columns and 'joins' adds columns of other tables,
+        see _select().
+        """
+        LOG.info('%s : list(limit=%s, marker=%s, marker_key=%s, sort_key=%s, '
+                 'sort_dir=%s, filters=%s, changes_since=%s, cols=%s, '
+                 'joins=%s)', self.table, limit, marker, marker_key, sort_key,
+                 sort_dir, filters, changes_since, cols,
+                 [(j[0].table, j[1]) for j in joins or []])
+
+        # Rows of joined tables are not tracked by the cache
+        cache_key = None
+        if joins is None:
+            cache_key = ('list', limit, marker, marker_key, sort_key,
+                         sort_dir, tuple(filters or []), changes_since,
+                         None if cols is None else tuple(cols))
+        (rows, generation) = self._cache_get(cache_key)
+        if rows is not None:
+            return [dict(row) for row in rows]
+
+        sort_key = self._sort_key(sort_key, sort_dir, changes_since)
+        op = '>' if sort_dir == 'asc' else '<'
+
+        (sql, args) = self._select(cols, joins)
+        (where, where_args) = self._filter_sql(filters or [])
+        args.extend(where_args)
+        if changes_since is None:
+            where.insert(0, '%s.deleted=?' % self.table)
+            args.insert(len(args) - len(where_args), FALSE)
+        else:
+            where.insert(0, '%s.updated_at>=?' % self.table)
+            args.insert(len(args) - len(where_args), changes_since)
+        cur = _POOL.cursor(self.db)
+
+        # Continue after the marker row (keyset pagination), using the rowid
+        # to break ties
+        if marker is not None:
+            if changes_since is None:
+                cur.execute('SELECT %s, rowid FROM %s WHERE %s=? AND '
+                            'deleted=?' % (sort_key, self.table, marker_key),
+                            (marker, FALSE))
+            else:
+                # The marker row may have been deleted. The condition on
+                # 'deleted' lets sqlite use the (deleted, marker_key) index.
+                cur.execute('SELECT %s, rowid FROM %s WHERE %s=? AND deleted '
+                            'IN (?,?) ORDER BY rowid DESC LIMIT 1' %
+                            (sort_key, self.table, marker_key),
+                            (marker, FALSE, TRUE))
+            row = cur.fetchone()
+            if row is None:
+                raise exception.BadRequest(reason='Marker %s not found' %
+                                           marker)
+            if sort_key == 'rowid':
+                where.append('%s.rowid %s ?' % (self.table, op))
+                args.append(row[1])
+            else:
+                where.append('{0}.{1} {2}= ? AND ({0}.{1} {2} ? OR '
+                             '{0}.rowid {2} ?)'.format(self.table, sort_key,
+                                                       op))
+                args.extend([row[0], row[0], row[1]])
+
+        sql += ' WHERE %s ORDER BY %s.%s %s' % (' AND '.join(where),
+                                                self.table, sort_key,
+                                                sort_dir)
+        if sort_key != 'rowid':
+            sql += ', %s.rowid %s' % (self.table, sort_dir)
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args.append(limit)
+
+        cur.execute(sql, args)
+        sq3_rows = cur.fetchall()
+
+        # Convert to an array of dicts
+        rows = [self._from_joins(self._from_db(row), joins)
+                for row in sq3_rows]
+        self._cache_put(cache_key, rows, generation)
+
+        LOG.debug('%s : %s', self.table, rows)
+        return [dict(row) for row in rows]
+
+    @_instrumented
+    def show(self, cols=None, joins=None, **kwargs):
+        """
+        Get a single table row, converted to a dict. 'cols' limits the
+        returned columns and 'joins' adds columns of other tables, see
+        _select().
+        """
+        LOG.info('%s : show(%s)', self.table, kwargs)
+        (key, val) = _get_from_dict(['id', 'name', 'ip'], **kwargs)
+
+        # Rows of joined tables are not tracked by the cache
+        cache_key = None
+        if joins is None:
+            cache_key = ('show', key, val,
+                         None if cols is None else tuple(cols))
+        (row, generation) = self._cache_get(cache_key)
+        if row is not None:
+            return dict(row)
+
+        (sql, args) = self._select(cols, joins)
+        cur = _POOL.cursor(self.db)
+        cur.execute(sql + ' WHERE {0}.{1}=? AND {0}.deleted=?'.format(
+            self.table, key), args + [val, FALSE])
+        sq3_row = cur.fetchone()
+
+        if not sq3_row:
+            raise exception.NotFound(reason='%s %s not found' %
+                                     (self.table.rstrip('s'), val))
+
+        # Convert to a dict
+        row = self._from_joins(self._from_db(sq3_row), joins)
+        self._cache_put(cache_key, row, generation)
+
+        LOG.debug('%s : %s', self.table, row)
+        return dict(row)
+
+
+class BaseJournal(object):
+    """
+    Append-only log of the row changes of all tables. Records are appended
+    in the write transaction of the change and numbered by a monotonic
+    sequence number, so consumers can follow the changes incrementally.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.table = 'journal'
+        self.cols = JOURNAL_COLS
+
+    def _from_db(self, sq3_row):
+        row = dict((k, sq3_row[k]) for k in sq3_row.keys())
+        row['changes'] = json.loads(row['changes'])
+        return row
+
+    def init(self):
+        """
+        Initialize (create) the journal table
+        """
+        raise NotImplementedError()
+
+    def append(self, cur, records):
+        """
+        Append (resource, resource_id, operation, changes) records. Must be
+        called from within the (write) transaction of the change, 'cur' is its
+        cursor (None for engines without transactions).
+        """
+        raise NotImplementedError()
+
+    def dump(self, deleted=True):
+        """
+        Iterate over all journal records
+        """
+        raise NotImplementedError()
+
+    def list(self, since=0, limit=None, resource=None, resource_id=None):
+        """
+        Get the journal records with a sequence number greater than 'since',
+        optionally only those of a resource type or a single resource
+        """
+        raise NotImplementedError()
+
+    def purge(self, before, limit=None):
+        """
+        Delete at most 'limit' records that were created before 'before',
+        except the latest one so that the sequence numbers continue where
+        consumers left off. Returns the number of deleted records.
+        """
+        raise NotImplementedError()
+
+
+class Journal(BaseJournal):
+    """
+    Journal of the sqlite engine
+    """
+
+    def init(self):
+        """
+        Initialize (create) the journal table
+        """
+        LOG.info('%s : init()', self.table)
+
+        with _POOL.transaction(self.db) as cur:
+            # AUTOINCREMENT never reuses sequence numbers
+            cur.execute('CREATE TABLE %s (seq INTEGER PRIMARY KEY '
+                        'AUTOINCREMENT, created_at TEXT, resource TEXT, '
+                        'resource_id TEXT, operation TEXT, changes TEXT)' %
+                        self.table)
+        self.init_indexes()
+
+    def init_indexes(self):
+        """
+        Create the (missing) journal indexes
+        """
+        LOG.info('%s : init_indexes()', self.table)
+
+        with _POOL.transaction(self.db) as cur:
+            for cols in _JOURNAL_INDEXES:
+                cur.execute('CREATE INDEX IF NOT EXISTS %s_%s_idx ON %s (%s)' %
+                            (self.table, '_'.join(cols), self.table,
+                             ','.join(cols)))
+
+    def append(self, cur, records):
+        """
+        Append (resource, resource_id, operation, changes) records. Must be
+        called from within the (write) transaction of the change.
+        """
+        now = _now()
+        cur.executemany('INSERT INTO %s (created_at, resource, resource_id, '
+                        'operation, changes) VALUES (?,?,?,?,?)' % self.table,
+                        [(now, resource, resource_id, operation,
+                          json.dumps(changes, sort_keys=True))
+                         for (resource, resource_id, operation, changes)
+                         in records])
+
+    def dump(self, deleted=True):   # pylint: disable=W0613
+        """
+        Iterate over all journal records
+        """
+        LOG.info('%s : dump()', self.table)
+
+        cur = _POOL.cursor(self.db)
+        cur.execute('SELECT %s FROM %s ORDER BY seq' % (','.join(self.cols),
+                                                        self.table))
+        return _fetch_rows(cur)
+
+    def list(self, since=0, limit=None, resource=None, resource_id=None):
+        """
+        Get the journal records with a sequence number greater than 'since',
+        optionally only those of a resource type or a single resource
+        """
+        LOG.info('%s : list(since=%s, limit=%s, resource=%s, '
+                 'resource_id=%s)', self.table, since, limit, resource,
+                 resource_id)
+
+        where = ['seq>?']
+        args = [_to_int('since', since)]
+        for (col, val) in (('resource', resource),
+                           ('resource_id', resource_id)):
+            if val is not None:
+                where.append('%s=?' % col)
+                args.append(val)
+        sql = 'SELECT * FROM %s WHERE %s ORDER BY seq' % (self.table,
+                                                          ' AND '.join(where))
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args.append(limit)
+
+        cur = _POOL.cursor(self.db)
+        cur.execute(sql, args)
+        return [self._from_db(row) for row in cur.fetchall()]
+
+    def purge(self, before, limit=None):
+        """
+        Delete at most 'limit' records that were created before 'before',
+        see BaseJournal.purge()
+        """
+        LOG.info('%s : purge(before=%s, limit=%s)', self.table, before, limit)
+
+        with _POOL.transaction(self.db) as cur:
+            # Records are appended in time order, so the old ones come first
+            # and the scan stops at the first newer one
+            cur.execute('SELECT seq FROM %s WHERE created_at>=? ORDER BY seq '
+                        'LIMIT 1' % self.table, (before, ))
+            row = cur.fetchone()
+            if row is None:
+                cur.execute('SELECT MAX(seq) FROM %s' % self.table)
+                row = cur.fetchone()
+                if row[0] is None:
+                    return 0
+            cur.execute('DELETE FROM %s WHERE seq IN (SELECT seq FROM %s '
+                        'WHERE seq<? ORDER BY seq LIMIT ?)' %
+                        (self.table, self.table),
+                        (row[0], -1 if limit is None else limit))
+            return cur.rowcount
+
+
+class BaseUsage(object):
+    """
+    Resource usage counters. The tables update the counters in the write
+    transaction of the counted rows, so checking a quota is a single lookup
+    instead of a scan of the tables.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.table = 'usage'
+
+    def _check(self, usage, deltas):
+        """
+        Raise Forbidden if an increased counter exceeds its quota
+        """
+        for name in sorted(deltas):
+            limit = _limit(name)
+            if deltas[name] > 0 and limit >= 0 and usage[name] > limit:
+                raise exception.Forbidden(reason='Quota exceeded for %s: '
+                                          'requested %d, but already used %d '
+                                          'of %d' % (name, deltas[name],
+                                                     usage[name] -
+                                                     deltas[name], limit))
+
+    def init(self):
+        """
+        Initialize (create) the usage counters
+        """
+        raise NotImplementedError()
+
+    def add(self, cur, deltas):
+        """
+        Add to the usage counters. Must be called from within the (write)
+        transaction of the counted rows, which is rolled back if a quota is
+        exceeded.
+        """
+        raise NotImplementedError()
+
+    def get(self):
+        """
+        Get the usage counters
+        """
+        raise NotImplementedError()
+
+    def recount(self, tables):
+        """
+        Recompute the usage counters from the rows of the counting tables
+        """
+        raise NotImplementedError()
+
+    def limits(self):
+        """
+        Get the usage counters and their quotas
+        """
+        usage = self.get()
+        return dict((name, {'used': usage.get(name, 0),
+                            'limit': _limit(name)})
+                    for name in USAGE_COUNTERS)
+
+
+class Usage(BaseUsage):
+    """
+    Usage counters of the sqlite engine
+    """
+
+    def init(self):
+        """
+        Initialize (create) the usage table
+        """
+        LOG.info('%s : init()', self.table)
+
+        with _POOL.transaction(self.db) as cur:
+            cur.execute('CREATE TABLE IF NOT EXISTS %s (name TEXT PRIMARY '
+                        'KEY, value INTEGER)' % self.table)
+            cur.executemany('INSERT OR IGNORE INTO %s (name, value) VALUES '
+                            '(?,0)' % self.table,
+                            [(name, ) for name in USAGE_COUNTERS])
+
+    def add(self, cur, deltas):
+        """
+        Add to the usage counters. Must be called from within the (write)
+        transaction of the counted rows, which is rolled back if a quota is
+        exceeded.
+        """
+        cur.executemany('UPDATE %s SET value=value+? WHERE name=?' %
+                        self.table, [(delta, name) for (name, delta)
+                                     in deltas.iteritems() if delta])
+        checked = [name for name in deltas
+                   if deltas[name] > 0 and _limit(name) >= 0]
+        if checked:
+            cur.execute('SELECT name, value FROM %s WHERE name IN (%s)' %
+                        (self.table, ','.join('?' * len(checked))), checked)
+            self._check(dict((r['name'], r['value']) for r in cur.fetchall()),
+                        deltas)
+
+    def get(self):
+        """
+        Get the usage counters
+        """
+        cur = _POOL.cursor(self.db)
+        cur.execute('SELECT name, value FROM %s' % self.table)
+        return dict((r['name'], r['value']) for r in cur.fetchall())
+
+    def recount(self, tables):
+        """
+        Recompute the usage counters from the rows of the counting tables
+        """
+        LOG.info('%s : recount()', self.table)
+
+        usage = dict((name, 0) for name in USAGE_COUNTERS)
+        with _POOL.transaction(self.db) as cur:
+            for table in tables:
+                for (name, col) in table.counters.iteritems():
+                    expr = 'COUNT(*)' if col is None else \
+                        'COALESCE(SUM(%s), 0)' % col
+                    cur.execute('SELECT %s FROM %s WHERE deleted=?' %
+                                (expr, table.table), (FALSE, ))
+                    usage[name] = cur.fetchone()[0]
+            cur.executemany('UPDATE %s SET value=? WHERE name=?' % self.table,
+                            [(value, name) for (name, value)
+                             in usage.iteritems()])
+
+
+def _limit(name):
+    """
+    Return the quota of a usage counter, -1 if it is unlimited
+    """
+    if name not in _QUOTAS:
+        return -1
+    return int(getattr(CONF, _QUOTAS[name]))
+
+
+class BaseMetadata(object):
+    """
+    Key/value items of the rows of another table, like the metadata and tags
+    of servers (with empty values).
+    """
+
+    def __init__(self, db, table, name, journal=None):
+        self.db = db
+        self.table = table
+        self.name = name
+        self.cols = METADATA_COLS
+        self.journal = journal
+
+    def _journal(self, cur, row_id):
+        """
+        Record the items of a row after a change
+        """
+        if self.journal is not None:
+            self.journal.append(cur, [(self.table, row_id, 'update',
+                                       self._get(cur, row_id))])
+
+    def _get(self, cur, row_id):
+        """
+        Return the items of a row, ordered by key
+        """
+        raise NotImplementedError()
+
+    def init(self):
+        """
+        Initialize (create) the metadata table
+        """
+        raise NotImplementedError()
+
+    def dump(self, deleted=True):
+        """
+        Iterate over all items
+        """
+        raise NotImplementedError()
+
+    def get(self, row_id):
+        """
+        Get the items of a row, ordered by key
+        """
+        raise NotImplementedError()
+
+    def set(self, row_id, items, replace=False):
+        """
+        Add or update items of a row, replacing all existing items if 'replace'
+        is True. Returns the resulting items.
+        """
+        raise NotImplementedError()
+
+    def delete(self, row_id, key=None):
+        """
+        Delete an item of a row, or all its items if no key is given
+        """
+        raise NotImplementedError()
+
+    def purge(self, table):
+        """
+        Delete the items of the rows that were purged from a table. Returns the
+        number of deleted items.
+        """
+        raise NotImplementedError()
+
+
+class Metadata(BaseMetadata):
+    """
+    Metadata of the sqlite engine. The items are kept in their own table,
+    keyed by the row ID, so that rows can be filtered by them in SQL.
+    """
+
+    def _get(self, cur, row_id):
+        cur.execute('SELECT key, value FROM %s WHERE id=? ORDER BY key' %
+                    self.table, (row_id, ))
+        return OrderedDict((r['key'], r['value']) for r in cur.fetchall())
+
+    def init(self):
+        """
+        Initialize (create) the metadata table
+        """
+        LOG.info('%s : init()', self.table)
+
+        with _POOL.transaction(self.db) as cur:
+            cur.execute('CREATE TABLE IF NOT EXISTS %s (id TEXT, key TEXT, '
+                        'value TEXT, PRIMARY KEY (id, key))' % self.table)
+        self.init_indexes()
+
+    def init_indexes(self):
+        """
+        Create the (missing) metadata indexes
+        """
+        LOG.info('%s : init_indexes()', self.table)
+
+        with _POOL.transaction(self.db) as cur:
+            for cols in _METADATA_INDEXES:
+                cur.execute('CREATE INDEX IF NOT EXISTS %s_%s_idx ON %s (%s)' %
+                            (self.table, '_'.join(cols), self.table,
+                             ','.join(cols)))
+
+    def dump(self, deleted=True):   # pylint: disable=W0613
+        """
+        Iterate over all items
+        """
+        LOG.info('%s : dump()', self.table)
 
+        cur = _POOL.cursor(self.db)
+        cur.execute('SELECT %s FROM %s ORDER BY id, key' %
+                    (','.join(self.cols), self.table))
+        return _fetch_rows(cur)
 
-def _print_rows(objs):
-    result = []
-    for obj in objs:
-        result.append(' | '.join(str(o) for o in obj))
-    print('\n'.join(result) + '\n')
+    def get(self, row_id):
+        """
+        Get the items of a row, ordered by key
+        """
+        LOG.info('%s : get(row_id=%s)', self.table, row_id)
+        return self._get(_POOL.cursor(self.db), row_id)
+
+    def set(self, row_id, items, replace=False):
+        """
+        Add or update items of a row, replacing all existing items if
+        'replace' is True. Returns the resulting items.
+        """
+        LOG.info('%s : set(row_id=%s, items=%s, replace=%s)', self.table,
+                 row_id, items, replace)
+
+        with _POOL.transaction(self.db) as cur:
+            if replace:
+                cur.execute('DELETE FROM %s WHERE id=?' % self.table,
+                            (row_id, ))
+            cur.executemany('INSERT OR REPLACE INTO %s (id, key, value) '
+                            'VALUES (?,?,?)' % self.table,
+                            [(row_id, key, val)
+                             for (key, val) in items.iteritems()])
+            self._journal(cur, row_id)
+            return self._get(cur, row_id)
+
+    def delete(self, row_id, key=None):
+        """
+        Delete an item of a row, or all its items if no key is given
+        """
+        LOG.info('%s : delete(row_id=%s, key=%s)', self.table, row_id, key)
+
+        with _POOL.transaction(self.db) as cur:
+            if key is None:
+                cur.execute('DELETE FROM %s WHERE id=?' % self.table,
+                            (row_id, ))
+            else:
+                cur.execute('DELETE FROM %s WHERE id=? AND key=?' %
+                            self.table, (row_id, key))
+                if cur.rowcount == 0:
+                    raise exception.NotFound(reason='%s %s not found' %
+                                             (self.name, key))
+            self._journal(cur, row_id)
+
+    def purge(self, table):
+        """
+        Delete the items of the rows that were purged from a table. Returns
+        the number of deleted items.
+        """
+        LOG.info('%s : purge(table=%s)', self.table, table.table)
 
+        with _POOL.transaction(self.db) as cur:
+            cur.execute('DELETE FROM %s WHERE id NOT IN (SELECT id FROM %s)' %
+                        (self.table, table.table))
+            return cur.rowcount
 
-def _get_from_dict(keys, **kwargs):
+    def select_sql(self, keys, match_all):
+        """
+        Return the SQL subquery (and its arguments) that selects the IDs of
+        the rows with all (or any) of the given keys
+        """
+        sql = 'SELECT id FROM %s WHERE key IN (%s)' % \
+            (self.table, ','.join('?' * len(keys)))
+        args = list(keys)
+        if match_all:
+            sql += ' GROUP BY id HAVING COUNT(*)=?'
+            args.append(len(keys))
+        return (sql, args)
+
+# -----------------------------------------------------------------------------
+# Memory engine. Tables live in process memory only and are lost when dwarf
+# exits, which is useful for tests and throwaway instances.
+
+# Memory tables by database and table name
+_MEMORY = {}
+_MEMORY_LOCK = threading.RLock()
+
+
+class _MemoryStore(object):
     """
-    Find key in dict and return (key, val) pair
+    The rows of a memory table in insertion (rowid) order, with maps of
+    column values to rowids for the indexed columns
     """
-    for key in keys:
-        val = kwargs.get(key, None)
-        if val is not None:
-            return (key, val)
 
+    def __init__(self, index_cols):
+        self.rows = OrderedDict()
+        self.shadow = []
+        self.last_rowid = 0
+        self.sequence = 0
+        self.index = dict((c, {}) for c in index_cols)
+
+    def insert(self, row):
+        self.last_rowid += 1
+        self.rows[self.last_rowid] = row
+        for (col, index) in self.index.iteritems():
+            index.setdefault(row[col], set()).add(self.last_rowid)
+
+    def update(self, rowid, vals):
+        row = self.rows[rowid]
+        for (col, index) in self.index.iteritems():
+            if col in vals and vals[col] != row[col]:
+                self._unindex(index, row[col], rowid)
+                index.setdefault(vals[col], set()).add(rowid)
+        row.update(vals)
+
+    def remove(self, rowid):
+        row = self.rows.pop(rowid)
+        for (col, index) in self.index.iteritems():
+            self._unindex(index, row[col], rowid)
+        return row
 
-def _now():
-    return strftime('%Y-%m-%d %H:%M:%S', gmtime())
+    def _unindex(self, index, val, rowid):
+        index[val].discard(rowid)
+        if not index[val]:
+            del index[val]
 
+    def lookup(self, col, val):
+        """
+        Return the rowids of the rows with the given column value, in rowid
+        order
+        """
+        if col in self.index:
+            return sorted(self.index[col].get(val, ()))
+        return [rowid for (rowid, row) in self.rows.iteritems()
+                if row[col] == val]
 
-def _to_string_bool(obj):
-    if isinstance(obj, bool):
-        if obj:
-            return TRUE
-    elif obj.lower() in ['1', 'yes', 'true', 'on']:
-        return TRUE
-    return FALSE
 
+def _match(row, filters):
+    """
+    Check if a row matches a list of validated filters
+    """
+    for (col, op, val) in filters:
+        if op == FILTER_EQ:
+            if row[col] != val:
+                return False
+        elif op == FILTER_GE:
+            if row[col] is None or row[col] < val:
+                return False
+        elif val and not (row[col] or '').startswith(val):
+            return False
+    return True
+
+
+class MemoryTable(BaseTable):
+    """
+    A table of the memory engine with the same semantics as the sqlite
+    table. Rows are stored in their database representation and all
+    operations are serialized by a single lock.
+    """
 
-class Table(object):
+    def __init__(self, *args, **kwargs):
+        super(MemoryTable, self).__init__(*args, **kwargs)
 
-    def __init__(self, db, table, cols, is_unique=None, is_bool=None):
-        self.db = db
-        self.table = table
-        self.cols = cols
-        self.is_unique = is_unique
-        if is_bool is None:
-            self.is_bool = []
-        else:
-            self.is_bool = is_bool
+        # Memory lookups are as cheap as row cache lookups
+        self.is_cached = False
+
+        # Maintain value maps for the indexed columns, the deleted flag alone
+        # is not selective enough
+        self.index_cols = sorted(set(c for i in self.indexes for c in i
+                                     if c != 'deleted'))
+
+    def _store(self):
+        try:
+            return _MEMORY[self.db][self.table]
+        except KeyError:
+            raise exception.Failure(reason='Table %s does not exist' %
+                                    self.table)
+
+    def _key(self, col, val):
+        """
+        Convert a lookup value to its database representation
+        """
+        if isinstance(val, basestring) and self._col_type(col) == 'TEXT':
+            return val
+        return self._to_db(col, val)
+
+    def _find(self, store, key, val):
+        """
+        Return the rowid of the first undeleted row with the given column
+        value or None
+        """
+        for rowid in store.lookup(key, self._key(key, val)):
+            if store.rows[rowid]['deleted'] == FALSE:
+                return rowid
+        return None
 
     def init(self):
         """
@@ -93,267 +2117,1106 @@ class Table(object):
         """
         LOG.info('%s : init()', self.table)
 
-        # Convert the cols array to an sqlite formatting string, i.e.,:
-        # 'id TEXT, name TEXT, status TEXT, key TEXT'
-        fmt = ','.join(['%s TEXT' % c for c in self.cols])
-
-        con = sq3.connect(self.db)
-        with con:
-            cur = con.cursor()
-            cur.execute('CREATE TABLE %s (%s)' % (self.table, fmt))
+        with _MEMORY_LOCK:
+            if self.table in _MEMORY.setdefault(self.db, {}):
+                raise exception.Failure(reason='Table %s exists already' %
+                                        self.table)
+            _MEMORY[self.db][self.table] = _MemoryStore(self.index_cols)
 
-    def dump(self):
+    @_instrumented
+    def dump(self, deleted=True):
         """
-        Return all table rows
+        Iterate over all table rows, including the deleted rows unless
+        'deleted' is False
         """
-        LOG.info('%s : dump()', self.table)
-
-        con = sq3.connect(self.db)
-        with con:
-            cur = con.cursor()
-            cur.execute('SELECT * FROM %s' % self.table)
-            rows = cur.fetchall()
+        LOG.info('%s : dump(deleted=%s)', self.table, deleted)
 
-        return rows
+        with _MEMORY_LOCK:
+            rows = [tuple(row[c] for c in self.cols)
+                    for row in self._store().rows.itervalues()
+                    if deleted or row['deleted'] == FALSE]
+        return iter(rows)
 
-    def create(self, **kwargs):
+    def _insert(self, store, rows):
         """
-        Create a new table row
+        Insert new table rows and return their IDs. All rows are validated
+        before the store is modified.
         """
-        LOG.info('%s : create(%s)', self.table, kwargs)
-
-        con = sq3.connect(self.db)
-        with con:
-            cur = con.cursor()
-
-            # Check if the row already exists
+        now = _now()
+        new = []
+        created = []
+        seen = set()
+        for kwargs in rows:
+            kwargs = dict(kwargs)
+            created.append(kwargs)
+
+            # Check if the row already exists, in the table or in the batch
             if self.is_unique:
                 key = self.is_unique
                 val = kwargs.get(key, None)
                 if val is not None:
-                    cur.execute('SELECT * FROM %s WHERE %s=? AND deleted=?' %
-                                (self.table, key), (val, FALSE))
-                    if cur.fetchone():
+                    if (self._key(key, val) in seen or
+                            self._find(store, key, val) is not None):
                         raise exception.Conflict(reason='%s %s already '
                                                  'exists' %
                                                  (self.table.rstrip('s'), val))
+                    seen.add(self._key(key, val))
 
             # Create a new (UU)ID if necessary
             if 'id' not in kwargs:
                 kwargs['id'] = str(uuid.uuid4())
 
-            # Autoincrement the integer ID
-            rid = 1
-            cur.execute('SELECT max(cast(int_id as INT)) FROM %s' % self.table)
-            row = cur.fetchone()
-            if row[0] is not None:
-                rid = int(row[0]) + 1
-            kwargs['int_id'] = rid
-
             # Fill in the missing row properties
-            now = _now()
+            kwargs['int_id'] = store.sequence + len(new) + 1
             kwargs['created_at'] = now
             kwargs['updated_at'] = now
             kwargs['deleted'] = FALSE
+            kwargs['version'] = 1
+            new.append(dict((c, self._to_db(c, kwargs.get(c, '')))
+                            for c in self.cols))
+
+        self._count(None, self._usage(new, 1))
+        store.sequence += len(new)
+        for row in new:
+            store.insert(row)
+        self._journal(None, 'create', created)
+        return [row['id'] for row in new]
+
+    @_instrumented
+    def create(self, **kwargs):
+        """
+        Create a new table row
+        """
+        LOG.info('%s : create(%s)', self.table, kwargs)
 
-            # Create the array of table row values (in the right column order)
-            vals = []
-            for c in self.cols:
-                if c in self.is_bool:
-                    val = _to_string_bool(kwargs.get(c, FALSE))
-                else:
-                    val = kwargs.get(c, '')
-                vals.append(str(val))
-
-            # Create the sqlite formatting string, i.e., '?,?,?,?'
-            fmt = ('?,' * len(self.cols)).rstrip(',')
-
-            # Insert the new row
-            cur.execute('INSERT into %s values (%s)' % (self.table, fmt), vals)
-
-        return self.show(id=kwargs['id'])
+        with _MEMORY_LOCK:
+            (row_id, ) = self._insert(self._store(), [kwargs])
+            return self.show(id=row_id)
 
-    def update(self, **kwargs):
+    @_instrumented
+    def create_many(self, rows):
         """
-        Update a table row
+        Create new table rows. Either all or none of the rows are created.
         """
-        LOG.info('%s : update(%s)', self.table, kwargs)
+        LOG.info('%s : create_many(%s)', self.table, rows)
 
-        con = sq3.connect(self.db)
-        with con:
-            cur = con.cursor()
+        with _MEMORY_LOCK:
+            row_ids = self._insert(self._store(), rows)
+            return [self.show(id=row_id) for row_id in row_ids]
 
-            # Fill in the missing row properties
-            now = _now()
+    def _update(self, store, rows, skip_missing):
+        """
+        Update table rows and return their IDs. All rows are validated
+        before the store is modified.
+        """
+        now = _now()
+        updates = []
+        versions = {}
+        counted = {}
+        deltas = {}
+        for kwargs in rows:
+            kwargs = dict(kwargs)
+            expected_version = kwargs.pop('expected_version', None)
+
+            # Fill in the missing row properties, the version is incremented
+            # on every write
             kwargs['updated_at'] = now
+            kwargs.pop('version', None)
+            vals = dict((c, self._to_db(c, kwargs[c])) for c in self.cols
+                        if c in kwargs)
+
+            rowid = self._find(store, 'id', kwargs['id'])
+            if rowid is None:
+                if skip_missing:
+                    continue
+                # Raises NotFound
+                self.show(id=kwargs['id'])
+
+            # The same row may be updated more than once
+            version = versions.get(rowid, store.rows[rowid]['version'])
+            if (expected_version is not None and
+                    version != _to_int('version', expected_version)):
+                raise exception.Conflict(reason='%s %s has version %s, not '
+                                         '%s' % (self.table.rstrip('s'),
+                                                 kwargs['id'], version,
+                                                 expected_version))
+            vals['version'] = versions[rowid] = version + 1
+            updates.append((rowid, vals, kwargs))
+
+            # The same row may be updated more than once
+            for (name, col) in self.counters.iteritems():
+                if col in vals:
+                    old = counted.get((rowid, col), store.rows[rowid][col])
+                    counted[(rowid, col)] = vals[col]
+                    deltas[name] = (deltas.get(name, 0) + (vals[col] or 0) -
+                                    (old or 0))
+
+        self._count(None, deltas)
+        for (rowid, vals, _kwargs) in updates:
+            store.update(rowid, vals)
+        self._journal(None, 'update', [kwargs for (_rowid, _vals, kwargs)
+                                       in updates])
+        return [store.rows[rowid]['id'] for (rowid, _vals, _kwargs)
+                in updates]
+
+    @_instrumented
+    def update(self, expected_version=None, **kwargs):
+        """
+        Update a table row. If 'expected_version' is given, the row is only
+        updated if its version still matches.
+        """
+        LOG.info('%s : update(expected_version=%s, %s)', self.table,
+                 expected_version, kwargs)
 
-            # Create the sqlite formatting string and values
-            fmt = ''
-            vals = []
-            for c in self.cols:
-                if c in kwargs:
-                    fmt = '%s,%s=?' % (fmt, c)
-                    if c in self.is_bool:
-                        val = _to_string_bool(kwargs[c])
-                    else:
-                        val = kwargs[c]
-                    vals.append(str(val))
-            fmt = fmt.lstrip(',')
-            vals.append(str(kwargs['id']))
+        kwargs['expected_version'] = expected_version
+        with _MEMORY_LOCK:
+            (row_id, ) = self._update(self._store(), [kwargs], False)
+            return self.show(id=row_id)
 
-            # Update the row
-            cur.execute('UPDATE %s SET %s WHERE id=?' % (self.table, fmt),
-                        vals)
+    @_instrumented
+    def update_many(self, rows, skip_missing=False):
+        """
+        Update table rows. Either all or none of the rows are updated, unless
+        'skip_missing' is set which skips rows that don't exist (anymore).
+        """
+        LOG.info('%s : update_many(%s, skip_missing=%s)', self.table, rows,
+                 skip_missing)
 
-        return self.show(id=kwargs['id'])
+        with _MEMORY_LOCK:
+            row_ids = self._update(self._store(), rows, skip_missing)
+            return [self.show(id=row_id) for row_id in row_ids]
 
-    def delete(self, **kwargs):
+    @_instrumented
+    def delete(self, expected_version=None, **kwargs):
         """
-        Delete a table row
+        Delete a table row. If 'expected_version' is given, the row is only
+        deleted if its version still matches.
         """
-        LOG.info('%s : delete(%s)', self.table, kwargs)
+        LOG.info('%s : delete(expected_version=%s, %s)', self.table,
+                 expected_version, kwargs)
         (key, val) = _get_from_dict(['id', 'name'], **kwargs)
 
-        con = sq3.connect(self.db)
-        with con:
-            con.row_factory = sq3.Row
-            cur = con.cursor()
-            cur.execute('SELECT * FROM %s WHERE %s=? AND deleted=?' %
-                        (self.table, key), (val, FALSE))
-            sq3_row = cur.fetchone()
+        with _MEMORY_LOCK:
+            store = self._store()
 
             # Check if the row exists
-            if not sq3_row:
+            rowid = self._find(store, key, val)
+            if rowid is None:
                 raise exception.NotFound(reason='%s %s not found' %
                                          (self.table.rstrip('s'), val))
 
             # Check if the row is protected
-            protected = dict(zip(sq3_row.keys(), sq3_row)).get('protected',
-                                                               'false').lower()
-            if protected == 'true':
+            row = self._from_db(store.rows[rowid])
+            if row.get('protected', False):
                 raise exception.Forbidden(reason='%s %s is protected' %
                                           (self.table.rstrip('s'), val))
 
+            # Check if the row has been modified
+            if (expected_version is not None and
+                    row['version'] != _to_int('version', expected_version)):
+                raise exception.Conflict(reason='%s %s has version %s, not '
+                                         '%s' % (self.table.rstrip('s'), val,
+                                                 row['version'],
+                                                 expected_version))
+
             # Delete the row
             now = _now()
-            cur.execute('UPDATE %s SET deleted_at=?, updated_at=?, deleted=?'
-                        'WHERE %s=?' % (self.table, key),
-                        (now, now, TRUE, val))
-
-    def list(self):
+            self._count(None, self._usage([row], -1))
+            store.update(rowid, {'deleted_at': now, 'updated_at': now,
+                                 'deleted': TRUE,
+                                 'version': row['version'] + 1})
+            self._journal(None, 'delete', [{'id': row['id']}])
+
+    @_instrumented
+    def purge(self, before, limit=None):
         """
-        Get all table rows, converted to an array of dicts
+        Move at most 'limit' rows that were deleted before 'before' to the
+        shadow table. Returns the number of purged rows.
         """
-        LOG.info('%s : list()', self.table)
-
-        con = sq3.connect(self.db)
-        with con:
-            con.row_factory = sq3.Row
-            cur = con.cursor()
-            cur.execute('SELECT * FROM %s WHERE deleted=?' % self.table,
-                        (FALSE, ))
-            sq3_rows = cur.fetchall()
-
-        # Convert to an array of dicts
-        rows = []
-        for row in sq3_rows:
-            rows.append(dict(zip(row.keys(), row)))
+        LOG.info('%s : purge(before=%s, limit=%s)', self.table, before, limit)
+
+        with _MEMORY_LOCK:
+            store = self._store()
+            rowids = [rowid for (rowid, row) in store.rows.iteritems()
+                      if row['deleted'] == TRUE and row['deleted_at'] < before]
+            if limit is not None:
+                rowids = rowids[:limit]
+            for rowid in rowids:
+                store.shadow.append(store.remove(rowid))
+            return len(rowids)
+
+    def _project(self, row, cols, joins):
+        """
+        Convert a stored row to a dict of the given columns (all if None) and
+        the columns of the joined rows, see BaseTable.list()
+        """
+        if cols is None:
+            cols = self.cols
+        result = dict((c, row[c]) for c in cols)
+        for (table, col, join_cols) in joins or []:
+            # pylint: disable=W0212
+            store = table._store()
+            rowid = table._find(store, 'id', row[col])
+            for c in join_cols:
+                result['%s_%s' % (table.table.rstrip('s'), c)] = \
+                    None if rowid is None else store.rows[rowid][c]
+        return self._from_joins(self._from_db(result), joins)
+
+    def _check_select(self, cols, joins):
+        if cols is not None:
+            self._check_cols(cols)
+        for (table, col, join_cols) in joins or []:
+            self._check_cols([col])
+            table._check_cols(join_cols)   # pylint: disable=W0212
+
+    @_instrumented
+    def list(self, limit=None, marker=None, marker_key='id', sort_key=None,
+             sort_dir='asc', filters=None, changes_since=None, cols=None,
+             joins=None):
+        """
+        Get table rows, converted to an array of dicts. See BaseTable.list().
+        """
+        LOG.info('%s : list(limit=%s, marker=%s, marker_key=%s, sort_key=%s, '
+                 'sort_dir=%s, filters=%s, changes_since=%s, cols=%s, '
+                 'joins=%s)', self.table, limit, marker, marker_key, sort_key,
+                 sort_dir, filters, changes_since, cols,
+                 [(j[0].table, j[1]) for j in joins or []])
+
+        sort_key = self._sort_key(sort_key, sort_dir, changes_since)
+        filters = self._check_filters(filters or [])
+        self._check_select(cols, joins)
+
+        def _order(rowid, row):
+            if sort_key == 'rowid':
+                return (rowid, )
+            return (row[sort_key], rowid)
+
+        with _MEMORY_LOCK:
+            store = self._store()
+
+            # Look up the IDs of the rows with the filter tags
+            ids = None
+            for (col, op, val) in filters:
+                if op in (FILTER_ALL, FILTER_ANY):
+                    found = self.tags.find(val, op == FILTER_ALL)
+                    ids = found if ids is None else ids & found
+            filters = [f for f in filters if f[1] not in (FILTER_ALL,
+                                                          FILTER_ANY)]
+
+            # Use an index map for an equality filter if possible
+            rowids = None
+            for (col, op, val) in filters:
+                if op == FILTER_EQ and col in store.index:
+                    rowids = store.lookup(col, val)
+                    break
+            if rowids is None:
+                rowids = store.rows.keys()
+
+            # Continue after the marker row (keyset pagination), using the
+            # rowid to break ties
+            after = None
+            if marker is not None:
+                marker_rowids = store.lookup(marker_key,
+                                             self._key(marker_key, marker))
+                if changes_since is None:
+                    marker_rowids = [r for r in marker_rowids
+                                     if store.rows[r]['deleted'] == FALSE]
+                else:
+                    # The marker row may have been deleted
+                    marker_rowids = marker_rowids[-1:]
+                if not marker_rowids:
+                    raise exception.BadRequest(reason='Marker %s not found' %
+                                               marker)
+                after = _order(marker_rowids[0],
+                               store.rows[marker_rowids[0]])
+
+            result = []
+            for rowid in rowids:
+                row = store.rows[rowid]
+                if changes_since is None:
+                    if row['deleted'] != FALSE:
+                        continue
+                elif row['updated_at'] < changes_since:
+                    continue
+                if ids is not None and row['id'] not in ids:
+                    continue
+                if not _match(row, filters):
+                    continue
+                if after is not None:
+                    order = _order(rowid, row)
+                    if ((sort_dir == 'asc' and order <= after) or
+                            (sort_dir == 'desc' and order >= after)):
+                        continue
+                result.append((_order(rowid, row), row))
+
+            result.sort(key=lambda r: r[0], reverse=(sort_dir == 'desc'))
+            if limit is not None:
+                result = result[:limit]
+
+            # Convert to an array of dicts
+            rows = [self._project(row, cols, joins)
+                    for (_order_key, row) in result]
 
         LOG.debug('%s : %s', self.table, rows)
         return rows
 
-    def show(self, **kwargs):
+    @_instrumented
+    def show(self, cols=None, joins=None, **kwargs):
         """
-        Get a single table row, converted to a dict
+        Get a single table row, converted to a dict. See BaseTable.show().
         """
         LOG.info('%s : show(%s)', self.table, kwargs)
         (key, val) = _get_from_dict(['id', 'name', 'ip'], **kwargs)
+        self._check_select(cols, joins)
 
-        con = sq3.connect(self.db)
-        with con:
-            con.row_factory = sq3.Row
-            cur = con.cursor()
-            cur.execute('SELECT * FROM %s WHERE %s=? AND deleted=?' %
-                        (self.table, key), (val, FALSE))
-            sq3_row = cur.fetchone()
-
-        if not sq3_row:
-            raise exception.NotFound(reason='%s %s not found' %
-                                     (self.table.rstrip('s'), val))
+        with _MEMORY_LOCK:
+            store = self._store()
+            rowid = self._find(store, key, val)
+            if rowid is None:
+                raise exception.NotFound(reason='%s %s not found' %
+                                         (self.table.rstrip('s'), val))
 
-        # Convert to a dict
-        row = dict(zip(sq3_row.keys(), sq3_row))
+            # Convert to a dict
+            row = self._project(store.rows[rowid], cols, joins)
 
         LOG.debug('%s : %s', self.table, row)
         return row
 
 
+class MemoryJournal(BaseJournal):
+    """
+    Journal of the memory engine
+    """
+
+    def _store(self):
+        try:
+            return _MEMORY[self.db][self.table]
+        except KeyError:
+            raise exception.Failure(reason='Table %s does not exist' %
+                                    self.table)
+
+    def init(self):
+        """
+        Initialize (create) the journal table
+        """
+        LOG.info('%s : init()', self.table)
+
+        with _MEMORY_LOCK:
+            _MEMORY.setdefault(self.db, {})[self.table] = \
+                _MemoryStore(['resource', 'resource_id'])
+
+    def append(self, cur, records):
+        now = _now()
+        with _MEMORY_LOCK:
+            store = self._store()
+            for (resource, resource_id, operation, changes) in records:
+                store.insert({'seq': store.last_rowid + 1, 'created_at': now,
+                              'resource': resource,
+                              'resource_id': resource_id,
+                              'operation': operation,
+                              'changes': json.dumps(changes,
+                                                    sort_keys=True)})
+
+    def dump(self, deleted=True):
+        LOG.info('%s : dump()', self.table)
+
+        with _MEMORY_LOCK:
+            rows = [tuple(row[c] for c in self.cols)
+                    for row in self._store().rows.itervalues()]
+        return iter(rows)
+
+    def list(self, since=0, limit=None, resource=None, resource_id=None):
+        """
+        Get the journal records with a sequence number greater than 'since',
+        see BaseJournal.list()
+        """
+        LOG.info('%s : list(since=%s, limit=%s, resource=%s, '
+                 'resource_id=%s)', self.table, since, limit, resource,
+                 resource_id)
+
+        since = _to_int('since', since)
+        with _MEMORY_LOCK:
+            rows = []
+            for (seq, row) in self._store().rows.iteritems():
+                if (seq <= since or
+                        resource not in (None, row['resource']) or
+                        resource_id not in (None, row['resource_id'])):
+                    continue
+                rows.append(self._from_db(row))
+                if limit is not None and len(rows) >= limit:
+                    break
+        return rows
+
+    def purge(self, before, limit=None):
+        """
+        Delete at most 'limit' records that were created before 'before',
+        see BaseJournal.purge()
+        """
+        LOG.info('%s : purge(before=%s, limit=%s)', self.table, before, limit)
+
+        with _MEMORY_LOCK:
+            store = self._store()
+            seqs = []
+            for (seq, row) in store.rows.iteritems():
+                if row['created_at'] >= before:
+                    break
+                seqs.append(seq)
+            if seqs and seqs[-1] == next(reversed(store.rows)):
+                # Keep the latest record
+                seqs.pop()
+            if limit is not None:
+                seqs = seqs[:limit]
+            for seq in seqs:
+                store.remove(seq)
+            return len(seqs)
+
+
+class MemoryUsage(BaseUsage):
+    """
+    Usage counters of the memory engine
+    """
+
+    def _store(self):
+        try:
+            return _MEMORY[self.db][self.table]
+        except KeyError:
+            raise exception.Failure(reason='Table %s does not exist' %
+                                    self.table)
+
+    def init(self):
+        """
+        Initialize (create) the usage counters
+        """
+        LOG.info('%s : init()', self.table)
+
+        with _MEMORY_LOCK:
+            _MEMORY.setdefault(self.db, {})[self.table] = \
+                dict((name, 0) for name in USAGE_COUNTERS)
+
+    def add(self, cur, deltas):
+        with _MEMORY_LOCK:
+            usage = self._store()
+            new = dict((name, usage[name] + delta)
+                       for (name, delta) in deltas.iteritems())
+            self._check(new, deltas)
+            usage.update(new)
+
+    def get(self):
+        with _MEMORY_LOCK:
+            return dict(self._store())
+
+    def recount(self, tables):
+        LOG.info('%s : recount()', self.table)
+
+        usage = dict((name, 0) for name in USAGE_COUNTERS)
+        with _MEMORY_LOCK:
+            for table in tables:
+                # pylint: disable=W0212
+                rows = [row for row in table._store().rows.itervalues()
+                        if row['deleted'] == FALSE]
+                usage.update(table._usage(rows, 1))
+            self._store().update(usage)
+
+
+class MemoryMetadata(BaseMetadata):
+    """
+    Metadata of the memory engine, the items of each row are kept in a dict
+    """
+
+    def _store(self):
+        try:
+            return _MEMORY[self.db][self.table]
+        except KeyError:
+            raise exception.Failure(reason='Table %s does not exist' %
+                                    self.table)
+
+    def _get(self, cur, row_id):
+        items = self._store().get(row_id, {})
+        return OrderedDict((key, items[key]) for key in sorted(items))
+
+    def init(self):
+        """
+        Initialize (create) the metadata table
+        """
+        LOG.info('%s : init()', self.table)
+
+        with _MEMORY_LOCK:
+            _MEMORY.setdefault(self.db, {}).setdefault(self.table, {})
+
+    def dump(self, deleted=True):
+        LOG.info('%s : dump()', self.table)
+
+        with _MEMORY_LOCK:
+            store = self._store()
+            rows = [(row_id, key, store[row_id][key])
+                    for row_id in sorted(store)
+                    for key in sorted(store[row_id])]
+        return iter(rows)
+
+    def get(self, row_id):
+        LOG.info('%s : get(row_id=%s)', self.table, row_id)
+
+        with _MEMORY_LOCK:
+            return self._get(None, row_id)
+
+    def set(self, row_id, items, replace=False):
+        LOG.info('%s : set(row_id=%s, items=%s, replace=%s)', self.table,
+                 row_id, items, replace)
+
+        with _MEMORY_LOCK:
+            store = self._store()
+            if replace:
+                store.pop(row_id, None)
+            if items:
+                store.setdefault(row_id, {}).update(items)
+            self._journal(None, row_id)
+            return self._get(None, row_id)
+
+    def delete(self, row_id, key=None):
+        LOG.info('%s : delete(row_id=%s, key=%s)', self.table, row_id, key)
+
+        with _MEMORY_LOCK:
+            store = self._store()
+            if key is None:
+                store.pop(row_id, None)
+            else:
+                if key not in store.get(row_id, {}):
+                    raise exception.NotFound(reason='%s %s not found' %
+                                             (self.name, key))
+                del store[row_id][key]
+                if not store[row_id]:
+                    del store[row_id]
+            self._journal(None, row_id)
+
+    def purge(self, table):
+        LOG.info('%s : purge(table=%s)', self.table, table.table)
+
+        with _MEMORY_LOCK:
+            store = self._store()
+            ids = set(row['id'] for row in table._store().rows.itervalues())
+            purged = [row_id for row_id in store if row_id not in ids]
+            count = 0
+            for row_id in purged:
+                count += len(store.pop(row_id))
+            return count
+
+    def find(self, keys, match_all):
+        """
+        Return the set of IDs of the rows with all (or any) of the given keys
+        """
+        with _MEMORY_LOCK:
+            check = all if match_all else any
+            return set(row_id for (row_id, items)
+                       in self._store().iteritems()
+                       if check(key in items for key in keys))
+
+
+# Table, journal, usage and metadata classes of the storage engines
+_ENGINES = {
+    'sqlite': (Table, Journal, Usage, Metadata),
+    'memory': (MemoryTable, MemoryJournal, MemoryUsage, MemoryMetadata),
+}
+
+
 class Controller(object):
 
     def __init__(self):
-        self.servers = Table(CONF.dwarf_db, 'servers', DB_SERVERS_COLS,
+        self.engine = CONF.db_engine
+        if self.engine not in _ENGINES:
+            raise exception.Failure(reason='Invalid database engine: %s' %
+                                    self.engine)
+        (table, journal, usage, metadata) = _ENGINES[self.engine]
+        self.journal = journal(CONF.dwarf_db)
+        self.usage = usage(CONF.dwarf_db)
+        self.server_metadata = metadata(CONF.dwarf_db, 'server_metadata',
+                                        'metadata item', journal=self.journal)
+        self.server_tags = metadata(CONF.dwarf_db, 'server_tags', 'tag',
+                                    journal=self.journal)
+
+        self.servers = table(CONF.dwarf_db, 'servers', DB_SERVERS_COLS,
                              is_unique='name',
-                             is_bool=('config_drive', 'deleted'))
-        self.keypairs = Table(CONF.dwarf_db, 'keypairs', DB_KEYPAIRS_COLS,
+                             is_bool=('config_drive', 'deleted'),
+                             is_int=('int_id', 'version', 'vcpus', 'ram',
+                                     'disk'),
+                             indexes=_DB_INDEXES + [('deleted', 'ip')],
+                             journal=self.journal,
+                             usage=self.usage,
+                             counters={'servers': None, 'vcpus': 'vcpus',
+                                       'ram': 'ram', 'disk': 'disk'},
+                             tags=self.server_tags)
+        self.keypairs = table(CONF.dwarf_db, 'keypairs', DB_KEYPAIRS_COLS,
                               is_unique='name',
-                              is_bool=('deleted', ))
-        self.images = Table(CONF.dwarf_db, 'images', DB_IMAGES_COLS,
+                              is_bool=('deleted', ),
+                              is_int=('int_id', 'version'),
+                              indexes=_DB_INDEXES,
+                              is_cached=True,
+                              journal=self.journal)
+        self.images = table(CONF.dwarf_db, 'images', DB_IMAGES_COLS,
                             is_unique='id',
-                            is_bool=('deleted', 'protected'))
-        self.flavors = Table(CONF.dwarf_db, 'flavors', DB_FLAVORS_COLS,
+                            is_bool=('deleted', 'protected'),
+                            is_int=('int_id', 'version', 'size', 'min_disk',
+                                    'min_ram'),
+                            indexes=_DB_INDEXES,
+                            is_cached=True,
+                            journal=self.journal,
+                            usage=self.usage,
+                            counters={'images': None, 'image_bytes': 'size'})
+        self.flavors = table(CONF.dwarf_db, 'flavors', DB_FLAVORS_COLS,
                              is_unique='id',
-                             is_bool=('deleted', ))
+                             is_bool=('deleted', ),
+                             is_int=('int_id', 'version', 'disk', 'ram',
+                                     'vcpus'),
+                             indexes=_DB_INDEXES,
+                             is_cached=True,
+                             journal=self.journal)
+
+    def tables(self):
+        return (self.servers, self.keypairs, self.images, self.flavors)
+
+    def extra_tables(self):
+        """
+        Return the journal and metadata tables
+        """
+        return (self.journal, self.server_metadata, self.server_tags)
+
+    def _exists(self):
+        if self.engine == 'memory':
+            return CONF.dwarf_db in _MEMORY
+        return os.path.exists(CONF.dwarf_db)
+
+    def _supported(self, what):
+        """
+        Check if an operation on the database files is supported by the
+        storage engine
+        """
+        if self.engine == 'memory':
+            print('%s is not supported by the memory engine' % what)
+            return False
+        return True
+
+    def _version(self):
+        cur = _POOL.cursor(CONF.dwarf_db)
+        cur.execute('PRAGMA user_version')
+        return cur.fetchone()[0]
 
     def init(self):
         """
         Initialize the database
         """
-        if os.path.exists(CONF.dwarf_db):
+        if self._exists():
             print('Database exists already')
             return
 
         LOG.info('Initializing database %s', CONF.dwarf_db)
+
+        # Drop connections to, cached rows and queued updates of a previous
+        # (removed) database file
+        _POOL.reset()
+        _CACHE.clear()
+        _QUEUE.clear()
+
         self.servers.init()
         self.keypairs.init()
         self.images.init()
         self.flavors.init()
+        self.journal.init()
+        self.usage.init()
+        self.server_metadata.init()
+        self.server_tags.init()
+
+        if self.engine == 'sqlite':
+            with _POOL.transaction(CONF.dwarf_db) as cur:
+                cur.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
 
         # Hard-code the default flavors
-        self.flavors.create(id=100, name='standard.xsmall', ram='512',
-                            disk='10', vcpus='1')
-        self.flavors.create(id=101, name='standard.small', ram='768',
-                            disk='30', vcpus='1')
-        self.flavors.create(id=102, name='standard.medium', ram='1024',
-                            disk='30', vcpus='1')
+        self.flavors.create_many([
+            dict(id=100, name='standard.xsmall', ram=512, disk=10, vcpus=1),
+            dict(id=101, name='standard.small', ram=768, disk=30, vcpus=1),
+            dict(id=102, name='standard.medium', ram=1024, disk=30, vcpus=1),
+        ])
+
+    def check(self):
+        """
+        Check that the database schema is up to date. A memory database is
+        created if it doesn't exist yet.
+        """
+        if self.engine == 'memory':
+            if not self._exists():
+                self.init()
+            return
+
+        if not os.path.exists(CONF.dwarf_db):
+            LOG.warn('Database %s does not exist', CONF.dwarf_db)
+            return
+
+        version = self._version()
+        if version != SCHEMA_VERSION:
+            raise exception.Failure(reason='Database schema version is %d '
+                                    'but should be %d, run \'dwarf-manage '
+                                    'db-migrate\'' % (version, SCHEMA_VERSION))
+
+    def migrate(self):
+        """
+        Migrate the database to the current schema version
+        """
+        if not self._supported('Migration'):
+            return
+        if not os.path.exists(CONF.dwarf_db):
+            print('Database does not exist')
+            return
+
+        version = self._version()
+        if version > SCHEMA_VERSION:
+            print('Database schema version %d is newer than %d' %
+                  (version, SCHEMA_VERSION))
+            return
+
+        # The migrations rewrite the rows
+        _CACHE.clear()
+
+        for v in range(version + 1, SCHEMA_VERSION + 1):
+            LOG.info('Migrating database %s to schema version %d',
+                     CONF.dwarf_db, v)
+            with _POOL.transaction(CONF.dwarf_db) as cur:
+                _MIGRATIONS[v](self)
+                cur.execute('PRAGMA user_version = %d' % v)
+            print('Migrated database to schema version %d' % v)
+
+        for table in self.tables() + self.extra_tables():
+            table.init_indexes()
+
+        # Switch older databases to incremental vacuum, which requires a full
+        # vacuum (outside of a transaction)
+        cur = _POOL.cursor(CONF.dwarf_db)
+        cur.execute('PRAGMA auto_vacuum')
+        if cur.fetchone()[0] != _AUTO_VACUUM_INCREMENTAL:
+            LOG.info('Vacuuming database %s', CONF.dwarf_db)
+            cur.execute('PRAGMA auto_vacuum = incremental')
+            cur.execute('VACUUM')
+
+    def purge(self, days, limit=None):
+        """
+        Archive and delete at most 'limit' rows that were deleted more than
+        'days' days ago, delete the journal records older than that (but the
+        latest) and release the free database pages. Returns the number of
+        purged rows per table and the database file size before and after.
+        """
+        if not self._exists():
+            print('Database does not exist')
+            return
+
+        LOG.info('purge(days=%s, limit=%s)', days, limit)
+
+        before = _days_ago(int(days))
+
+        # Memory databases have no file
+        size = 0
+        if self.engine == 'sqlite':
+            size = os.path.getsize(CONF.dwarf_db)
+
+        rows = {}
+        for table in self.tables():
+            if limit is not None and limit <= 0:
+                break
+            rows[table.table] = table.purge(before, limit=limit)
+            if limit is not None:
+                limit -= rows[table.table]
+
+        # The metadata of purged servers is dropped, not archived
+        if rows.get('servers'):
+            for metadata in (self.server_metadata, self.server_tags):
+                metadata.purge(self.servers)
+
+        if limit is None or limit > 0:
+            rows[self.journal.table] = self.journal.purge(before, limit=limit)
+
+        result = {'rows': rows, 'size_before': size, 'size_after': 0}
+        if self.engine == 'sqlite':
+            # Release the free pages and truncate the write-ahead log so that
+            # the file shrinks
+            cur = _POOL.cursor(CONF.dwarf_db)
+            cur.execute('PRAGMA incremental_vacuum')
+            cur.fetchall()
+            cur.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            result['size_after'] = os.path.getsize(CONF.dwarf_db)
+
+        LOG.info('Purged %d rows from database %s, size %d -> %d bytes',
+                 sum(rows.values()), CONF.dwarf_db, result['size_before'],
+                 result['size_after'])
+        return result
+
+    def flush(self):
+        """
+        Write the queued row updates of all tables. Returns the number of
+        updated rows.
+        """
+        if not self._exists():
+            return 0
+        return sum(table.flush() for table in self.tables())
+
+    def index(self):
+        """
+        Create the missing indexes of an existing database
+        """
+        if not self._supported('Indexing'):
+            return
+        if not os.path.exists(CONF.dwarf_db):
+            print('Database does not exist')
+            return
+
+        LOG.info('Indexing database %s', CONF.dwarf_db)
+        for table in self.tables() + self.extra_tables():
+            table.init_indexes()
+
+    def backup(self, path=None):
+        """
+        Create a consistent backup of the (live) database and verify it.
+        Without a path, the backup is created in the backups directory and
+        only the newest db_backup_keep backups are kept. Returns the backup
+        file name.
+        """
+        if not self._supported('Backup'):
+            return
+        if not os.path.exists(CONF.dwarf_db):
+            print('Database does not exist')
+            return
+
+        rotate = path is None
+        if rotate:
+            if not os.path.exists(CONF.backups_dir):
+                os.makedirs(CONF.backups_dir)
+            path = os.path.join(CONF.backups_dir, 'dwarf-%s.db' %
+                                strftime('%Y%m%d%H%M%S', gmtime()))
+        if os.path.exists(path):
+            print('Backup %s exists already' % path)
+            return
+
+        LOG.info('Backing up database %s to %s', CONF.dwarf_db, path)
+
+        tmp = path + '.tmp'
+        con = _POOL.connection(CONF.dwarf_db)
+        if hasattr(con, 'backup'):
+            # Copy a limited number of pages at a time so that writers are
+            # never locked out for long
+            dst = sq3.connect(tmp)
+            try:
+                con.backup(dst, pages=int(CONF.db_backup_pages), sleep=0.01)
+            finally:
+                dst.close()
+        else:
+            # The Python 2 sqlite3 module lacks the backup API. VACUUM INTO
+            # copies a consistent snapshot in a read transaction, which
+            # doesn't block writers in WAL mode.
+            con.execute('VACUUM INTO ?', (tmp, ))
+
+        (_version, errors) = _check_file(tmp)
+        if errors:
+            os.remove(tmp)
+            raise exception.Failure(reason='Backup of database %s failed: %s'
+                                    % (CONF.dwarf_db, '; '.join(errors)))
+        os.rename(tmp, path)
+
+        if rotate:
+            backups = sorted(glob.glob(os.path.join(CONF.backups_dir,
+                                                    'dwarf-*.db')))
+            for old in backups[:-int(CONF.db_backup_keep)]:
+                LOG.info('Removing old backup %s', old)
+                os.remove(old)
+
+        return path
+
+    def verify(self, path=None):
+        """
+        Run the integrity check on the database (or a backup of it). Returns
+        True if no problems were found.
+        """
+        if not self._supported('Verification'):
+            return False
+        if path is None:
+            path = CONF.dwarf_db
+        if not os.path.exists(path):
+            print('Database %s does not exist' % path)
+            return False
+
+        (version, errors) = _check_file(path)
+        for error in errors:
+            print(error)
+        if errors:
+            return False
+
+        print('Database %s is ok (schema version %d)' % (path, version))
+        return True
+
+    def restore(self, path):
+        """
+        Replace the database with a verified backup and migrate it to the
+        current schema version. Dwarf must not be running.
+        """
+        if not self._supported('Restore'):
+            return
+        if not os.path.exists(path):
+            print('Backup %s does not exist' % path)
+            return
+
+        (version, errors) = _check_file(path)
+        if errors:
+            print('Backup %s is corrupt: %s' % (path, '; '.join(errors)))
+            return
+        if version > SCHEMA_VERSION:
+            print('Backup schema version %d is newer than %d' %
+                  (version, SCHEMA_VERSION))
+            return
+
+        LOG.info('Restoring database %s from %s', CONF.dwarf_db, path)
+        _POOL.reset()
+        _CACHE.clear()
+
+        # Copy the backup next to the database and move it into place, after
+        # removing the write-ahead log of the old database
+        tmp = CONF.dwarf_db + '.restore'
+        shutil.copyfile(path, tmp)
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(CONF.dwarf_db + suffix):
+                os.remove(CONF.dwarf_db + suffix)
+        os.rename(tmp, CONF.dwarf_db)
+        print('Restored database from %s' % path)
+
+        if version < SCHEMA_VERSION:
+            self.migrate()
 
     def delete(self):
         """
         Delete the database
         """
-        if not os.path.exists(CONF.dwarf_db):
+        if not self._exists():
             print('Database does not exist')
             return
 
+        if self.engine == 'memory':
+            LOG.info('Deleting memory database %s', CONF.dwarf_db)
+            _QUEUE.clear()
+            with _MEMORY_LOCK:
+                del _MEMORY[CONF.dwarf_db]
+            return
+
         LOG.info('Deleting database %s', CONF.dwarf_db)
+        _POOL.reset()
+        _CACHE.clear()
+        _QUEUE.clear()
         os.remove(CONF.dwarf_db)
 
-    def dump(self, table=None):
+        # Remove the write-ahead log and shared memory files
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(CONF.dwarf_db + suffix):
+                os.remove(CONF.dwarf_db + suffix)
+
+    def dump(self, table=None, fmt='text', deleted=True, out=None):
         """
-        Dump a database table
+        Dump a database table (or the database schema if no table is given)
+        in text, CSV or JSON lines format
         """
+        if fmt not in DUMP_FORMATS:
+            print('Format %s not supported' % fmt)
+            return
+        if out is None:
+            out = sys.stdout
+
         if table is None:
-            con = sq3.connect(CONF.dwarf_db)
-            with con:
-                cur = con.cursor()
-                cur.execute('SELECT * FROM sqlite_master')
-                rows = cur.fetchall()
+            if not self._supported('Schema dump'):
+                return
+            cur = _POOL.cursor(CONF.dwarf_db)
+            cur.execute('SELECT * FROM sqlite_master')
+            cols = [d[0] for d in cur.description]
+            rows = _fetch_rows(cur)
 
         else:
-            try:
-                obj = getattr(self, table)
-            except AttributeError:
+            tables = dict((t.table, t)
+                          for t in self.tables() + self.extra_tables())
+            if table not in tables:
                 print('Table %s not found' % table)
                 return
-            rows = obj.dump()
+            cols = tables[table].cols
+            rows = tables[table].dump(deleted=deleted)
+
+        _write_rows(out, fmt, cols, rows)
+
+
+# -----------------------------------------------------------------------------
+# Database schema migrations. Table rebuilds convert the rows to the current
+# column definitions so they're safe to run on any older schema.
+
+def _migrate_v1(ctrl):
+    """
+    Typed columns and integer ID sequences
+    """
+    for table in ctrl.tables():
+        table.rebuild()
+        table.init_sequence()
+
+
+def _migrate_v2(ctrl):
+    """
+    Shadow tables for purged rows
+    """
+    for table in ctrl.tables():
+        table.init_shadow()
+
 
-        _print_rows(rows)
+def _migrate_v3(ctrl):
+    """
+    Row versions
+    """
+    cur = _POOL.cursor(CONF.dwarf_db)
+    for table in ctrl.tables():
+        table.rebuild()
+        for name in (table.table, table.shadow):
+            cur.execute('UPDATE %s SET version=1 WHERE version IS NULL' % name)
+
+
+def _migrate_v4(ctrl):
+    """
+    Journal of row changes
+    """
+    ctrl.journal.init()
+
+
+def _migrate_v5(ctrl):
+    """
+    Server resources and usage counters
+    """
+    ctrl.servers.rebuild()
+    cur = _POOL.cursor(CONF.dwarf_db)
+    for name in (ctrl.servers.table, ctrl.servers.shadow):
+        for col in ('vcpus', 'ram', 'disk'):
+            cur.execute('UPDATE {t} SET {c}=(SELECT {c} FROM flavors WHERE '
+                        'flavors.id={t}.flavor_id ORDER BY deleted, rowid '
+                        'DESC LIMIT 1) WHERE {c} IS NULL'.format(t=name,
+                                                                 c=col))
+    ctrl.usage.init()
+    ctrl.usage.recount(ctrl.tables())
+
+
+def _migrate_v6(ctrl):
+    """
+    Server metadata and tags
+    """
+    ctrl.server_metadata.init()
+    ctrl.server_tags.init()
+
+
+def _migrate_v7(ctrl):
+    """
+    Server task states
+    """
+    ctrl.servers.rebuild()
+
+
+_MIGRATIONS = {
+    1: _migrate_v1,
+    2: _migrate_v2,
+    3: _migrate_v3,
+    4: _migrate_v4,
+    5: _migrate_v5,
+    6: _migrate_v6,
+    7: _migrate_v7,
+}
@@ -0,0 +1,748 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2017 Hewlett Packard Enterprise Development, L.P.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Event-driven HTTP/1.1 WSGI server. A single thread multiplexes all client
+# connections with epoll (or poll) and parses the requests. Complete requests
+# are handed to a worker pool, the executor for the blocking work of the
+# WSGI application (database, libvirt and subprocess calls). Idle keep-alive
+# connections only cost a socket and a small buffer, not a thread.
+#
+
+import collections
+import errno
+import fcntl
+import logging
+import os
+import select
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib
+
+from email.utils import formatdate
+
+LOG = logging.getLogger(__name__)
+
+# Default seconds after which an idle keep-alive connection is closed
+IDLE_TIMEOUT = 60
+
+# Maximum size of a request line and headers
+_MAX_HEAD_SIZE = 65536
+
+# Request bodies larger than this are spooled to a temporary file
+_MAX_BODY_MEMORY = 1024 * 1024
+
+_RECV_SIZE = 65536
+
+# Workers wait for the client once this much of a response is buffered
+_MAX_OUTPUT = 256 * 1024
+
+# Seconds to stop accepting connections when out of file descriptors
+_ACCEPT_BACKOFF = 1
+
+# Request parser states
+_HEAD = 'head'
+_BODY = 'body'
+_CHUNK_SIZE = 'chunk-size'
+_CHUNK_DATA = 'chunk-data'
+_CHUNK_END = 'chunk-end'
+_TRAILER = 'trailer'
+
+_EAGAIN = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+def _nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class _Poller(object):
+    """
+    epoll (Linux) or poll, which unlike select() scale to thousands of
+    connections
+    """
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._scale = 1
+            self.READ = select.EPOLLIN
+            self.WRITE = select.EPOLLOUT
+        else:
+            self._poller = select.poll()
+            self._scale = 1000
+            self.READ = select.POLLIN
+            self.WRITE = select.POLLOUT
+
+    def register(self, fd, events):
+        self._poller.register(fd, events)
+
+    def modify(self, fd, events):
+        self._poller.modify(fd, events)
+
+    def unregister(self, fd):
+        self._poller.unregister(fd)
+
+    def poll(self, timeout):
+        try:
+            return self._poller.poll(timeout * self._scale)
+        except (IOError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        if hasattr(self._poller, 'close'):
+            self._poller.close()
+
+
+class _Connection(object):
+    """
+    The state of a client connection
+    """
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.address = address
+
+        self.inbuf = ''
+        self.outbuf = ''
+        self.state = _HEAD
+        self.environ = None
+        self.remaining = 0
+
+        # A request is being handled by a worker
+        self.busy = False
+        # The client wants to keep the connection open after the request
+        self.keep_alive = True
+        # Close the connection once the output is sent
+        self.close = False
+
+        self.requests = 0
+        self.last_active = time.time()
+
+        # Set while the output buffer has room for more of the response
+        self.drained = threading.Event()
+        self.drained.set()
+
+
+class _Response(object):
+    """
+    The response of a WSGI application, passed to the event loop as it is
+    produced
+    """
+
+    def __init__(self, server, conn, environ):
+        self.server = server
+        self.conn = conn
+        self.environ = environ
+
+        self.status = None
+        self.headers = []
+        self.code = None
+        self.length = 0
+        self.head_sent = False
+
+        # The body is sent with the chunked transfer encoding
+        self.chunked = False
+        # The response has no body
+        self.no_body = False
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info is not None and self.head_sent:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.status = status
+        self.headers = headers
+        return self.write
+
+    def _head(self, length):
+        """
+        Build the status line and headers, the connection header is added by
+        the event loop
+        """
+        self.code = int(self.status.split(' ', 1)[0])
+        self.no_body = (self.environ['REQUEST_METHOD'] == 'HEAD' or
+                        self.code < 200 or self.code in (204, 304))
+
+        headers = []
+        names = set()
+        close = False
+        for (name, value) in self.headers:
+            lname = name.lower()
+            if lname == 'connection':
+                close = close or value.lower() == 'close'
+                continue
+            headers.append((name, value))
+            names.add(lname)
+        if self.code >= 200 and self.code not in (204, 304) and \
+                'content-length' not in names:
+            if length is not None:
+                headers.append(('Content-Length', str(length)))
+            elif self.environ['SERVER_PROTOCOL'] == 'HTTP/1.0':
+                # The end of the body is marked by closing the connection
+                close = True
+            else:
+                headers.append(('Transfer-Encoding', 'chunked'))
+                self.chunked = not self.no_body
+        if 'date' not in names:
+            headers.append(('Date', formatdate(usegmt=True)))
+        if 'server' not in names:
+            headers.append(('Server', 'dwarf'))
+
+        self.head_sent = True
+        head = ''.join(['HTTP/1.1 %s\r\n' % self.status] +
+                       ['%s: %s\r\n' % h for h in headers])
+        return (head, close)
+
+    def write(self, data, last=False):
+        """
+        Send a part of the body, the head goes with the first one
+        """
+        if self.status is None:
+            raise AssertionError('write() before start_response()')
+        if not data and not last:
+            return
+
+        (head, close) = (None, False)
+        if not self.head_sent:
+            (head, close) = self._head(len(data) if last else None)
+
+        self.length += len(data)
+        if self.no_body:
+            data = ''
+        elif self.chunked and data:
+            data = '%x\r\n%s\r\n' % (len(data), data)
+        if last and self.chunked:
+            data += '0\r\n\r\n'
+        # pylint: disable=W0212
+        self.server._emit(self.conn, head, data, close, last)
+
+    def finish(self):
+        """
+        Send the end of the body
+        """
+        self.write('', last=True)
+
+    def abort(self):
+        """
+        End a response that failed after its head was sent by closing the
+        connection
+        """
+        # pylint: disable=W0212
+        self.server._emit(self.conn, None, '', True, True)
+
+
+class EventWSGIServer(object):
+    """
+    HTTP/1.1 WSGI server with persistent connections. Requests are run by
+    the 'workers' pool (see api_server._WorkerPool) and are answered with
+    '503 Service Unavailable' if its queue is full.
+
+    Connections are closed after 'idle_timeout' seconds without a request
+    and after 'max_requests' requests (0 means no limit). With an
+    'idle_timeout' of 0 or less, connections are never closed for being idle
+    but are closed after their first response (no keep-alive).
+    """
+
+    def __init__(self, server_address, workers=None,
+                 idle_timeout=IDLE_TIMEOUT, max_requests=0):
+        self.app = None
+        self.workers = workers
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(socket.SOMAXCONN)
+        self.socket.setblocking(0)
+        self.server_address = self.socket.getsockname()
+
+        self._poller = _Poller()
+        self._poller.register(self.socket.fileno(), self._poller.READ)
+        self._connections = {}
+
+        # Responses of the workers, the pipe wakes up the event loop
+        self._done = collections.deque()
+        (self._wake_r, self._wake_w) = os.pipe()
+        _nonblocking(self._wake_r)
+        _nonblocking(self._wake_w)
+        self._poller.register(self._wake_r, self._poller.READ)
+
+        self._running = False
+        self._stopped = threading.Event()
+
+        # Accepting is paused until then after running out of file
+        # descriptors
+        self._accept_paused = None
+
+    def set_app(self, app):
+        self.app = app
+
+    def connections(self):
+        """
+        Return the number of open connections
+        """
+        return len(self._connections)
+
+    # -------------------------------------------------------------------------
+    # Event loop
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Handle requests until shutdown() is called
+        """
+        self._running = True
+        self._stopped.clear()
+        next_check = time.time() + 1
+        try:
+            while self._running:
+                for (fd, events) in self._poller.poll(poll_interval):
+                    if fd == self.socket.fileno():
+                        self._accept()
+                    elif fd == self._wake_r:
+                        self._drain()
+                    elif fd in self._connections:
+                        conn = self._connections[fd]
+                        if events & self._poller.WRITE:
+                            self._write(conn)
+                            self._next(conn)
+                        else:
+                            self._read(conn)
+                self._respond()
+
+                now = time.time()
+                if (self._accept_paused is not None and
+                        now >= self._accept_paused):
+                    LOG.info('Accepting new connections again')
+                    self._accept_paused = None
+                    self._poller.register(self.socket.fileno(),
+                                          self._poller.READ)
+
+                # Close the idle keep-alive connections
+                if self.idle_timeout > 0 and now >= next_check:
+                    next_check = now + 1
+                    for conn in self._connections.values():
+                        if (not conn.busy and not conn.outbuf and
+                                now - conn.last_active > self.idle_timeout):
+                            self._close(conn)
+        finally:
+            self._running = False
+            self._stopped.set()
+
+    def shutdown(self):
+        """
+        Stop serve_forever() and wait for it to return
+        """
+        self._running = False
+        self._wake()
+        self._stopped.wait()
+
+    def server_close(self):
+        """
+        Close the listening socket and all connections
+        """
+        for conn in self._connections.values():
+            self._close(conn)
+        self._poller.close()
+        self.socket.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError:
+            # The pipe is full (the loop wakes up anyway) or closed
+            pass
+
+    def _drain(self):
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except OSError:
+            pass
+
+    def _accept(self):
+        while True:
+            try:
+                (sock, address) = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in _EAGAIN + (errno.ECONNABORTED, ):
+                    return
+                if e.args[0] in (errno.EMFILE, errno.ENFILE):
+                    # The pending connection keeps the listening socket
+                    # readable, stop polling it for a while instead of
+                    # spinning
+                    LOG.warn('Too many open files, not accepting new '
+                             'connections for %s seconds', _ACCEPT_BACKOFF)
+                    self._poller.unregister(self.socket.fileno())
+                    self._accept_paused = time.time() + _ACCEPT_BACKOFF
+                    return
+                raise
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = _Connection(sock, address)
+            self._connections[conn.fd] = conn
+            self._poller.register(conn.fd, self._poller.READ)
+
+    def _close(self, conn):
+        if self._connections.pop(conn.fd, None) is None:
+            return
+        try:
+            self._poller.unregister(conn.fd)
+        except (IOError, ValueError):
+            pass
+        conn.sock.close()
+        conn.sock = None
+
+        # Don't keep a worker waiting for the client
+        conn.drained.set()
+
+    def _read(self, conn):
+        try:
+            data = conn.sock.recv(_RECV_SIZE)
+        except socket.error as e:
+            if e.args[0] in _EAGAIN:
+                return
+            data = ''
+        if not data:
+            # The client closed the connection, the response of a running
+            # request is dropped
+            self._close(conn)
+            return
+
+        conn.inbuf += data
+        conn.last_active = time.time()
+        self._parse(conn)
+
+    def _write(self, conn):
+        """
+        Send the buffered output and watch the connection for the next event
+        """
+        if conn.outbuf:
+            try:
+                sent = conn.sock.send(conn.outbuf)
+            except socket.error as e:
+                if e.args[0] not in _EAGAIN:
+                    self._close(conn)
+                    return
+                sent = 0
+            conn.outbuf = conn.outbuf[sent:]
+            conn.last_active = time.time()
+        if len(conn.outbuf) < _MAX_OUTPUT:
+            conn.drained.set()
+        if conn.outbuf:
+            self._poller.modify(conn.fd, self._poller.WRITE)
+        elif conn.close and not conn.busy:
+            self._close(conn)
+        elif conn.busy:
+            # Don't read pipelined requests until the response is sent
+            self._poller.modify(conn.fd, 0)
+        else:
+            self._poller.modify(conn.fd, self._poller.READ)
+
+    def _next(self, conn):
+        """
+        Parse the next (pipelined) request once a response has been sent
+        """
+        if (conn.sock is not None and not conn.busy and not conn.outbuf and
+                conn.inbuf):
+            self._parse(conn)
+
+    def _send(self, conn, data):
+        conn.outbuf += data
+        self._write(conn)
+
+    def _error(self, conn, status):
+        """
+        Answer a request that can't be handled and close the connection
+        """
+        LOG.warn('%s from %s', status, conn.address[0])
+        conn.close = True
+        conn.inbuf = ''
+        conn.state = _HEAD
+        self._send(conn, 'HTTP/1.1 %s\r\nContent-Length: 0\r\n'
+                         'Connection: close\r\n\r\n' % status)
+
+    # -------------------------------------------------------------------------
+    # Request parsing
+
+    def _parse(self, conn):
+        """
+        Parse the buffered request data and dispatch complete requests
+        """
+        while conn.sock is not None and not conn.busy:
+            if conn.state == _HEAD:
+                # Ignore empty lines between requests
+                conn.inbuf = conn.inbuf.lstrip('\r\n')
+                end = conn.inbuf.find('\r\n\r\n')
+                if end < 0:
+                    if len(conn.inbuf) > _MAX_HEAD_SIZE:
+                        self._error(conn, '431 Request Header Fields Too '
+                                    'Large')
+                    return
+                head = conn.inbuf[:end]
+                conn.inbuf = conn.inbuf[end + 4:]
+                try:
+                    self._start_request(conn, head)
+                except ValueError as e:
+                    LOG.warn('Bad request from %s: %s', conn.address[0], e)
+                    self._error(conn, '400 Bad Request')
+                    return
+
+            elif conn.state == _BODY:
+                data = conn.inbuf[:conn.remaining]
+                conn.inbuf = conn.inbuf[len(data):]
+                conn.environ['wsgi.input'].write(data)
+                conn.remaining -= len(data)
+                if conn.remaining > 0:
+                    return
+                self._dispatch(conn)
+
+            elif conn.state == _CHUNK_DATA:
+                data = conn.inbuf[:conn.remaining]
+                conn.inbuf = conn.inbuf[len(data):]
+                conn.environ['wsgi.input'].write(data)
+                conn.remaining -= len(data)
+                if conn.remaining > 0:
+                    return
+                conn.state = _CHUNK_END
+
+            else:
+                # Line-based states of the chunked encoding
+                end = conn.inbuf.find('\r\n')
+                if end < 0:
+                    if len(conn.inbuf) > _MAX_HEAD_SIZE:
+                        self._error(conn, '400 Bad Request')
+                    return
+                line = conn.inbuf[:end]
+                conn.inbuf = conn.inbuf[end + 2:]
+
+                if conn.state == _CHUNK_SIZE:
+                    try:
+                        size = int(line.split(';', 1)[0].strip(), 16)
+                    except ValueError:
+                        self._error(conn, '400 Bad Request')
+                        return
+                    if size == 0:
+                        conn.state = _TRAILER
+                    else:
+                        conn.state = _CHUNK_DATA
+                        conn.remaining = size
+                elif conn.state == _CHUNK_END:
+                    if line:
+                        self._error(conn, '400 Bad Request')
+                        return
+                    conn.state = _CHUNK_SIZE
+                elif not line:
+                    # End of the trailer
+                    self._dispatch(conn)
+
+    def _start_request(self, conn, head):
+        """
+        Parse the request line and headers and set up the WSGI environment
+        """
+        lines = head.split('\r\n')
+        parts = lines[0].split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/1.'):
+            raise ValueError('invalid request line %r' % lines[0])
+        (method, target, protocol) = parts
+
+        # Absolute URIs (of proxy requests)
+        if '://' in target:
+            target = '/' + target.split('://', 1)[1].partition('/')[2]
+        (path, _sep, query) = target.partition('?')
+
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.server_address[0],
+            'SERVER_PORT': str(self.server_address[1]),
+            'SERVER_PROTOCOL': protocol,
+            'REMOTE_ADDR': conn.address[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for line in lines[1:]:
+            (name, sep, value) = line.partition(':')
+            if not sep or not name or name != name.strip():
+                raise ValueError('invalid header %r' % line)
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            value = value.strip()
+            if key in environ:
+                environ[key] += ',' + value
+            else:
+                environ[key] = value
+
+        # HTTP/1.1 connections are persistent unless the client closes them,
+        # HTTP/1.0 connections only if the client asks for it
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        if protocol == 'HTTP/1.0':
+            conn.keep_alive = 'keep-alive' in connection
+        else:
+            conn.keep_alive = 'close' not in connection
+
+        conn.environ = environ
+        environ['wsgi.input'] = tempfile.SpooledTemporaryFile(
+            max_size=_MAX_BODY_MEMORY)
+
+        if environ.pop('HTTP_TRANSFER_ENCODING', '').lower() == 'chunked':
+            # The body is decoded, the application sees its length
+            environ.pop('CONTENT_LENGTH', None)
+            conn.state = _CHUNK_SIZE
+        else:
+            length = environ.get('CONTENT_LENGTH', '') or '0'
+            if not length.isdigit():
+                raise ValueError('invalid content length %r' % length)
+            conn.remaining = int(length)
+            conn.state = _BODY
+
+        if (conn.state != _BODY or conn.remaining) and \
+                environ.get('HTTP_EXPECT', '').lower() == '100-continue':
+            conn.outbuf += 'HTTP/1.1 100 Continue\r\n\r\n'
+            self._write(conn)
+
+        if conn.state == _BODY and not conn.remaining:
+            self._dispatch(conn)
+
+    def _dispatch(self, conn):
+        """
+        Hand a complete request to the workers
+        """
+        environ = conn.environ
+        body = environ['wsgi.input']
+        environ['CONTENT_LENGTH'] = str(body.tell())
+        body.seek(0)
+
+        conn.state = _HEAD
+        conn.environ = None
+        conn.busy = True
+        conn.requests += 1
+        self._write(conn)
+
+        if not self.workers.put(conn, environ):
+            body.close()
+            conn.busy = False
+            LOG.warn('Rejecting request from %s, all %d workers are busy',
+                     conn.address[0], self.workers.workers)
+            conn.close = True
+            self._send(conn, 'HTTP/1.1 503 Service Unavailable\r\n'
+                             'Retry-After: 1\r\nContent-Length: 0\r\n'
+                             'Connection: close\r\n\r\n')
+
+    # -------------------------------------------------------------------------
+    # Responses
+
+    def process_request(self, conn, environ):
+        """
+        Run the WSGI application for a request, in a worker thread, and
+        stream the response to the event loop
+        """
+        response = _Response(self, conn, environ)
+        try:
+            result = self.app(environ, response.start_response)
+            try:
+                if isinstance(result, (list, tuple)):
+                    # The whole body is known, send it with its length
+                    response.write(''.join(result), last=True)
+                else:
+                    for data in result:
+                        response.write(data)
+                        if conn.sock is None:
+                            # The client has gone away
+                            break
+                    response.finish()
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception:   # pylint: disable=W0703
+            LOG.exception('Failed to handle request %s %s from %s',
+                          environ['REQUEST_METHOD'], environ['PATH_INFO'],
+                          conn.address[0])
+            if response.head_sent:
+                # Too late for an error response, cut the response short
+                response.abort()
+            else:
+                response.start_response('500 Internal Server Error',
+                                        [('Content-Type', 'text/plain')])
+                response.write('Internal Server Error', last=True)
+        finally:
+            environ['wsgi.input'].close()
+
+        LOG.info('%s from %s:%s to http://%s:%s%s %s %s (request %d)',
+                 environ['REQUEST_METHOD'],
+                 conn.address[0],
+                 conn.address[1],
+                 self.server_address[0],
+                 self.server_address[1],
+                 environ['PATH_INFO'] + ('?' + environ['QUERY_STRING']
+                                         if environ['QUERY_STRING'] else ''),
+                 response.code,
+                 response.length,
+                 conn.requests)
+
+    def _emit(self, conn, head, data, close, last):
+        """
+        Queue a part of a response for the event loop and, unless it is the
+        last part, wait until the client has taken most of the output
+        """
+        conn.drained.clear()
+        self._done.append((conn, head, data, close, last))
+        self._wake()
+        if last:
+            return
+        while not conn.drained.wait(1):
+            if conn.sock is None or not self._running:
+                break
+
+    def _respond(self):
+        """
+        Send the responses of the workers
+        """
+        while self._done:
+            (conn, head, data, close, last) = self._done.popleft()
+            if conn.sock is None:
+                # The client has gone away
+                conn.drained.set()
+                continue
+            if head is not None:
+                conn.close = (not conn.keep_alive or close or
+                              not self._running or self.idle_timeout <= 0 or
+                              0 < self.max_requests <= conn.requests)
+                data = '%sConnection: %s\r\n\r\n%s' % \
+                    (head, 'close' if conn.close else 'keep-alive', data)
+            elif close:
+                # The response was cut short
+                conn.close = True
+            if last:
+                conn.busy = False
+            self._send(conn, data)
+            if last:
+                self._next(conn)
@@ -21,6 +21,7 @@ import json
 import logging
 
 from dwarf import config
+from dwarf import db
 from dwarf import exception
 from dwarf import utils
 
@@ -32,6 +33,14 @@ LOG = logging.getLogger(__name__)
 
 IMAGES = images.Controller()
 
+# Supported list query parameters and their database filters
+IMAGES_FILTERS = {
+    'name': ('name', db.FILTER_EQ),
+    'status': ('status', db.FILTER_EQ),
+    'disk_format': ('disk_format', db.FILTER_EQ),
+    'visibility': ('visibility', db.FILTER_EQ),
+}
+
 
 # -----------------------------------------------------------------------------
 # Bottle API routes
@@ -60,15 +69,26 @@ def _route_images():
     if bottle.request.method == 'POST':
         bottle.response.status = 201
         image_md = json.load(bottle.request.body)
-        return api_response.create_image(IMAGES.create(image_md))
+        image = utils.set_etag(bottle.response, IMAGES.create(image_md))
+        return api_response.create_image(image)
 
     # glance image-list
-    if (bottle.request.query.get('marker', None) is not None):
-        # When the client wants more, tell it we're done
-        return api_response.list_images([])
-    else:
-        # We don't 'do' marker, so return it all on the first call
-        return api_response.list_images(IMAGES.list())
+    params = utils.get_pagination(bottle.request)
+    params['filters'] = utils.get_filters(bottle.request, IMAGES_FILTERS)
+
+    # Changes (including deletions) since the given time, i.e.,
+    # updated_at=gte:2001-02-03T04:05:06Z
+    updated_at = bottle.request.query.get('updated_at', None)
+    if updated_at is not None:
+        if not updated_at.startswith('gte:'):
+            raise exception.BadRequest(reason='Unsupported updated_at '
+                                       'filter: %s' % updated_at)
+        params['changes_since'] = utils.parse_timestamp(updated_at[4:])
+
+    images = IMAGES.list(**params)
+    next_url = utils.get_next_url(bottle.request, images, params['limit'],
+                                  path='/v2/images')
+    return api_response.list_images(images, next_url=next_url)
 
 
 @exception.catchall
@@ -82,16 +102,20 @@ def _route_images_id(image_id):
     # glance image-delete
     if bottle.request.method == 'DELETE':
         bottle.response.status = 204
-        IMAGES.delete(image_id)
+        IMAGES.delete(image_id, version=utils.get_if_match(bottle.request))
         return
 
     # glance image-update
     if bottle.request.method == 'PATCH':
         image_ops = json.load(bottle.request.body)
-        return api_response.update_image(IMAGES.update(image_id, image_ops))
+        image = IMAGES.update(image_id, image_ops,
+                              version=utils.get_if_match(bottle.request))
+        return api_response.update_image(utils.set_etag(bottle.response,
+                                                        image))
 
     # glance image-show
-    return api_response.show_image(IMAGES.show(image_id))
+    image = utils.set_etag(bottle.response, IMAGES.show(image_id))
+    return api_response.show_image(image)
 
 
 @exception.catchall
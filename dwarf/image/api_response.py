@@ -69,8 +69,11 @@ def create_image(data):
     return utils.json_render(IMAGE, data)
 
 
-def list_images(data):
-    return {'images': [utils.json_render(IMAGE, d) for d in data]}
+def list_images(data, next_url=None):
+    resp = {'images': [utils.json_render(IMAGE, d) for d in data]}
+    if next_url is not None:
+        resp['next'] = next_url
+    return resp
 
 
 def show_image(data):
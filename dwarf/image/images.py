@@ -46,14 +46,14 @@ class Controller(object):
         image_md['status'] = 'queued'
         return self.db.images.create(**image_md)
 
-    def delete(self, image_id):
+    def delete(self, image_id, version=None):
         """
         Delete an image
         """
-        LOG.info('delete(image_id=%s)', image_id)
+        LOG.info('delete(image_id=%s, version=%s)', image_id, version)
 
         # Delete the image in the database
-        self.db.images.delete(id=image_id)
+        self.db.images.delete(id=image_id, expected_version=version)
 
         # Delete the image file
         image_file = os.path.join(CONF.images_dir, image_id)
@@ -64,12 +64,24 @@ class Controller(object):
             LOG.warn('failed to delete image %s (%s, %s)', image_file,
                      ex.errno, ex.strerror)
 
-    def list(self):
+    def list(self, limit=None, marker=None, sort_key=None, sort_dir='asc',
+             filters=None, changes_since=None):
         """
-        List all images
+        List images, including the deleted images if 'changes_since' is
+        given
         """
-        LOG.info('list()')
-        return self.db.images.list()
+        LOG.info('list(limit=%s, marker=%s, sort_key=%s, sort_dir=%s, '
+                 'filters=%s, changes_since=%s)', limit, marker, sort_key,
+                 sort_dir, filters, changes_since)
+
+        images = self.db.images.list(limit=limit, marker=marker,
+                                     sort_key=sort_key, sort_dir=sort_dir,
+                                     filters=filters,
+                                     changes_since=changes_since)
+        for image in images:
+            if image['deleted']:
+                image['status'] = 'deleted'
+        return images
 
     def show(self, image_id):
         """
@@ -78,11 +90,12 @@ class Controller(object):
         LOG.info('show(image_id=%s)', image_id)
         return self.db.images.show(id=image_id)
 
-    def update(self, image_id, image_ops):
+    def update(self, image_id, image_ops, version=None):
         """
         Update image metadata
         """
-        LOG.info('update(image_id=%s, image_ops=%s)', image_id, image_ops)
+        LOG.info('update(image_id=%s, image_ops=%s, version=%s)', image_id,
+                 image_ops, version)
 
         image_md = {}
         for op in image_ops:
@@ -93,7 +106,8 @@ class Controller(object):
             else:
                 raise exception.BadRequest(reason='Operation not supported')
 
-        return self.db.images.update(id=image_id, **image_md)
+        return self.db.images.update(id=image_id, expected_version=version,
+                                     **image_md)
 
     def upload(self, image_id, image_fh):
         """
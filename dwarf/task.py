@@ -16,14 +16,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import Queue
 import logging
 import time
 
-from threading import Thread
+from threading import Event, Lock, Thread
 
 LOG = logging.getLogger(__name__)
 
+# Running tasks, started and stopped by concurrent API requests
 _TASKS = {}
+_TASKS_LOCK = Lock()
 
 
 class _Task(Thread):
@@ -39,28 +42,84 @@ class _Task(Thread):
         self.args = args
         self.kwargs = kwargs
 
-        self._stop = False
+        # Set by stop(), also interrupts the sleep between runs
+        self._stopped = Event()
 
-        _TASKS[tid] = self
+        with _TASKS_LOCK:
+            _TASKS[tid] = self
         self.start()
 
     def run(self):
-        for dummy in range(self.repeat):
-            if self._stop:
+        count = 0
+        while self.repeat is None or count < self.repeat:
+            if self._stopped.is_set():
                 break
             retval = self.func(*self.args, **self.kwargs)
             if retval is not None:
                 break
-            time.sleep(self.interval)
-        _TASKS.pop(self.tid, None)
+            count += 1
+            self._stopped.wait(self.interval)
+        with _TASKS_LOCK:
+            # A new task with the same ID may have been started
+            if _TASKS.get(self.tid) is self:
+                del _TASKS[self.tid]
 
     def stop(self):
-        self._stop = True
+        self._stopped.set()
+
+
+class WorkQueue(object):
+    """
+    Queue of jobs that are run in the background by a number of worker
+    threads, which are started with the first job
+    """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = max(workers, 1)
+
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = Lock()
+
+    def _run(self):
+        while True:
+            (func, args, kwargs) = self._queue.get()
+            try:
+                func(*args, **kwargs)
+            except Exception:   # pylint: disable=W0703
+                LOG.exception('Job %s of queue %s failed', func.__name__,
+                              self.name)
+            finally:
+                self._queue.task_done()
+
+    def put(self, func, *args, **kwargs):
+        """
+        Queue a job that calls func
+        """
+        LOG.info('%s : put(func=%s, args=%s, kwargs=%s)', self.name,
+                 func.__name__, args, kwargs)
+
+        with self._lock:
+            while len(self._threads) < self.workers:
+                t = Thread(target=self._run,
+                           name='%s-%d' % (self.name, len(self._threads)))
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+        self._queue.put((func, args, kwargs))
+
+    def join(self):
+        """
+        Wait until all queued jobs are done
+        """
+        self._queue.join()
 
 
 def start(tid, interval, repeat, func, *args, **kwargs):
     """
-    Start a new task
+    Start a new task that calls func every interval seconds, at most repeat
+    times (forever if repeat is None)
     """
     LOG.info('start(tid=%s, interval=%s, repeat=%s, func=%s, args=%s, '
              'kwargs=%s)', tid, interval, repeat, func.__name__, args, kwargs)
@@ -74,7 +133,8 @@ def stop(tid):
     """
     LOG.info('stop(tid=%s)', tid)
 
-    t = _TASKS.get(tid, None)
+    with _TASKS_LOCK:
+        t = _TASKS.get(tid, None)
     if t is not None:
         t.stop()
 
@@ -85,7 +145,9 @@ def stop_all(wait=False):
     """
     LOG.info('stop_all()')
 
-    for tid in _TASKS:
+    with _TASKS_LOCK:
+        tids = _TASKS.keys()
+    for tid in tids:
         stop(tid)
 
     if wait:
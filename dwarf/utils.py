@@ -19,13 +19,19 @@
 import json
 import logging
 import os
+import re
 import signal
 import subprocess
+import urllib
+
+from datetime import datetime, timedelta
 
 from bottle import SimpleTemplate
 
+from dwarf import config
 from dwarf import exception
 
+CONF = config.Config()
 LOG = logging.getLogger(__name__)
 
 
@@ -36,6 +42,122 @@ def show_request(req):
     LOG.debug('---- END REQUEST HEADERS -----')
 
 
+def get_pagination(req):
+    """
+    Return the pagination parameters (limit, marker, sort key and sort
+    direction) of a list request. The limit is capped at api_max_limit.
+    """
+    limit = req.query.get('limit', None)
+    if limit is None:
+        limit = CONF.api_max_limit
+    else:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = -1
+        if limit < 0:
+            raise exception.BadRequest(reason='limit must be a positive '
+                                       'integer')
+        limit = min(limit, CONF.api_max_limit)
+
+    return {
+        'limit': limit,
+        'marker': req.query.get('marker', None),
+        'sort_key': req.query.get('sort_key', None),
+        'sort_dir': req.query.get('sort_dir', 'asc'),
+    }
+
+
+def get_filters(req, params):
+    """
+    Translate the query parameters of a list request into database filters.
+    params maps query parameter names to (column, operator[, converter])
+    tuples.
+    """
+    filters = []
+    for (key, spec) in params.iteritems():
+        val = req.query.get(key, None)
+        if val is None:
+            continue
+        try:
+            val = val.decode('utf-8')
+        except UnicodeDecodeError:
+            raise exception.BadRequest(reason='Invalid filter value for %s' %
+                                       key)
+        if len(spec) > 2:
+            val = spec[2](val)
+        filters.append((spec[0], spec[1], val))
+    return filters
+
+
+def parse_timestamp(val):
+    """
+    Convert an ISO 8601 timestamp to the (UTC) database timestamp format
+    """
+    m = re.match(r'^(\d{4}-\d{2}-\d{2})[T ](\d{2}:\d{2}:\d{2})(\.\d+)?'
+                 r'(Z|[+-]\d{2}:?\d{2})?$', val)
+    if m is None:
+        raise exception.BadRequest(reason='Invalid timestamp: %s' % val)
+
+    ts = datetime.strptime('%s %s' % m.group(1, 2), '%Y-%m-%d %H:%M:%S')
+    tz = m.group(4)
+    if tz is not None and tz != 'Z':
+        offset = timedelta(hours=int(tz[1:3]), minutes=int(tz[-2:]))
+        if tz[0] == '+':
+            ts -= offset
+        else:
+            ts += offset
+
+    result = ts.strftime('%Y-%m-%d %H:%M:%S')
+    if m.group(3) is not None:
+        # Match the microseconds of the database timestamps
+        result += m.group(3)[:7].ljust(7, '0')
+    return result
+
+
+def get_next_url(req, items, limit, key='id', path=None):
+    """
+    Return the URL of the next page of a list request or None if the current
+    page isn't full. The URL is absolute unless a path is provided.
+    """
+    if not items or len(items) < limit:
+        return None
+
+    query = [(k, v) for (k, v) in req.query.allitems() if k != 'marker']
+    query.append(('marker', items[-1][key]))
+    query.sort()
+    if path is None:
+        path = '%s://%s%s' % (req.urlparts.scheme, req.urlparts.netloc,
+                              req.path)
+    return '%s?%s' % (path, urllib.urlencode(query))
+
+
+def get_if_match(req):
+    """
+    Return the resource version of the If-Match request header or None if
+    the header is missing or matches any version
+    """
+    etag = req.headers.get('If-Match', '*').strip()
+    if etag == '*':
+        return None
+
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    try:
+        return int(etag.strip('"'))
+    except ValueError:
+        raise exception.BadRequest(reason='Invalid If-Match header: %s' %
+                                   etag)
+
+
+def set_etag(resp, obj):
+    """
+    Set the ETag response header to the resource version
+    """
+    resp.set_header('ETag', '"%s"' % obj['version'])
+    return obj
+
+
 def execute(cmd, check_exit_code=None, shell=False, run_as_root=False):
     """
     Helper function to execute a command
@@ -98,13 +220,11 @@ def json_render(template, *args, **kwargs):
         render_data.update(arg)
     render_data.update(kwargs)
 
-    # Encode strings and unicodes to take care of multi-line values. Otherwise
-    # the rendered result contains illegal JSON data.
+    # Escape strings and unicodes to take care of multi-line and non-ASCII
+    # values. Otherwise the rendered result contains illegal JSON data.
     for key, val in render_data.iteritems():
-        if isinstance(val, str):
-            render_data[key] = val.encode('string_escape')
-        if isinstance(val, unicode):
-            render_data[key] = val.encode('unicode_escape')
+        if isinstance(val, basestring):
+            render_data[key] = json.dumps(val)[1:-1]
 
     # Do the actual template rendering and convert to a dict
     tpl = SimpleTemplate(template, noescape=True)
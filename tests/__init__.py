@@ -27,10 +27,14 @@ CONF = config.Config()
 CONF.set_option('instances_dir', '/tmp/dwarf/instances')
 CONF.set_option('instances_base_dir', '/tmp/dwarf/instances/_base')
 CONF.set_option('images_dir', '/tmp/dwarf/images')
+CONF.set_option('backups_dir', '/tmp/dwarf/backups')
 CONF.set_option('dwarf_db', '/tmp/dwarf/dwarf.db')
 CONF.set_option('dwarf_log', '/tmp/dwarf/dwarf.log')
 CONF.set_option('bind_port', 20000)
 
+# The storage engine of the tests, set before the API controllers are created
+CONF.set_option('db_engine', os.environ.get('DWARF_TEST_DB_ENGINE', 'sqlite'))
+
 # Mock libvirt imports
 # This means that all libvirt calls will be handled by our libvirt_mock module
 sys.modules['libvirt'] = libvirt_mock
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2017 Hewlett Packard Enterprise Development, L.P.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import httplib
+import socket
+import threading
+import time
+import urllib2
+
+from tests import data
+from tests import utils
+
+from dwarf import api_server
+from dwarf import config
+from dwarf.api_server import ApiServer
+
+
+class DwarfTestCase(utils.TestCase):
+
+    def test_worker_pool(self):
+        release = threading.Event()
+        handled = []
+
+        def handler(item):
+            release.wait()
+            handled.append(item)
+
+        pool = api_server._WorkerPool(2, 1, handler)   # pylint: disable=W0212
+        pool.start()
+        try:
+            for item in (1, 2):
+                self.assertTrue(pool.put(item))
+                while pool.stats()['busy'] < item:
+                    time.sleep(0.01)
+
+            # Both workers are busy and the queue is bounded
+            self.assertTrue(pool.put(3))
+            self.assertFalse(pool.put(4))
+            stats = pool.stats()
+            self.assertEqual((stats['busy'], stats['queued'],
+                              stats['max_queued'], stats['rejected']),
+                             (2, 1, 1, 1))
+        finally:
+            release.set()
+            pool.stop()
+
+        self.assertEqual(sorted(handled), [1, 2, 3])
+        stats = pool.stats()
+        self.assertEqual((stats['busy'], stats['requests']), (0, 3))
+        self.assertTrue(0 < stats['utilization'] <= 1)
+
+    def test_threaded_server(self):
+        release = threading.Event()
+
+        def app(environ, start_response):
+            if environ['PATH_INFO'] == '/slow':
+                release.wait(10)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [environ['PATH_INFO']]
+
+        # pylint: disable=W0212
+        srv = api_server._ThreadPoolWSGIServer(('127.0.0.1', 0),
+                                               api_server._HTTPRequestHandler)
+        srv.workers = api_server._WorkerPool(2, 1,
+                                             srv.process_request_thread)
+        srv.workers.start()
+        srv.set_app(app)
+        url = 'http://127.0.0.1:%d' % srv.server_address[1]
+        thread = threading.Thread(target=srv.serve_forever)
+        thread.start()
+        try:
+            slow = threading.Thread(target=urllib2.urlopen,
+                                    args=(url + '/slow', ))
+            slow.start()
+            while srv.workers.stats()['busy'] < 1:
+                time.sleep(0.01)
+
+            # A slow request doesn't block the others
+            self.assertEqual(urllib2.urlopen(url + '/fast',
+                                             timeout=5).read(), '/fast')
+        finally:
+            release.set()
+            srv.shutdown()
+            thread.join()
+            srv.workers.stop()
+            srv.server_close()
+        slow.join()
+        self.assertEqual(srv.workers.stats()['requests'], 2)
+
+    def test_threaded_keep_alive(self):
+        conf = config.Config()
+        max_requests = conf.api_keepalive_requests
+        conf.set_option('api_keepalive_requests', 3)
+
+        def app(environ, start_response):
+            body = environ['wsgi.input'].read(1)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            if environ['PATH_INFO'] == '/stream':
+                # No Content-Length
+                return (c for c in ['stream', ':', body])
+            return [environ['PATH_INFO'], ':', body]
+
+        # pylint: disable=W0212
+        srv = api_server._ThreadPoolWSGIServer(('127.0.0.1', 0),
+                                               api_server._HTTPRequestHandler)
+        srv.workers = api_server._WorkerPool(2, 1,
+                                             srv.process_request_thread)
+        srv.workers.start()
+        srv.set_app(app)
+        thread = threading.Thread(target=srv.serve_forever)
+        thread.start()
+        try:
+            conn = httplib.HTTPConnection('127.0.0.1', srv.server_address[1],
+                                          timeout=5)
+            # The unread part of the body is skipped
+            conn.request('PUT', '/put', 'abc')
+            resp = conn.getresponse()
+            self.assertEqual(resp.getheader('Connection'), 'keep-alive')
+            self.assertEqual(resp.read(), '/put:a')
+            sock = conn.sock
+
+            conn.request('GET', '/stream')
+            resp = conn.getresponse()
+            self.assertEqual(resp.getheader('Transfer-Encoding'), 'chunked')
+            self.assertEqual(resp.read(), 'stream:')
+            self.assertTrue(conn.sock is sock)
+
+            # The connection is closed after the maximum number of requests
+            conn.request('GET', '/last')
+            resp = conn.getresponse()
+            self.assertEqual(resp.getheader('Connection'), 'close')
+            self.assertEqual(resp.read(), '/last:')
+
+            # An idle connection doesn't keep the server from shutting down
+            conn.close()
+            conn.request('GET', '/idle')
+            self.assertEqual(conn.getresponse().read(), '/idle:')
+        finally:
+            srv.shutdown()
+            thread.join()
+            srv.workers.stop()
+            srv.server_close()
+            conf.set_option('api_keepalive_requests', max_requests)
+        self.assertEqual(srv.workers.stats()['requests'], 2)
+
+    def test_threaded_keep_alive_busy(self):
+        def app(dummy_environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['ok']
+
+        # pylint: disable=W0212
+        srv = api_server._ThreadPoolWSGIServer(('127.0.0.1', 0),
+                                               api_server._HTTPRequestHandler)
+        srv.workers = api_server._WorkerPool(2, 1,
+                                             srv.process_request_thread)
+        srv.workers.start()
+        srv.set_app(app)
+        thread = threading.Thread(target=srv.serve_forever)
+        thread.start()
+        try:
+            port = srv.server_address[1]
+
+            # The first idle connection holds a worker
+            idle = httplib.HTTPConnection('127.0.0.1', port, timeout=5)
+            idle.request('GET', '/')
+            resp = idle.getresponse()
+            self.assertEqual(resp.getheader('Connection'), 'keep-alive')
+            resp.read()
+
+            # The last free worker doesn't keep its connection open
+            for dummy in range(3):
+                start = time.time()
+                conn = httplib.HTTPConnection('127.0.0.1', port, timeout=5)
+                conn.request('GET', '/')
+                resp = conn.getresponse()
+                self.assertEqual(resp.getheader('Connection'), 'close')
+                self.assertEqual(resp.read(), 'ok')
+                conn.close()
+                self.assertTrue(time.time() - start < 1)
+            idle.close()
+        finally:
+            srv.shutdown()
+            thread.join()
+            srv.workers.stop()
+            srv.server_close()
+
+    def test_chunked_upload(self):
+        image1 = data.image['11111111-2222-3333-4444-555555555555']
+        self.create_image(image1)
+        body = 'x' * 5000
+
+        # pylint: disable=W0212
+        for pool in (True, False):
+            open('/tmp/dwarf/images/%s' % image1['id'], 'w').close()
+            if pool:
+                srv = api_server._ThreadPoolWSGIServer(
+                    ('127.0.0.1', 0), api_server._HTTPRequestHandler)
+                srv.workers = api_server._WorkerPool(
+                    1, 1, srv.process_request_thread)
+                srv.workers.start()
+            else:
+                srv = api_server._WSGIServer(('127.0.0.1', 0),
+                                             api_server._HTTPRequestHandler)
+            srv.set_app(ApiServer().app)
+            thread = threading.Thread(target=srv.serve_forever)
+            thread.start()
+            try:
+                sock = socket.create_connection(srv.server_address, timeout=5)
+                sock.sendall('PUT /image/v2/images/%s/file HTTP/1.1\r\n'
+                             'Host: localhost\r\n'
+                             'Transfer-Encoding: chunked\r\n\r\n'
+                             '%x\r\n%s\r\n0\r\n\r\n' %
+                             (image1['id'], len(body), body))
+                resp = ''
+                while True:
+                    buf = sock.recv(4096)
+                    if not buf:
+                        break
+                    resp += buf
+                sock.close()
+            finally:
+                srv.shutdown()
+                thread.join()
+                if pool:
+                    srv.workers.stop()
+                srv.server_close()
+
+            # The body is uploaded and the connection is closed
+            self.assertTrue(resp.startswith('HTTP/1.1 204 '))
+            self.assertTrue('Connection: close\r\n' in resp)
+            with open('/tmp/dwarf/images/%s' % image1['id']) as fh:
+                self.assertEqual(fh.read(), body)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2017 Hewlett Packard Enterprise Development, L.P.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import zlib
+
+from webob import Request
+
+from tests import utils
+
+from dwarf import compress
+from dwarf.api_server import ApiServer
+
+
+def _stream_app(environ, start_response):
+    """
+    Return a response of unknown length, or a short one for /short
+    """
+    if environ['PATH_INFO'] == '/short':
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', '2')])
+        return ['{}']
+    if environ['PATH_INFO'] == '/binary':
+        start_response('200 OK', [('Content-Type',
+                                   'application/octet-stream')])
+        return ['x' * 4096]
+
+    start_response('200 OK', [('Content-Type', 'text/plain; charset=utf-8'),
+                              ('Vary', 'Cookie')])
+    return ('line %d\n' % i for i in range(1000))
+
+
+def _get(app, url, accept_encoding=None):
+    """
+    Call a WSGI application directly (webtest decodes compressed responses)
+    and return the status, headers and body chunks
+    """
+    headers = {}
+    if accept_encoding is not None:
+        headers['Accept-Encoding'] = accept_encoding
+    resp = {}
+
+    def start_response(status, headers, exc_info=None):
+        resp['status'] = status
+        resp['headers'] = dict(headers)
+
+    chunks = list(app(Request.blank(url, headers=headers).environ,
+                      start_response))
+    return (resp['status'], resp['headers'], chunks)
+
+
+class DwarfTestCase(utils.TestCase):
+
+    def setUp(self):
+        super(DwarfTestCase, self).setUp()
+        self.app = ApiServer().app
+
+    # Commented out to silence pylint
+    # def tearDown(self):
+    #     super(DwarfTestCase, self).tearDown()
+
+    def test_gzip(self):
+        for i in range(20):
+            self.db.flavors.create(id=str(200 + i), name='flavor-%d' % i,
+                                   disk=10, ram=512, vcpus=1)
+
+        url = '/compute/v2.0/flavors/detail'
+        (status, headers, chunks) = _get(self.app, url)
+        self.assertNotIn('Content-Encoding', headers)
+        plain = ''.join(chunks)
+
+        (status, headers, chunks) = _get(self.app, url, 'gzip')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertNotIn('Content-Length', headers)
+        body = ''.join(chunks)
+        self.assertTrue(len(body) < len(plain))
+        self.assertEqual(json.loads(zlib.decompress(body,
+                                                    16 + zlib.MAX_WBITS)),
+                         json.loads(plain))
+
+    def test_min_size(self):
+        (dummy, headers, chunks) = _get(self.app, '/compute/v2.0/flavors/100',
+                                        'gzip')
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(json.loads(''.join(chunks))['flavor']['id'], '100')
+
+    def test_negotiate(self):
+        # pylint: disable=W0212
+        self.assertEqual(compress._negotiate(''), None)
+        self.assertEqual(compress._negotiate('gzip, deflate'), 'gzip')
+        self.assertEqual(compress._negotiate('deflate'), 'deflate')
+        self.assertEqual(compress._negotiate('gzip;q=0.5, deflate'),
+                         'deflate')
+        self.assertEqual(compress._negotiate('*;q=0.1, gzip;q=0'), 'deflate')
+        self.assertEqual(compress._negotiate('identity, br'), None)
+
+    def test_stream(self):
+        app = compress.CompressMiddleware(
+            _stream_app, types=['application/json', 'text/plain'])
+        plain = ''.join('line %d\n' % i for i in range(1000))
+
+        (dummy, headers, chunks) = _get(app, '/', 'deflate')
+        self.assertEqual(headers['Content-Encoding'], 'deflate')
+        self.assertEqual(headers['Vary'], 'Cookie, Accept-Encoding')
+        self.assertEqual(zlib.decompress(''.join(chunks)), plain)
+
+        # Short responses and other content types aren't compressed
+        for url in ('/short', '/binary'):
+            (dummy, headers, chunks) = _get(app, url, 'gzip')
+            self.assertNotIn('Content-Encoding', headers)
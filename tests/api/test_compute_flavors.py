@@ -96,6 +96,37 @@ class DwarfTestCase(utils.TestCase):
                          list_flavors_resp([flavor1, flavor2, flavor3],
                                            details=True))
 
+    def test_list_flavors_paginated(self):
+        resp = self.app.get('/compute/v2.0/flavors?limit=2', status=200)
+        links = [{'href': 'http://localhost:80/compute/v2.0/flavors?'
+                          'limit=2&marker=%s' % flavor2['id'],
+                  'rel': 'next'}]
+        expected = list_flavors_resp([flavor1, flavor2], details=False)
+        expected['flavors_links'] = links
+        self.assertEqual(json.loads(resp.body), expected)
+
+        resp = self.app.get('/compute/v2.0/flavors?limit=2&marker=%s' %
+                            flavor2['id'], status=200)
+        self.assertEqual(json.loads(resp.body),
+                         list_flavors_resp([flavor3], details=False))
+
+    def test_list_flavors_filtered(self):
+        resp = self.app.get('/compute/v2.0/flavors?minRam=768&minDisk=30',
+                            status=200)
+        self.assertEqual(json.loads(resp.body),
+                         list_flavors_resp([flavor2, flavor3], details=False))
+
+        resp = self.app.get('/compute/v2.0/flavors/detail?minRam=1024',
+                            status=200)
+        self.assertEqual(json.loads(resp.body),
+                         list_flavors_resp([flavor3], details=True))
+
+    def test_list_flavors_bad_request(self):
+        self.app.get('/compute/v2.0/flavors?limit=foo', status=400)
+        self.app.get('/compute/v2.0/flavors?minRam=foo', status=400)
+        self.app.get('/compute/v2.0/flavors?marker=foo', status=400)
+        self.app.get('/compute/v2.0/flavors?sort_key=ram', status=400)
+
     def test_show_flavor(self):
         resp = self.app.get('/compute/v2.0/flavors/%s' % flavor1['id'],
                             status=200)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2017 Hewlett Packard Enterprise Development, L.P.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from webtest import TestApp
+
+from tests import data
+from tests import utils
+
+from dwarf import config
+
+from dwarf.api_server import ApiServer
+
+CONF = config.Config()
+
+server1 = data.server['11111111-2222-3333-4444-555555555555']
+
+image1 = data.image['11111111-2222-3333-4444-555555555555']
+
+
+class DwarfTestCase(utils.TestCase):
+
+    def setUp(self):
+        super(DwarfTestCase, self).setUp()
+        self.app = TestApp(ApiServer().app)
+
+    # Commented out to silence pylint
+    # def tearDown(self):
+    #     super(DwarfTestCase, self).tearDown()
+
+    def test_show_limits(self):
+        self.db.servers.create(**server1)
+        self.db.images.create(**image1)
+
+        quota = CONF.quota_cores
+        CONF.set_option('quota_cores', 4)
+        try:
+            resp = self.app.get('/compute/v2.0/limits', status=200)
+        finally:
+            CONF.set_option('quota_cores', quota)
+
+        self.assertEqual(json.loads(resp.body), {
+            'limits': {
+                'absolute': {
+                    'maxTotalCores': 4,
+                    'maxTotalImageBytes': -1,
+                    'maxTotalImages': -1,
+                    'maxTotalInstances': -1,
+                    'maxTotalRAMSize': -1,
+                    'totalCoresUsed': 1,
+                    'totalImageBytesUsed': 17,
+                    'totalImagesUsed': 1,
+                    'totalInstancesUsed': 1,
+                    'totalRAMUsed': 512,
+                },
+                'rate': [],
+            },
+        })
@@ -17,6 +17,7 @@
 
 # import time
 import json
+import threading
 
 from webtest import TestApp
 
@@ -24,6 +25,8 @@ from tests import data
 from tests import utils
 
 from dwarf.api_server import ApiServer
+from dwarf.compute import servers
+from dwarf.compute import virt
 
 SERVER_REQ = """{
     "flavorRef": "{{flavor_id}}",
@@ -38,6 +41,9 @@ def create_server_req(server):
 
 SERVER_RESP = """{
     "server": {
+% if task_state:
+        "OS-EXT-STS:task_state": "{{task_state}}",
+% end
         "addresses": {
             "private": [
                 {
@@ -102,6 +108,195 @@ class DwarfTestCase(utils.TestCase):
 
         resp = self.app.post('/compute/v2.0/servers',
                              params=json.dumps(create_server_req(server1)),
-                             status=200)
+                             status=202)
         self.assertEqual(json.loads(resp.body),
-                         utils.json_render(SERVER_RESP, ip=''))
+                         utils.json_render(SERVER_RESP, ip='',
+                                           task_state='spawning'))
+
+        # The server has been updated once after its creation
+        self.assertEqual(resp.headers['ETag'], '"2"')
+        self.app.delete('/compute/v2.0/servers/%s' % server1['id'],
+                        headers={'If-Match': '"1"'}, status=409)
+
+        # The server is built in the background
+        servers.Controller().wait()
+        resp = self.app.get('/compute/v2.0/servers/%s' % server1['id'],
+                            status=200)
+        server = json.loads(resp.body)['server']
+        self.assertEqual(server['status'], 'building')
+        self.assertNotIn('OS-EXT-STS:task_state', server)
+
+    def test_server_actions(self):
+        self.create_image(image1)
+        self.app.post('/compute/v2.0/servers',
+                      params=json.dumps(create_server_req(server1)),
+                      status=202)
+        servers.Controller().wait()
+
+        url = '/compute/v2.0/servers/%s' % server1['id']
+        for action in ({'os-stop': None}, {'os-start': None},
+                       {'reboot': {'type': 'HARD'}}):
+            self.app.post(url + '/action', params=json.dumps(action),
+                          status=202)
+            servers.Controller().wait()
+            server = self.db.servers.show(id=server1['id'])
+            self.assertEqual(server['task_state'], '')
+
+        # Only one operation at a time
+        self.db.servers.update(id=server1['id'], task_state='rebooting')
+        resp = self.app.get(url, status=200)
+        self.assertEqual(json.loads(resp.body)['server']['status'],
+                         'rebooting')
+        self.app.post(url + '/action', params=json.dumps({'os-stop': None}),
+                      status=409)
+
+        # A delete takes over from other operations, but not from a delete
+        self.db.servers.update(id=server1['id'], task_state='deleting')
+        self.app.delete(url, status=409)
+        self.db.servers.update(id=server1['id'], task_state='rebooting')
+        self.app.delete(url, status=204)
+        servers.Controller().wait()
+        self.app.get(url, status=404)
+
+    def test_delete_spawning_server(self):
+        self.create_image(image1)
+        url = '/compute/v2.0/servers/%s' % server1['id']
+
+        # Hold the build until the delete has started, and the delete until
+        # the build has finished
+        (release, built) = (threading.Event(), threading.Event())
+        states = []
+        create_server = virt.Controller.create_server
+        delete_server = virt.Controller.delete_server
+
+        def _create_server(self_, server, flavor):
+            release.wait(10)
+            try:
+                create_server(self_, server, flavor)
+            finally:
+                built.set()
+
+        def _delete_server(self_, server):
+            built.wait(10)
+            states.append(self.db.servers.show(id=server['id'])['task_state'])
+            delete_server(self_, server)
+
+        virt.Controller.create_server = _create_server
+        virt.Controller.delete_server = _delete_server
+        try:
+            self.app.post('/compute/v2.0/servers',
+                          params=json.dumps(create_server_req(server1)),
+                          status=202)
+            self.app.delete(url, status=204)
+            resp = self.app.get(url, status=200)
+            self.assertEqual(json.loads(resp.body)['server']['status'],
+                             'deleting')
+            release.set()
+            servers.Controller().wait()
+        finally:
+            release.set()
+            virt.Controller.create_server = create_server
+            virt.Controller.delete_server = delete_server
+
+        # The finished build didn't clear the task state of the delete
+        self.assertEqual(states, ['deleting'])
+        self.app.get(url, status=404)
+
+    def test_list_servers(self):
+        self.create_image(image1)
+        self.app.post('/compute/v2.0/servers',
+                      params=json.dumps(create_server_req(server1)),
+                      status=202)
+        servers.Controller().wait()
+
+        # The detailed list includes the flavor and image
+        resp = self.app.get('/compute/v2.0/servers/detail', status=200)
+        server = json.loads(resp.body)['servers'][0]
+        self.assertEqual(server['flavor']['original_name'], 'standard.xsmall')
+        self.assertEqual(server['flavor']['ram'], '512')
+        self.assertEqual(server['image']['name'], image1['name'])
+        self.assertEqual(server['updated_at'], '2001-02-03 04:05:06')
+
+        resp = self.app.get('/compute/v2.0/servers', status=200)
+        server = json.loads(resp.body)['servers'][0]
+        self.assertEqual(server['flavor']['id'], '100')
+        self.assertNotIn('original_name', server['flavor'])
+        self.assertNotIn('updated_at', server)
+
+    def test_list_servers_filtered(self):
+        server2 = dict(server1, id='22222222-3333-4444-5555-666666666666',
+                       name=u'Serv\xe9r 2')
+        self.db.servers.create_many([server1, server2])
+
+        # Non-ASCII names are matched by prefix
+        for name in ('Serv%C3%A9', 'Serv%C3%A9r%202'):
+            resp = self.app.get('/compute/v2.0/servers?name=%s' % name,
+                                status=200)
+            self.assertEqual([s['name'] for s in
+                              json.loads(resp.body)['servers']],
+                             [u'Serv\xe9r 2'])
+        resp = self.app.get('/compute/v2.0/servers?name=Test', status=200)
+        self.assertEqual([s['id'] for s in json.loads(resp.body)['servers']],
+                         [server1['id']])
+        self.app.get('/compute/v2.0/servers?name=%FF', status=400)
+
+    def test_server_metadata(self):
+        self.db.servers.create(**server1)
+        url = '/compute/v2.0/servers/%s/metadata' % server1['id']
+
+        resp = self.app.get(url, status=200)
+        self.assertEqual(json.loads(resp.body), {'metadata': {}})
+
+        resp = self.app.post(url, params=json.dumps({'metadata': {'a': '1'}}),
+                             status=200)
+        self.assertEqual(json.loads(resp.body), {'metadata': {'a': '1'}})
+        resp = self.app.put(url + '/b',
+                            params=json.dumps({'meta': {'b': '2'}}),
+                            status=200)
+        self.assertEqual(json.loads(resp.body), {'meta': {'b': '2'}})
+        resp = self.app.get(url + '/a', status=200)
+        self.assertEqual(json.loads(resp.body), {'meta': {'a': '1'}})
+
+        resp = self.app.put(url, params=json.dumps({'metadata': {'c': '3'}}),
+                            status=200)
+        self.assertEqual(json.loads(resp.body), {'metadata': {'c': '3'}})
+        self.app.delete(url + '/c', status=200)
+        self.app.get(url + '/c', status=404)
+
+        self.app.put(url + '/b', params=json.dumps({'meta': {'c': '3'}}),
+                     status=400)
+        self.app.post(url, params=json.dumps({'metadata': {'a': 1}}),
+                      status=400)
+        self.app.get('/compute/v2.0/servers/no_such_id/metadata', status=404)
+
+    def test_server_tags(self):
+        server2 = dict(server1, id='22222222-3333-4444-5555-666666666666',
+                       name='server2')
+        self.db.servers.create_many([server1, server2])
+        url = '/compute/v2.0/servers/%s/tags' % server1['id']
+
+        resp = self.app.put(url, params=json.dumps({'tags': ['b', 'a']}),
+                            status=200)
+        self.assertEqual(json.loads(resp.body), {'tags': ['a', 'b']})
+        resp = self.app.put(url + '/c', status=201)
+        self.assertTrue(resp.headers['Location'].endswith(url + '/c'))
+        resp = self.app.put(url + '/c', status=204)
+        self.assertNotIn('Location', resp.headers)
+        self.app.get(url + '/c', status=204)
+        self.app.delete(url + '/c', status=200)
+        self.app.get(url + '/c', status=404)
+        self.app.put(url + '/c,d', status=400)
+        self.app.put('/compute/v2.0/servers/%s/tags/b' % server2['id'],
+                     status=201)
+
+        # Filter the server list by tags
+        resp = self.app.get('/compute/v2.0/servers?tags=a,b', status=200)
+        self.assertEqual([s['id'] for s in json.loads(resp.body)['servers']],
+                         [server1['id']])
+        resp = self.app.get('/compute/v2.0/servers?tags-any=a,b', status=200)
+        self.assertEqual([s['id'] for s in json.loads(resp.body)['servers']],
+                         [server1['id'], server2['id']])
+
+        self.app.delete(url, status=200)
+        resp = self.app.get(url, status=200)
+        self.assertEqual(json.loads(resp.body), {'tags': []})
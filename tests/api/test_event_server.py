@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2017 Hewlett Packard Enterprise Development, L.P.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import httplib
+import errno
+import json
+import os
+import resource
+import socket
+import threading
+import time
+
+from tests import utils
+
+from dwarf import event_server
+from dwarf.api_server import ApiServer
+from dwarf.api_server import _WorkerPool   # pylint: disable=W0212
+
+
+def _echo_app(environ, start_response):
+    """
+    Return the request body, or wait for the release event of /slow requests
+    """
+    if environ['PATH_INFO'] == '/slow':
+        environ['test.release'].wait(10)
+    body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [environ['PATH_INFO'], ':', body]
+
+
+def _stream_app(environ, start_response):
+    """
+    Return the body in parts, the second one after the release event
+    """
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    yield 'first'
+    environ['test.release'].wait(10)
+    yield 'second'
+
+
+def _recv_until(sock, end):
+    data = ''
+    while not data.endswith(end):
+        buf = sock.recv(4096)
+        if not buf:
+            break
+        data += buf
+    return data
+
+
+def _recv_all(sock):
+    data = ''
+    while True:
+        buf = sock.recv(4096)
+        if not buf:
+            return data
+        data += buf
+
+
+class DwarfTestCase(utils.TestCase):
+
+    def setUp(self):
+        super(DwarfTestCase, self).setUp()
+        self.release = threading.Event()
+        self.srv = None
+        self.thread = None
+
+    def tearDown(self):
+        self.release.set()
+        if self.srv is not None:
+            self.srv.shutdown()
+            self.thread.join()
+            self.srv.workers.stop()
+            self.srv.server_close()
+        super(DwarfTestCase, self).tearDown()
+
+    def start(self, app, workers=2, queue_size=8, **kwargs):
+        """
+        Start an event server on a free port
+        """
+        def _app(environ, start_response):
+            environ['test.release'] = self.release
+            return app(environ, start_response)
+
+        self.srv = event_server.EventWSGIServer(('127.0.0.1', 0), **kwargs)
+        self.srv.workers = _WorkerPool(workers, queue_size,
+                                       self.srv.process_request)
+        self.srv.workers.start()
+        self.srv.set_app(_app)
+        self.thread = threading.Thread(target=self.srv.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.start()
+        return self.srv.server_address[1]
+
+    def connect(self, port):
+        sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        return sock
+
+    def test_keep_alive(self):
+        port = self.start(ApiServer().app)
+
+        conn = httplib.HTTPConnection('127.0.0.1', port, timeout=5)
+        for dummy in range(3):
+            conn.request('GET', '/compute/v2.0/flavors')
+            resp = conn.getresponse()
+            self.assertEqual(resp.status, 200)
+            self.assertEqual(resp.getheader('Connection'), 'keep-alive')
+            flavors = json.loads(resp.read())['flavors']
+            self.assertEqual(len(flavors), 3)
+        self.assertEqual(self.srv.connections(), 1)
+        conn.close()
+
+    def test_max_requests(self):
+        port = self.start(_echo_app, max_requests=2)
+
+        sock = self.connect(port)
+        sock.sendall('GET /a HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                     'GET /b HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                     'GET /c HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        resp = _recv_all(sock)
+        self.assertEqual(resp.count('HTTP/1.1 200 OK'), 2)
+        self.assertTrue(resp.endswith('Connection: close\r\n\r\n/b:'))
+
+    def test_idle_timeout(self):
+        port = self.start(_echo_app, idle_timeout=0.1)
+
+        sock = self.connect(port)
+        sock.sendall('GET /a HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        resp = _recv_all(sock)
+        self.assertTrue('Connection: keep-alive\r\n' in resp)
+        self.assertEqual(self.srv.connections(), 0)
+
+    def test_idle_timeout_disabled(self):
+        port = self.start(_echo_app, idle_timeout=0)
+
+        # A slow client isn't closed while sending its request
+        sock = self.connect(port)
+        sock.sendall('GET /a HTTP/1.1\r\n')
+        time.sleep(1.2)
+        self.assertEqual(self.srv.connections(), 1)
+        sock.sendall('Host: localhost\r\n\r\n')
+        resp = _recv_all(sock)
+        self.assertTrue('Connection: close\r\n' in resp)
+        self.assertTrue(resp.endswith('/a:'))
+
+    def test_streamed_response(self):
+        port = self.start(_stream_app)
+
+        # The first part is sent before the second one is produced
+        sock = self.connect(port)
+        sock.sendall('GET /a HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        resp = _recv_until(sock, '5\r\nfirst\r\n')
+        self.assertTrue('Transfer-Encoding: chunked\r\n' in resp)
+        self.assertTrue('Connection: keep-alive\r\n' in resp)
+        self.release.set()
+        self.assertEqual(_recv_until(sock, '0\r\n\r\n'),
+                         '6\r\nsecond\r\n0\r\n\r\n')
+
+        # The connection is still usable
+        sock.sendall('GET /b HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        resp = _recv_until(sock, '0\r\n\r\n')
+        self.assertTrue(resp.endswith('5\r\nfirst\r\n6\r\nsecond\r\n'
+                                      '0\r\n\r\n'))
+
+        # HTTP/1.0 clients get the body up to the end of the connection
+        sock = self.connect(port)
+        sock.sendall('GET /c HTTP/1.0\r\nConnection: keep-alive\r\n\r\n')
+        resp = _recv_all(sock)
+        self.assertTrue('Connection: close\r\n' in resp)
+        self.assertFalse('Transfer-Encoding' in resp)
+        self.assertTrue(resp.endswith('\r\n\r\nfirstsecond'))
+
+    def test_streamed_response_slow_client(self):
+        produced = []
+
+        def _app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            for dummy in range(512):
+                produced.append(1)
+                yield 'x' * 65536
+
+        port = self.start(_app)
+
+        # The worker waits for the client instead of buffering 32 MB
+        sock = self.connect(port)
+        sock.sendall('GET /a HTTP/1.1\r\nConnection: close\r\n\r\n')
+        time.sleep(0.5)
+        self.assertTrue(len(produced) < 512)
+        resp = _recv_all(sock)
+        self.assertEqual(len(produced), 512)
+        self.assertEqual(resp.partition('\r\n\r\n')[2].count('x'),
+                         512 * 65536)
+
+    def test_too_many_open_files(self):
+        port = self.start(_echo_app)
+        sock = socket.socket()
+        sock.settimeout(5)
+
+        accepts = []
+        accept = self.srv._accept   # pylint: disable=W0212
+
+        def _accept():
+            accepts.append(1)
+            accept()
+
+        self.srv._accept = _accept   # pylint: disable=W0212
+
+        # Use up all the file descriptors
+        limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+        resource.setrlimit(resource.RLIMIT_NOFILE, (max(fds) + 1, limits[1]))
+        dups = []
+        try:
+            while True:
+                try:
+                    dups.append(os.dup(0))
+                except OSError as e:
+                    self.assertEqual(e.errno, errno.EMFILE)
+                    break
+
+            # The server stops accepting instead of spinning
+            sock.connect(('127.0.0.1', port))
+            time.sleep(0.3)
+            self.assertEqual(len(accepts), 1)
+        finally:
+            for fd in dups:
+                os.close(fd)
+            resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+
+        # And accepts the connection later
+        sock.sendall('GET /a HTTP/1.0\r\n\r\n')
+        self.assertTrue(_recv_all(sock).endswith('/a:'))
+        self.assertEqual(len(accepts), 2)
+
+    def test_chunked_body(self):
+        port = self.start(_echo_app)
+
+        sock = self.connect(port)
+        sock.sendall('PUT /upload HTTP/1.1\r\nHost: localhost\r\n'
+                     'Transfer-Encoding: chunked\r\n'
+                     'Expect: 100-continue\r\nConnection: close\r\n\r\n')
+        self.assertEqual(sock.recv(4096), 'HTTP/1.1 100 Continue\r\n\r\n')
+        sock.sendall('4\r\nTest\r\n9;ext=1\r\n image 1 \r\n4\r\ndata\r\n'
+                     '0\r\nX-Trailer: foo\r\n\r\n')
+        resp = _recv_all(sock)
+        self.assertTrue(resp.startswith('HTTP/1.1 200 OK\r\n'))
+        self.assertTrue('Connection: close\r\n' in resp)
+        self.assertTrue(resp.endswith('\r\n\r\n/upload:Test image 1 data'))
+
+    def test_pipelined_requests(self):
+        port = self.start(_echo_app)
+
+        sock = self.connect(port)
+        sock.sendall('POST /a HTTP/1.1\r\nContent-Length: 3\r\n\r\nfoo'
+                     'GET /b HTTP/1.0\r\n\r\n')
+        resp = _recv_all(sock)
+        self.assertEqual(resp.count('HTTP/1.1 200 OK'), 2)
+        self.assertTrue(resp.index('/a:foo') < resp.index('/b:'))
+        self.assertTrue('Connection: keep-alive' in resp)
+        self.assertTrue(resp.endswith('Connection: close\r\n\r\n/b:'))
+
+    def test_bad_request(self):
+        port = self.start(_echo_app)
+
+        sock = self.connect(port)
+        sock.sendall('FOO\r\n\r\n')
+        self.assertTrue(_recv_all(sock).startswith('HTTP/1.1 400 '))
+
+    def test_slow_request(self):
+        port = self.start(_echo_app)
+
+        # Idle connections don't use up the workers
+        idle = [self.connect(port) for dummy in range(100)]
+
+        slow = self.connect(port)
+        slow.sendall('GET /slow HTTP/1.1\r\n\r\n')
+        while self.srv.workers.stats()['busy'] < 1:
+            time.sleep(0.01)
+
+        conn = httplib.HTTPConnection('127.0.0.1', port, timeout=5)
+        conn.request('GET', '/fast')
+        self.assertEqual(conn.getresponse().read(), '/fast:')
+        self.assertEqual(self.srv.connections(), 102)
+
+        self.release.set()
+        self.assertTrue(slow.recv(4096).endswith('/slow:'))
+        for sock in idle + [slow]:
+            sock.close()
+        conn.close()
+
+    def test_workers_busy(self):
+        port = self.start(_echo_app, workers=1, queue_size=1)
+
+        slow = [self.connect(port) for dummy in range(3)]
+        for (sock, stat) in zip(slow[:2], ('busy', 'queued')):
+            sock.sendall('GET /slow HTTP/1.1\r\n\r\n')
+            while self.srv.workers.stats()[stat] < 1:
+                time.sleep(0.01)
+
+        # One request runs, one is queued and the next one is rejected
+        slow[2].sendall('GET /slow HTTP/1.1\r\n\r\n')
+        self.assertTrue(_recv_all(slow[2]).startswith('HTTP/1.1 503 '))
+        self.release.set()
+        for sock in slow[:2]:
+            self.assertTrue(sock.recv(4096).endswith('/slow:'))
+        self.assertEqual(self.srv.workers.stats()['rejected'], 1)
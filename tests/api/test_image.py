@@ -118,6 +118,64 @@ class DwarfTestCase(utils.TestCase):
         self.assertEqual(json.loads(resp.body),
                          list_images_resp([image1, image2]))
 
+    def test_list_images_paginated(self):
+        # Preload test images
+        self.create_image(image1)
+        self.create_image(image2)
+
+        resp = self.app.get('/image/v2/images?limit=1&sort_key=name&'
+                            'sort_dir=desc', status=200)
+        expected = list_images_resp([image2])
+        expected['next'] = '/v2/images?limit=1&marker=%s&sort_dir=desc&' \
+                           'sort_key=name' % image2['id']
+        self.assertEqual(json.loads(resp.body), expected)
+
+        resp = self.app.get(expected['next'].replace('/v2', '/image/v2'),
+                            status=200)
+        expected = list_images_resp([image1])
+        expected['next'] = '/v2/images?limit=1&marker=%s&sort_dir=desc&' \
+                           'sort_key=name' % image1['id']
+        self.assertEqual(json.loads(resp.body), expected)
+
+        resp = self.app.get(expected['next'].replace('/v2', '/image/v2'),
+                            status=200)
+        self.assertEqual(json.loads(resp.body), list_images_resp([]))
+
+    def test_list_images_filtered(self):
+        # Preload test images
+        self.create_image(image1)
+        self.create_image(image2)
+
+        resp = self.app.get('/image/v2/images?name=%s' % image2['name'],
+                            status=200)
+        self.assertEqual(json.loads(resp.body), list_images_resp([image2]))
+
+        resp = self.app.get('/image/v2/images?status=active&'
+                            'disk_format=%s' % image1['disk_format'],
+                            status=200)
+        self.assertEqual(json.loads(resp.body),
+                         list_images_resp([image1, image2]))
+
+        resp = self.app.get('/image/v2/images?visibility=no_such_visibility',
+                            status=200)
+        self.assertEqual(json.loads(resp.body), list_images_resp([]))
+
+    def test_list_images_changes_since(self):
+        # Preload test images
+        self.create_image(image1)
+        self.now = '2001-02-03 04:05:07.500000'
+        self.create_image(image2)
+        self.app.delete('/image/v2/images/%s' % image2['id'], status=204)
+
+        resp = self.app.get('/image/v2/images?updated_at=gte:'
+                            '2001-02-03T04:05:07.5Z', status=200)
+        images = json.loads(resp.body)['images']
+        self.assertEqual([(i['id'], i['status']) for i in images],
+                         [(image2['id'], 'deleted')])
+
+        self.app.get('/image/v2/images?updated_at=lt:2001-02-03T04:05:07Z',
+                     status=400)
+
     def test_show_image(self):
         # Preload a test image
         self.create_image(image1)
@@ -155,6 +213,33 @@ class DwarfTestCase(utils.TestCase):
         patched[key] = val
         self.assertEqual(json.loads(resp.body), update_image_resp(patched))
 
+    def test_update_image_if_match(self):
+        # Preload a test image
+        self.create_image(image1)
+
+        resp = self.app.get('/image/v2/images/%s' % image1['id'], status=200)
+        etag = resp.headers['ETag']
+
+        # Stale and invalid versions
+        params = json.dumps([{'op': 'replace', 'path': '/name',
+                              'value': 'Patched test image 1'}])
+        self.app.patch('/image/v2/images/%s' % image1['id'], params=params,
+                       headers={'If-Match': '"1"'}, status=409)
+        self.app.patch('/image/v2/images/%s' % image1['id'], params=params,
+                       headers={'If-Match': 'foo'}, status=400)
+
+        resp = self.app.patch('/image/v2/images/%s' % image1['id'],
+                              params=params, headers={'If-Match': etag},
+                              status=200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        # The image has changed since
+        self.app.delete('/image/v2/images/%s' % image1['id'],
+                        headers={'If-Match': etag}, status=409)
+        self.app.delete('/image/v2/images/%s' % image1['id'],
+                        headers={'If-Match': resp.headers['ETag']},
+                        status=204)
+
     def test_create_image(self):
         # Create the image in the database
         resp = self.app.post('/image/v2/images',
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Hewlett-Packard Development Company, L.P.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from webtest import TestApp
+
+from tests import utils
+
+from dwarf.api_server import ApiServer
+
+
+class DwarfTestCase(utils.TestCase):
+
+    def setUp(self):
+        super(DwarfTestCase, self).setUp()
+        self.app = TestApp(ApiServer().app)
+
+    # Commented out to silence pylint
+    # def tearDown(self):
+    #     super(DwarfTestCase, self).tearDown()
+
+    def test_db_headers(self):
+        # The memory engine doesn't run any statements
+        queries = 1 if self.db_engine == 'sqlite' else 0
+
+        resp = self.app.get('/compute/v2.0/flavors/100', status=200)
+        self.assertEqual(resp.headers['X-Dwarf-DB-Queries'], str(queries))
+        self.assertTrue(float(resp.headers['X-Dwarf-DB-Time']) >= 0)
+
+        # Served from the row cache
+        resp = self.app.get('/compute/v2.0/flavors/100', status=200)
+        self.assertEqual(resp.headers['X-Dwarf-DB-Queries'], '0')
+
+        # Error responses have the headers, too
+        resp = self.app.get('/compute/v2.0/flavors/999', status=404)
+        self.assertEqual(resp.headers['X-Dwarf-DB-Queries'], str(queries))
+        resp = self.app.get('/no/such/route', status=404)
+        self.assertEqual(resp.headers['X-Dwarf-DB-Queries'], '0')
+
+    def test_stats(self):
+        self.app.get('/compute/v2.0/flavors', status=200)
+        resp = self.app.get('/stats', status=200)
+        stats = json.loads(resp.body)
+        route = stats['routes']['GET /compute/v2.0/flavors']
+        self.assertTrue(route['requests'] >= 1)
+        self.assertTrue(route['rows'] >= 3)
+        self.assertTrue('statements' in stats['db'])
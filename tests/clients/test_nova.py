@@ -23,6 +23,8 @@ import time
 from tests import data
 from tests import utils
 
+from dwarf.compute import servers
+
 
 def verify_private_key(stdout):
     line = [l for l in stdout.split('\n') if l != '']
@@ -109,6 +111,7 @@ class DwarfTestCase(utils.TestCase):
         self.exec_verify(['nova', 'stop', server1['id']],
                          stdout='Request to stop server %s has been '
                          'accepted.\n' % server1['id'])
+        servers.Controller().wait()
 
         # Should show status 'stopped'
         self.exec_verify(['nova', 'show', server1['id']],
@@ -117,6 +120,7 @@ class DwarfTestCase(utils.TestCase):
         self.exec_verify(['nova', 'start', server1['id']],
                          stdout='Request to start server %s has been '
                          'accepted.\n' % server1['id'])
+        servers.Controller().wait()
 
         # Should show status 'active'
         self.exec_verify(['nova', 'show', server1['id']],
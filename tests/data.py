@@ -27,21 +27,22 @@ image = {
         'created_at': now,
         'data': 'Test image 1 data',
         'data_chunked': '4\r\nTest\r\n9\r\n image 1 \r\n4\r\ndata\r\n0\r\n',
-        'deleted': 'False',
+        'deleted': False,
         'deleted_at': '',
         'disk_format': 'raw',
         'file': '/tmp/dwarf/images/11111111-2222-3333-4444-555555555555',
         'id': '11111111-2222-3333-4444-555555555555',
-        'int_id': '1',
+        'int_id': 1,
         'min_disk': '',
         'min_ram': '',
         'name': 'Test image 1',
         'owner': '',
         'properties': {},
-        'protected': 'False',
-        'size': '17',
+        'protected': False,
+        'size': 17,
         'status': 'active',
         'updated_at': now,
+        'version': 1,
         'visibility': 'private'
     },
     '22222222-3333-4444-5555-666666666666': {
@@ -50,21 +51,22 @@ image = {
         'created_at': now,
         'data': 'Test image 2 data',
         'data_chunked': '4\r\nTest\r\n9\r\n image 2 \r\n4\r\ndata\r\n0\r\n',
-        'deleted': 'False',
+        'deleted': False,
         'deleted_at': '',
         'disk_format': 'raw',
         'file': '/tmp/dwarf/images/22222222-3333-4444-5555-666666666666',
         'id': '22222222-3333-4444-5555-666666666666',
-        'int_id': '2',
+        'int_id': 2,
         'min_disk': '',
         'min_ram': '',
         'name': 'Test image 2',
         'owner': '',
         'properties': {},
-        'protected': 'False',
-        'size': '17',
+        'protected': False,
+        'size': 17,
         'status': 'active',
         'updated_at': now,
+        'version': 1,
         'visibility': 'private'
     },
 }
@@ -72,49 +74,52 @@ image = {
 flavor = {
     '100': {
         'created_at': now,
-        'deleted': 'False',
+        'deleted': False,
         'deleted_at': '',
-        'disk': '10',
+        'disk': 10,
         'id': '100',
-        'int_id': '1',
+        'int_id': 1,
         'name': 'standard.xsmall',
-        'ram': '512',
+        'ram': 512,
         'updated_at': now,
-        'vcpus': '1',
+        'version': 1,
+        'vcpus': 1,
     },
     '101': {
         'created_at': now,
-        'deleted': 'False',
+        'deleted': False,
         'deleted_at': '',
-        'disk': '30',
+        'disk': 30,
         'id': '101',
-        'int_id': '2',
+        'int_id': 2,
         'name': 'standard.small',
-        'ram': '768',
+        'ram': 768,
         'updated_at': now,
-        'vcpus': '1',
+        'version': 1,
+        'vcpus': 1,
     },
     '102': {
         'created_at': now,
-        'deleted': 'False',
+        'deleted': False,
         'deleted_at': '',
-        'disk': '30',
+        'disk': 30,
         'id': '102',
-        'int_id': '3',
+        'int_id': 3,
         'name': 'standard.medium',
-        'ram': '1024',
+        'ram': 1024,
         'updated_at': now,
-        'vcpus': '1',
+        'version': 1,
+        'vcpus': 1,
     },
 }
 
 keypair = {
     '11111111-2222-3333-4444-555555555555': {
         'created_at': now,
-        'deleted': 'False',
+        'deleted': False,
         'deleted_at': '',
         'id': '11111111-2222-3333-4444-555555555555',
-        'int_id': '1',
+        'int_id': 1,
         'fingerprint': 'ea:3a:a1:40:49:63:c3:50:96:b6:a3:d9:d8:57:78:1c',
         'name': 'Test keypair 1',
         'public_key': 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQC3BdGcpV0k4FgcVTR'
@@ -125,13 +130,14 @@ keypair = {
                       '3Ie4fqoGX7uj13ZRSHDCxeVI1lUeWraIKASTgvCQmrDebYPniD0LFa0'
                       '9lIrzQ95TTUDOk2XcQ292Bm1M7YRWY8OAum5bhj+JkSLxFNnDf',
         'updated_at': now,
+        'version': 1,
     },
     '22222222-3333-4444-5555-666666666666': {
         'created_at': now,
-        'deleted': 'False',
+        'deleted': False,
         'deleted_at': '',
         'id': '22222222-3333-4444-5555-666666666666',
-        'int_id': '2',
+        'int_id': 2,
         'fingerprint': 'f1:82:dc:af:6a:85:06:71:74:c4:25:4f:aa:88:2c:e3',
         'name': 'Test keypair 2',
         'public_key': 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQDFQBq363pwh80sA3o'
@@ -142,25 +148,31 @@ keypair = {
                       'f0ZPD6HJCe4MyUgYQBwAAnZ4sq2fSV/U6kqhmhnv9WnUD/ianGuFNgp'
                       'CjkNTepm8ny6+H+i/YKp4h1jAEc/bi+xPksN5tJAVuXI1b6iy7',
         'updated_at': now,
+        'version': 1,
     },
 }
 
 
 server = {
     '11111111-2222-3333-4444-555555555555': {
-        'config_drive': 'False',
+        'config_drive': False,
         'created_at': now,
-        'deleted': 'False',
+        'deleted': False,
         'deleted_at': '',
+        'disk': 10,
         'flavor_id': '100',
         'id': '11111111-2222-3333-4444-555555555555',
         'image_id': '11111111-2222-3333-4444-555555555555',
-        'int_id': '1',
+        'int_id': 1,
         'ip': '11.22.33.44',
         'key_name': 'Test keypair 1',
         'mac_address': '11:22:33:44:55:66',
         'name': 'Test server 1',
+        'ram': 512,
         'status': 'active',
+        'task_state': '',
         'updated_at': now,
+        'vcpus': 1,
+        'version': 1,
     },
 }
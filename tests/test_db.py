@@ -16,102 +16,72 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+import json
+import logging
+import os
+import StringIO
+import threading
+import time
+import unittest
+
+from contextlib import contextmanager
 from copy import deepcopy
 
 from tests import data
 from tests import utils
 
+from dwarf import config
+from dwarf import db
 from dwarf import exception
 
-FLAVOR = """{
-    "created_at": "{{created_at}}",
-    "deleted": "{{deleted}}",
-    "deleted_at": "{{deleted_at}}",
-    "disk": "{{disk}}",
-    "id": "{{id}}",
-    "int_id": "{{int_id}}",
-    "name": "{{name}}",
-    "ram": "{{ram}}",
-    "updated_at": "{{updated_at}}",
-    "vcpus": "{{vcpus}}"
-}"""
+CONF = config.Config()
+
+
+def sqlite_only(func):
+    """
+    Skip a test of sqlite internals for the other storage engines
+    """
+    @functools.wraps(func)
+    def wrapper(self):
+        if self.db_engine != 'sqlite':
+            raise unittest.SkipTest('not supported by the %s engine' %
+                                    self.db_engine)
+        return func(self)
+    return wrapper
+
+
+def _row(cols, obj, **kwargs):
+    """
+    Return the table row (dict) of the object
+    """
+    row = dict((c, obj[c]) for c in cols)
+    row.update(kwargs)
+    return row
 
 
 def show_flavor_resp(flavor, **kwargs):
-    return utils.json_render(FLAVOR, flavor, **kwargs)
+    return _row(db.DB_FLAVORS_COLS, flavor, **kwargs)
 
 
 def list_flavors_resp(flavors):
-    return [utils.json_render(FLAVOR, f) for f in flavors]
-
-
-SERVER = """{
-    "config_drive": "{{config_drive}}",
-    "created_at": "{{created_at}}",
-    "deleted": "{{deleted}}",
-    "deleted_at": "{{deleted_at}}",
-    "flavor_id": "{{flavor_id}}",
-    "id": "{{id}}",
-    "image_id": "{{image_id}}",
-    "int_id": "{{int_id}}",
-    "ip": "{{ip}}",
-    "key_name": "{{key_name}}",
-    "mac_address": "{{mac_address}}",
-    "name": "{{name}}",
-    "status": "{{status}}",
-    "updated_at": "{{updated_at}}"
-}"""
+    return [_row(db.DB_FLAVORS_COLS, f) for f in flavors]
 
 
 def create_server_resp(server):
-    return utils.json_render(SERVER, server)
+    return _row(db.DB_SERVERS_COLS, server)
 
 
 def show_server_resp(server):
-    return utils.json_render(SERVER, server)
-
-
-KEYPAIR = """{
-    "created_at": "{{created_at}}",
-    "deleted": "{{deleted}}",
-    "deleted_at": "{{deleted_at}}",
-    "id": "{{id}}",
-    "int_id": "{{int_id}}",
-    "fingerprint": "{{fingerprint}}",
-    "name": "{{name}}",
-    "public_key": "{{public_key}}",
-    "updated_at": "{{updated_at}}"
-}"""
+    return _row(db.DB_SERVERS_COLS, server)
 
 
 def create_keypair_resp(keypair):
-    return utils.json_render(KEYPAIR, keypair)
-
-
-IMAGE = """{
-    "checksum": "{{checksum}}",
-    "container_format": "{{container_format}}",
-    "created_at": "{{created_at}}",
-    "deleted": "{{deleted}}",
-    "deleted_at": "{{deleted_at}}",
-    "disk_format": "{{disk_format}}",
-    "file": "{{file}}",
-    "id": "{{id}}",
-    "int_id": "{{int_id}}",
-    "min_disk": "{{min_disk}}",
-    "min_ram": "{{min_ram}}",
-    "name": "{{name}}",
-    "owner": "{{owner}}",
-    "protected": "{{protected}}",
-    "size": "{{size}}",
-    "status": "{{status}}",
-    "updated_at": "{{updated_at}}",
-    "visibility": "{{visibility}}"
-}"""
+    return _row(db.DB_KEYPAIRS_COLS, keypair)
 
 
 def create_image_resp(image):
-    return utils.json_render(IMAGE, image)
+    return _row(db.DB_IMAGES_COLS, image)
 
 
 flavor1 = data.flavor['100']
@@ -127,6 +97,8 @@ image1 = data.image['11111111-2222-3333-4444-555555555555']
 
 class DbTestCase(utils.TestCase):
 
+    db_engine = 'sqlite'
+
     # Commented out to silence pylint
     # def setUp(self):
     #     super(DbTestCase, self).setUp()
@@ -146,6 +118,22 @@ class DbTestCase(utils.TestCase):
         self.db.dump()
         self.db.dump(table='flavors')
 
+    def test_dump_db_formats(self):
+        self.db.flavors.delete(id=flavor1['id'])
+
+        out = StringIO.StringIO()
+        self.db.dump(table='flavors', fmt='csv', out=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], ','.join(db.DB_FLAVORS_COLS))
+        self.assertEqual(len(lines), 4)
+
+        out = StringIO.StringIO()
+        self.db.dump(table='flavors', fmt='json', deleted=False, out=out)
+        rows = [json.loads(l) for l in out.getvalue().splitlines()]
+        self.assertEqual([r['id'] for r in rows], [flavor2['id'],
+                                                   flavor3['id']])
+        self.assertEqual(rows[0]['ram'], flavor2['ram'])
+
     # -------------------------------------------------------------------------
     # Flavor
 
@@ -176,9 +164,79 @@ class DbTestCase(utils.TestCase):
 
     def test_update_flavor(self):
         resp = self.db.flavors.update(id=flavor1['id'], name='new name',
-                                      disk='new disk', foo='bar')
+                                      disk='40', foo='bar')
         self.assertEqual(resp, show_flavor_resp(flavor1, name='new name',
-                                                disk='new disk'))
+                                                disk=40, version=2))
+
+    def test_update_flavor_bad_request(self):
+        self.assertRaises(exception.BadRequest, self.db.flavors.update,
+                          id=flavor1['id'], disk='new disk')
+
+    def test_update_flavor_version(self):
+        resp = self.db.flavors.update(id=flavor1['id'], name='new name',
+                                      expected_version=1)
+        self.assertEqual(resp['version'], 2)
+
+        # Stale version
+        self.assertRaises(exception.Conflict, self.db.flavors.update,
+                          id=flavor1['id'], name='other name',
+                          expected_version=1)
+        self.assertRaises(exception.Conflict, self.db.flavors.delete,
+                          id=flavor1['id'], expected_version=1)
+        self.assertEqual(self.db.flavors.show(id=flavor1['id']),
+                         show_flavor_resp(flavor1, name='new name',
+                                          version=2))
+
+        self.assertRaises(exception.NotFound, self.db.flavors.update,
+                          id='no_such_id', expected_version=1)
+        self.db.flavors.delete(id=flavor1['id'], expected_version=2)
+
+    def test_list_flavors_paginated(self):
+        resp = self.db.flavors.list(limit=2)
+        self.assertEqual(resp, list_flavors_resp([flavor1, flavor2]))
+        resp = self.db.flavors.list(limit=2, marker=flavor2['id'])
+        self.assertEqual(resp, list_flavors_resp([flavor3]))
+
+    def test_list_flavors_sorted(self):
+        resp = self.db.flavors.list(sort_key='name', sort_dir='desc')
+        self.assertEqual(resp, list_flavors_resp([flavor1, flavor2,
+                                                  flavor3]))
+        resp = self.db.flavors.list(sort_key='name', sort_dir='desc',
+                                    marker=flavor1['id'])
+        self.assertEqual(resp, list_flavors_resp([flavor2, flavor3]))
+
+        # Rows with the same sort key value are in insertion order
+        resp = self.db.flavors.list(sort_key='created_at', limit=1,
+                                    marker=flavor1['id'])
+        self.assertEqual(resp, list_flavors_resp([flavor2]))
+
+    def test_list_flavors_filtered(self):
+        resp = self.db.flavors.list(filters=[('ram', db.FILTER_GE, '768')])
+        self.assertEqual(resp, list_flavors_resp([flavor2, flavor3]))
+        resp = self.db.flavors.list(filters=[('ram', db.FILTER_GE, 768),
+                                             ('disk', db.FILTER_EQ, 30),
+                                             ('name', db.FILTER_PREFIX,
+                                              'standard.m')])
+        self.assertEqual(resp, list_flavors_resp([flavor3]))
+        with self.assertIndexed():
+            resp = self.db.flavors.list(filters=[('name', db.FILTER_PREFIX,
+                                                  'standard.')], limit=1,
+                                        marker=flavor1['id'])
+        self.assertEqual(resp, list_flavors_resp([flavor2]))
+
+    def test_list_flavors_bad_request(self):
+        self.assertRaises(exception.BadRequest, self.db.flavors.list,
+                          marker='no_such_id')
+        self.assertRaises(exception.BadRequest, self.db.flavors.list,
+                          filters=[('foo', db.FILTER_EQ, 'bar')])
+        self.assertRaises(exception.BadRequest, self.db.flavors.list,
+                          filters=[('ram', db.FILTER_PREFIX, '5')])
+        self.assertRaises(exception.BadRequest, self.db.flavors.list,
+                          filters=[('ram', db.FILTER_GE, 'foo')])
+        self.assertRaises(exception.BadRequest, self.db.flavors.list,
+                          sort_key='ram')
+        self.assertRaises(exception.BadRequest, self.db.flavors.list,
+                          sort_dir='up')
 
     # -------------------------------------------------------------------------
     # Server
@@ -193,6 +251,238 @@ class DbTestCase(utils.TestCase):
         resp = self.db.servers.show(ip=server1['ip'])
         self.assertEqual(resp, show_server_resp(server1))
 
+    def test_list_servers_filtered(self):
+        self.db.servers.create(**server1)
+
+        resp = self.db.servers.list(filters=[('name', db.FILTER_PREFIX,
+                                              'Test'),
+                                             ('flavor_id', db.FILTER_EQ,
+                                              server1['flavor_id'])])
+        self.assertEqual(resp, [show_server_resp(server1)])
+        resp = self.db.servers.list(filters=[('updated_at', db.FILTER_GE,
+                                              server1['updated_at'])])
+        self.assertEqual(resp, [show_server_resp(server1)])
+        resp = self.db.servers.list(filters=[('updated_at', db.FILTER_GE,
+                                              '2001-02-03 04:05:07')])
+        self.assertEqual(resp, [])
+
+    def test_list_servers_tags(self):
+        server2 = dict(server1, id='22222222-3333-4444-5555-666666666666',
+                       name='server2')
+        self.db.servers.create_many([server1, server2])
+        self.db.server_tags.set(server1['id'], {'a': '', 'b': ''})
+        self.db.server_tags.set(server2['id'], {'b': ''})
+
+        resp = self.db.servers.list(filters=[('tags', db.FILTER_ALL, 'a,b')])
+        self.assertEqual([s['id'] for s in resp], [server1['id']])
+        with self.assertIndexed():
+            resp = self.db.servers.list(filters=[('tags', db.FILTER_ANY,
+                                                  ['a', 'b', 'c'])])
+        self.assertEqual([s['id'] for s in resp],
+                         [server1['id'], server2['id']])
+        resp = self.db.servers.list(filters=[('tags', db.FILTER_ALL, 'b'),
+                                             ('name', db.FILTER_PREFIX,
+                                              'server')])
+        self.assertEqual([s['id'] for s in resp], [server2['id']])
+        resp = self.db.servers.list(filters=[('tags', db.FILTER_ANY, 'c')])
+        self.assertEqual(resp, [])
+
+        self.assertRaises(exception.BadRequest, self.db.servers.list,
+                          filters=[('tags', db.FILTER_ALL, ',')])
+        self.assertRaises(exception.BadRequest, self.db.flavors.list,
+                          filters=[('tags', db.FILTER_ANY, 'a')])
+
+    def test_server_metadata(self):
+        self.db.servers.create(**server1)
+        metadata = self.db.server_metadata
+        self.assertEqual(metadata.get(server1['id']), {})
+
+        resp = metadata.set(server1['id'], {'b': '2', 'a': '1'})
+        self.assertEqual(resp.items(), [('a', '1'), ('b', '2')])
+        resp = metadata.set(server1['id'], {'b': '3', 'c': '4'})
+        self.assertEqual(resp, {'a': '1', 'b': '3', 'c': '4'})
+        resp = metadata.set(server1['id'], {'d': '5'}, replace=True)
+        self.assertEqual(resp, {'d': '5'})
+
+        metadata.delete(server1['id'], key='d')
+        self.assertRaises(exception.NotFound, metadata.delete, server1['id'],
+                          key='d')
+        self.assertEqual(metadata.get(server1['id']), {})
+
+        resp = self.db.journal.list(resource='server_metadata')
+        self.assertEqual([r['changes'] for r in resp],
+                         [{'a': '1', 'b': '2'},
+                          {'a': '1', 'b': '3', 'c': '4'}, {'d': '5'}, {}])
+
+        out = StringIO.StringIO()
+        metadata.set(server1['id'], {'a': '1'})
+        self.db.dump(table='server_metadata', fmt='csv', out=out)
+        self.assertEqual(out.getvalue().splitlines()[1],
+                         '%s,a,1' % server1['id'])
+
+    def test_list_servers_changes_since(self):
+        self.now = '2001-02-03 04:05:06.000001'
+        self.db.servers.create(**server1)
+        self.now = '2001-02-03 04:05:06.000002'
+        self.db.servers.delete(id=server1['id'])
+
+        resp = self.db.servers.list(changes_since='2001-02-03 04:05:06.000002')
+        self.assertEqual([(r['id'], r['deleted']) for r in resp],
+                         [(server1['id'], True)])
+        resp = self.db.servers.list(changes_since='2001-02-03 04:05:06.000003')
+        self.assertEqual(resp, [])
+
+        # Paginate across deleted rows
+        with self.assertIndexed():
+            resp = self.db.servers.list(changes_since='2001-02-03 04:05:06',
+                                        marker=server1['id'])
+        self.assertEqual(resp, [])
+
+    def test_list_servers_cols(self):
+        self.db.servers.create(**server1)
+        cols = ['id', 'name', 'deleted', 'int_id']
+        resp = self.db.servers.list(cols=cols)
+        self.assertEqual(resp, [dict((c, show_server_resp(server1)[c])
+                                     for c in cols)])
+        resp = self.db.flavors.show(id=flavor1['id'], cols=['name'])
+        self.assertEqual(resp, {'name': flavor1['name']})
+
+        self.assertRaises(exception.BadRequest, self.db.servers.list,
+                          cols=['foo'])
+        self.assertRaises(exception.BadRequest, self.db.servers.show,
+                          id=server1['id'], cols=['foo'])
+
+    def test_list_servers_joined(self):
+        self.db.images.create(**image1)
+        self.db.servers.create(**server1)
+        server2 = dict(server1, id='22222222-3333-4444-5555-666666666666',
+                       name='server2', image_id='no_such_image')
+        self.db.servers.create(**server2)
+
+        joins = [(self.db.flavors, 'flavor_id', ['name', 'ram']),
+                 (self.db.images, 'image_id', ['name', 'protected'])]
+        with self.assertIndexed():
+            resp = self.db.servers.list(joins=joins,
+                                        filters=[('name', db.FILTER_PREFIX,
+                                                  'server')],
+                                        limit=1)
+        self.assertEqual(resp, [dict(show_server_resp(server2), int_id=2,
+                                     flavor_name=flavor1['name'],
+                                     flavor_ram=flavor1['ram'],
+                                     image_name='', image_protected='')])
+
+        resp = self.db.servers.show(id=server1['id'], joins=joins)
+        self.assertEqual(resp, dict(show_server_resp(server1),
+                                    flavor_name=flavor1['name'],
+                                    flavor_ram=flavor1['ram'],
+                                    image_name=image1['name'],
+                                    image_protected=False))
+
+        self.assertRaises(exception.BadRequest, self.db.servers.list,
+                          joins=[(self.db.flavors, 'foo', ['name'])])
+        self.assertRaises(exception.BadRequest, self.db.servers.list,
+                          joins=[(self.db.flavors, 'flavor_id', ['foo'])])
+
+    def test_create_server_int_id(self):
+        self.db.servers.create(**server1)
+        self.db.servers.delete(id=server1['id'])
+
+        # Integer IDs of deleted rows are not reused
+        server2 = deepcopy(server1)
+        server2['id'] = '22222222-3333-4444-5555-666666666666'
+        resp = self.db.servers.create(**server2)
+        self.assertEqual(resp['int_id'], 2)
+
+    def test_create_server_unicode(self):
+        self.db.servers.create(**dict(server1, name=u'Serv\xe9r 1'))
+        resp = self.db.servers.show(id=server1['id'])
+        self.assertEqual(resp['name'], u'Serv\xe9r 1')
+        resp = self.db.servers.list(filters=[('name', db.FILTER_EQ,
+                                              u'Serv\xe9r 1')])
+        self.assertEqual([s['id'] for s in resp], [server1['id']])
+
+    # -------------------------------------------------------------------------
+    # Batch writes
+
+    def test_create_many(self):
+        server2 = dict(server1, id='22222222-3333-4444-5555-666666666666',
+                       name='server2')
+        resp = self.db.servers.create_many([server1, server2])
+        self.assertEqual(resp, [create_server_resp(server1),
+                                show_server_resp(dict(server2, int_id=2))])
+
+        # Nothing is created if a row exists, in the table or in the batch
+        server3 = dict(server1, id='33333333-4444-5555-6666-777777777777',
+                       name='server3')
+        self.assertRaises(exception.Conflict, self.db.servers.create_many,
+                          [server3, server1])
+        self.assertRaises(exception.Conflict, self.db.servers.create_many,
+                          [server3, server3])
+        self.assertEqual(len(self.db.servers.list()), 2)
+
+        # The integer IDs continue after the batch
+        resp = self.db.servers.create(**server3)
+        self.assertEqual(resp['int_id'], 3)
+
+    @sqlite_only
+    def test_create_many_transaction(self):
+        stats = db.stats()
+        self.db.keypairs.create_many([dict(keypair1, name='key%d' % i)
+                                      for i in range(10)])
+        self.assertEqual(db.stats()['transactions'],
+                         stats['transactions'] + 1)
+
+    def test_update_many(self):
+        resp = self.db.flavors.update_many([
+            {'id': flavor1['id'], 'ram': 1024, 'expected_version': 1},
+            {'id': flavor2['id'], 'ram': 2048},
+        ])
+        self.assertEqual([(r['ram'], r['version']) for r in resp],
+                         [(1024, 2), (2048, 2)])
+
+        # Nothing is updated if a row doesn't exist or has been modified
+        self.assertRaises(exception.NotFound, self.db.flavors.update_many,
+                          [{'id': flavor3['id'], 'ram': 4096},
+                           {'id': 'no_such_id', 'ram': 4096}])
+        self.assertRaises(exception.Conflict, self.db.flavors.update_many,
+                          [{'id': flavor3['id'], 'ram': 4096},
+                           {'id': flavor1['id'], 'expected_version': 1}])
+        self.assertEqual(self.db.flavors.show(id=flavor3['id']),
+                         show_flavor_resp(flavor3))
+
+        resp = self.db.flavors.update_many([{'id': 'no_such_id', 'ram': 1},
+                                            {'id': flavor3['id'], 'ram': 1}],
+                                           skip_missing=True)
+        self.assertEqual([r['id'] for r in resp], [flavor3['id']])
+
+    def test_queue_update(self):
+        self.db.servers.create(**server1)
+        self.db.servers.queue_update(id=server1['id'], status='active')
+        self.db.servers.queue_update(id=server1['id'], ip='1.2.3.4')
+        self.db.servers.queue_update(id='no_such_id', ip='1.2.3.5')
+        self.assertEqual(db.stats()['queued_updates'], 2)
+        self.assertEqual(self.db.servers.show(id=server1['id'])['ip'],
+                         server1['ip'])
+
+        # Updates of the same row are merged, missing rows are dropped
+        self.assertEqual(self.db.flush(), 1)
+        resp = self.db.servers.show(id=server1['id'])
+        self.assertEqual((resp['status'], resp['ip'], resp['version']),
+                         ('active', '1.2.3.4', 2))
+        self.assertEqual(db.stats()['queued_updates'], 0)
+        self.assertEqual(self.db.flush(), 0)
+
+    def test_queue_update_disabled(self):
+        self.db.servers.create(**server1)
+        interval = CONF.db_flush_interval
+        CONF.set_option('db_flush_interval', 0)
+        try:
+            self.db.servers.queue_update(id=server1['id'], ip='1.2.3.4')
+        finally:
+            CONF.set_option('db_flush_interval', interval)
+        self.assertEqual(self.db.servers.show(id=server1['id'])['ip'],
+                         '1.2.3.4')
+
     # -------------------------------------------------------------------------
     # Keypair
 
@@ -214,6 +504,587 @@ class DbTestCase(utils.TestCase):
         self.assertRaises(exception.Forbidden, self.db.images.delete,
                           id=protected['id'])
 
+    # -------------------------------------------------------------------------
+    # Connection pool
+
+    @sqlite_only
+    def test_connection_reuse(self):
+        stats = db.stats()
+        self.db.servers.create(**server1)
+        self.db.servers.update(id=server1['id'], status='stopped')
+        self.db.flavors.show(id=flavor1['id'])
+        self.db.images.list()
+
+        # Re-use the connection of the previous calls
+        self.assertEqual(db.stats()['connections'], stats['connections'])
+        self.assertEqual(db.stats()['transactions'],
+                         stats['transactions'] + 2)
+
+    @sqlite_only
+    def test_connection_thread_exit(self):
+        self.db.flavors.list()
+        stats = db.stats()
+
+        # The connections of ended threads are closed
+        threads = [threading.Thread(target=self.db.servers.list)
+                   for dummy in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(db.stats()['connections'],
+                         stats['connections'] + 50)
+
+        # The thread-local state is freed right after join() returns
+        deadline = time.time() + 5
+        while (db.stats()['open_connections'] > stats['open_connections'] and
+               time.time() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(db.stats()['open_connections'],
+                         stats['open_connections'])
+
+    @sqlite_only
+    def test_connection_pragmas(self):
+        cur = db._POOL.cursor(self.db.flavors.db)   # pylint: disable=W0212
+        cur.execute('PRAGMA journal_mode')
+        self.assertEqual(cur.fetchone()[0], CONF.db_journal_mode)
+        cur.execute('PRAGMA busy_timeout')
+        self.assertEqual(cur.fetchone()[0], CONF.db_busy_timeout)
+
+    @sqlite_only
+    def test_connection_bad_pragma(self):
+        synchronous = CONF.db_synchronous
+        CONF.set_option('db_synchronous', 'foo')
+        try:
+            db._POOL.reset()   # pylint: disable=W0212
+            self.assertRaises(exception.Failure, self.db.flavors.list)
+        finally:
+            CONF.set_option('db_synchronous', synchronous)
+
+    @sqlite_only
+    def test_create_rollback(self):
+        stats = db.stats()
+        self.assertRaises(exception.Conflict, self.db.flavors.create,
+                          id=flavor1['id'])
+        self.assertEqual(db.stats()['transactions'],
+                         stats['transactions'] + 1)
+        self.assertEqual(self.db.flavors.list(),
+                         list_flavors_resp([flavor1, flavor2, flavor3]))
+
+    # -------------------------------------------------------------------------
+    # Journal
+
+    def test_journal(self):
+        self.db.servers.create(**server1)
+        self.db.servers.update_many([{'id': server1['id'], 'ip': '1.2.3.4'}])
+        self.db.servers.delete(id=server1['id'])
+        self.assertRaises(exception.Conflict, self.db.flavors.create,
+                          id=flavor1['id'])
+
+        resp = self.db.journal.list(resource='servers')
+        self.assertEqual([(r['resource_id'], r['operation']) for r in resp],
+                         [(server1['id'], 'create'), (server1['id'], 'update'),
+                          (server1['id'], 'delete')])
+        self.assertEqual(resp[0]['changes']['name'], server1['name'])
+        self.assertFalse('created_at' in resp[0]['changes'])
+        self.assertEqual(resp[1]['changes'], {'ip': '1.2.3.4'})
+        self.assertEqual(resp[2]['changes'], {})
+
+        # The default flavors come first, records are consumed incrementally
+        seq = [r['seq'] for r in self.db.journal.list()]
+        self.assertEqual(seq, range(1, 7))
+        resp = self.db.journal.list(since=4, limit=1)
+        self.assertEqual([r['seq'] for r in resp], [5])
+        resp = self.db.journal.list(resource_id=flavor1['id'])
+        self.assertEqual([r['operation'] for r in resp], ['create'])
+
+        out = StringIO.StringIO()
+        self.db.dump(table='journal', fmt='csv', out=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 7)
+
+    @sqlite_only
+    def test_journal_transaction(self):
+        stats = db.stats()
+        self.db.servers.create(**server1)
+        self.assertEqual(db.stats()['transactions'],
+                         stats['transactions'] + 1)
+        with self.assertIndexed():
+            self.db.journal.list(resource='servers')
+
+    # -------------------------------------------------------------------------
+    # Usage counters and quotas
+
+    def test_usage(self):
+        self.db.servers.create(**server1)
+        self.db.images.create(**image1)
+        self.assertEqual(self.db.usage.get(),
+                         {'servers': 1, 'vcpus': 1, 'ram': 512, 'disk': 10,
+                          'images': 1, 'image_bytes': 17})
+
+        self.db.servers.update(id=server1['id'], ram=1024, status='active')
+        self.db.images.update_many([{'id': image1['id'], 'size': 20},
+                                    {'id': image1['id'], 'size': 30}])
+        resp = self.db.usage.limits()
+        self.assertEqual(resp['ram'], {'used': 1024, 'limit': -1})
+        self.assertEqual(resp['image_bytes'], {'used': 30, 'limit': -1})
+
+        self.db.servers.delete(id=server1['id'])
+        self.db.images.delete(id=image1['id'])
+        self.assertEqual(self.db.usage.get(),
+                         dict((name, 0) for name in db.USAGE_COUNTERS))
+
+    def test_usage_delete_by_name(self):
+        image2 = dict(image1, id='22222222-3333-4444-5555-666666666666')
+        self.db.images.create_many([image1, image2])
+        self.db.images.delete(name=image1['name'])
+
+        # Only the oldest of the images with the same name is deleted
+        self.assertEqual([i['id'] for i in self.db.images.list()],
+                         [image2['id']])
+        self.assertEqual((self.db.usage.get()['images'],
+                          self.db.usage.get()['image_bytes']), (1, 17))
+
+    def test_usage_recount(self):
+        self.db.servers.create(**server1)
+        self.db.images.create(**image1)
+        usage = self.db.usage.get()
+
+        self.db.usage.recount([])
+        self.assertEqual(self.db.usage.get(),
+                         dict((name, 0) for name in db.USAGE_COUNTERS))
+        self.db.usage.recount(self.db.tables())
+        self.assertEqual(self.db.usage.get(), usage)
+
+    def test_quota_exceeded(self):
+        quotas = (CONF.quota_instances, CONF.quota_ram)
+        CONF.set_option('quota_instances', 1)
+        CONF.set_option('quota_ram', 1000)
+        try:
+            self.db.servers.create(**server1)
+            server2 = dict(server1, id='22222222-3333-4444-5555-666666666666',
+                           name='server2')
+            self.assertRaises(exception.Forbidden, self.db.servers.create,
+                              **server2)
+            self.assertRaises(exception.Forbidden, self.db.servers.update,
+                              id=server1['id'], ram=2048)
+            self.assertEqual(self.db.usage.limits()['servers'],
+                             {'used': 1, 'limit': 1})
+
+            # Nothing was written
+            self.assertEqual(self.db.servers.list(),
+                             [show_server_resp(server1)])
+            self.assertEqual(self.db.usage.get()['ram'], 512)
+
+            # Freed resources can be reused
+            self.db.servers.delete(id=server1['id'])
+            self.db.servers.create(**server2)
+        finally:
+            CONF.set_option('quota_instances', quotas[0])
+            CONF.set_option('quota_ram', quotas[1])
+
+    # -------------------------------------------------------------------------
+    # Request statistics
+
+    def test_request_stats(self):
+        route = 'GET /%s' % self.db_engine
+        requests = db.route_stats().get(route, {}).get('requests', 0)
+
+        db.begin_request()
+        self.db.servers.create(**server1)
+        self.db.servers.update(id=server1['id'], status='active')
+        self.db.flavors.list()
+        stats = db.end_request(route)
+
+        # The read-backs of the written rows are nested calls
+        self.assertEqual(stats['calls'], {'servers.create': 1,
+                                          'servers.update': 1,
+                                          'servers.show': 2,
+                                          'flavors.list': 1})
+        self.assertEqual(stats['rows'], 5)
+        self.assertEqual(stats['statements'] > 0, self.db_engine == 'sqlite')
+        self.assertEqual(db.route_stats()[route]['requests'], requests + 1)
+
+        # Nothing is collected outside of requests
+        self.db.flavors.list()
+        self.assertEqual(db.end_request(route), None)
+
+    @sqlite_only
+    def test_request_stats_batch(self):
+        # pylint: disable=W0212
+        executed = []
+        execute = db._Cursor.execute
+
+        def _execute(cur, *args):
+            executed.append(args[0])
+            return execute(cur, *args)
+
+        server2 = dict(server1, id='22222222-3333-4444-5555-666666666666',
+                       name='server2')
+        db._Cursor.execute = _execute
+        try:
+            total = db.stats()['statements']
+            db.begin_request()
+            self.db.servers.create_many([server1, server2])
+            stats = db.end_request('POST /batch')
+        finally:
+            db._Cursor.execute = execute
+
+        # The batch inserts and the journal records are counted, too
+        self.assertTrue(stats['statements'] > len(executed))
+        self.assertEqual(db.stats()['statements'] - total,
+                         stats['statements'])
+
+    def test_request_stats_debug(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logging.getLogger('dwarf.db').addHandler(handler)
+        CONF.set_option('db_debug_queries', True)
+        try:
+            db.begin_request()
+            for flavor in (flavor1, flavor2):
+                self.db.flavors.show(id=flavor['id'])
+            db.end_request('GET /flavors')
+        finally:
+            CONF.set_option('db_debug_queries', False)
+            logging.getLogger('dwarf.db').removeHandler(handler)
+
+        self.assertEqual([r.getMessage() for r in records
+                          if r.levelno == logging.WARN],
+                         ['GET /flavors : flavors.show() called 2 times, '
+                          'possible N+1 query pattern'])
+
+    # -------------------------------------------------------------------------
+    # Row cache
+
+    @sqlite_only
+    def test_cache_hit(self):
+        self.db.flavors.show(id=flavor1['id'])
+        self.db.flavors.list()
+
+        # Served from the cache without touching the database
+        stats = db.stats()
+        resp = self.db.flavors.show(id=flavor1['id'])
+        self.assertEqual(resp, show_flavor_resp(flavor1))
+        resp = self.db.flavors.list()
+        self.assertEqual(resp, list_flavors_resp([flavor1, flavor2, flavor3]))
+        self.assertEqual(db.stats()['statements'], stats['statements'])
+        self.assertEqual(db.stats()['cache_hits'], stats['cache_hits'] + 2)
+        self.assertEqual(db.stats()['cache_misses'], stats['cache_misses'])
+
+        # Callers can't modify the cached rows
+        resp[0]['name'] = 'new name'
+        self.assertEqual(self.db.flavors.show(id=flavor1['id']),
+                         show_flavor_resp(flavor1))
+
+    @sqlite_only
+    def test_cache_invalidation(self):
+        self.db.flavors.show(id=flavor1['id'])
+        self.db.flavors.list()
+
+        self.db.flavors.update(id=flavor1['id'], name='new name')
+        self.assertEqual(self.db.flavors.show(id=flavor1['id']),
+                         show_flavor_resp(flavor1, name='new name',
+                                          version=2))
+
+        self.db.flavors.delete(id=flavor1['id'])
+        self.assertRaises(exception.NotFound, self.db.flavors.show,
+                          id=flavor1['id'])
+        self.assertEqual(self.db.flavors.list(),
+                         list_flavors_resp([flavor2, flavor3]))
+
+        # A failed transaction invalidates the cache, too
+        self.db.flavors.show(id=flavor2['id'])
+        stats = db.stats()
+        self.assertRaises(exception.Conflict, self.db.flavors.create,
+                          id=flavor2['id'])
+        self.assertEqual(db.stats()['cache_entries'], 0)
+        self.assertEqual(db.stats()['cache_invalidations'],
+                         stats['cache_invalidations'] + 1)
+
+    @sqlite_only
+    def test_cache_transaction(self):
+        self.db.flavors.show(id=flavor1['id'])
+        self.db.flavors.list()
+
+        result = {}
+
+        def show():
+            result['flavor'] = self.db.flavors.show(id=flavor1['id'])
+
+        # pylint: disable=W0212
+        try:
+            with db._POOL.transaction(self.db.flavors.db):
+                # The read-back isn't served from or stored in the cache
+                resp = self.db.flavors.update(id=flavor1['id'],
+                                              name='new name')
+                self.assertEqual(resp, show_flavor_resp(flavor1,
+                                                        name='new name',
+                                                        version=2))
+                self.assertEqual(db.stats()['cache_entries'], 2)
+
+                # Other threads don't see the uncommitted row
+                thread = threading.Thread(target=show)
+                thread.start()
+                thread.join()
+                self.assertEqual(result['flavor'], show_flavor_resp(flavor1))
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertEqual(db.stats()['cache_entries'], 0)
+        self.assertEqual(self.db.flavors.show(id=flavor1['id']),
+                         show_flavor_resp(flavor1))
+
+    @sqlite_only
+    def test_cache_size(self):
+        size = CONF.db_row_cache_size
+        CONF.set_option('db_row_cache_size', 2)
+        try:
+            for flavor in (flavor1, flavor2, flavor3):
+                self.db.flavors.show(id=flavor['id'])
+            self.assertEqual(db.stats()['cache_entries'], 2)
+
+            # The least recently used entry was evicted
+            stats = db.stats()
+            self.db.flavors.show(id=flavor1['id'])
+            self.assertEqual(db.stats()['cache_misses'],
+                             stats['cache_misses'] + 1)
+        finally:
+            CONF.set_option('db_row_cache_size', size)
+
+    @sqlite_only
+    def test_cache_servers(self):
+        self.db.servers.create(**server1)
+        self.db.servers.show(id=server1['id'])
+        stats = db.stats()
+        self.db.servers.show(id=server1['id'])
+        self.assertEqual(db.stats()['cache_hits'], stats['cache_hits'])
+
+    # -------------------------------------------------------------------------
+    # Indexes
+
+    @contextmanager
+    def assertIndexed(self):   # pylint: disable=C0103
+        """
+        Check that the statements run by the enclosed block don't scan a
+        whole table, using their actual query plans
+        """
+        if self.db_engine != 'sqlite':
+            yield
+            return
+
+        # pylint: disable=W0212
+        statements = []
+        execute = db._Cursor.execute
+
+        def _execute(cur, sql, args=()):
+            statements.append((sql, args))
+            return execute(cur, sql, args)
+
+        # Cached results don't run any statements
+        db._CACHE.clear()
+        db._Cursor.execute = _execute
+        try:
+            yield
+        finally:
+            db._Cursor.execute = execute
+
+        self.assertTrue(statements)
+        cur = db._POOL.cursor(self.db.servers.db)
+        for (sql, args) in statements:
+            if sql.split()[0] not in ('SELECT', 'UPDATE', 'DELETE'):
+                continue
+            cur.execute('EXPLAIN QUERY PLAN ' + sql, args)
+            for row in cur.fetchall():
+                detail = row[-1]
+                if detail.startswith('SCAN') and 'INDEX' not in detail:
+                    self.fail('Full table scan: %s (%s)' % (sql, detail))
+
+    @sqlite_only
+    def test_query_plan(self):
+        self.db.servers.create(**server1)
+        self.db.keypairs.create(**keypair1)
+        self.db.images.create(**image1)
+        self.db.server_tags.set(server1['id'], {'a': '', 'b': ''})
+
+        for (table, keys) in ((self.db.servers, ('id', 'name', 'ip')),
+                              (self.db.keypairs, ('id', 'name')),
+                              (self.db.images, ('id', 'name')),
+                              (self.db.flavors, ('id', 'name'))):
+            row = table.list()[0]
+            with self.assertIndexed():
+                for key in keys:
+                    table.show(**{key: row[key]})
+                table.list(marker=row['id'])
+                table.list(sort_key='name', sort_dir='desc',
+                           marker=row['id'], limit=10)
+                table.list(filters=[('name', db.FILTER_PREFIX,
+                                     row['name'][:3])])
+                table.list(changes_since=row['updated_at'],
+                           marker=row['id'])
+                table.update(id=row['id'], name=row['name'])
+
+        with self.assertIndexed():
+            self.db.servers.list(filters=[('tags', db.FILTER_ALL, 'a,b')])
+            self.db.servers.list(filters=[('tags', db.FILTER_ANY, 'a,b')])
+            self.db.servers.list(joins=[(self.db.flavors, 'flavor_id',
+                                         ['name'])])
+            self.db.servers.delete(name=server1['name'])
+            self.db.journal.list(resource='servers')
+
+    @sqlite_only
+    def test_index_db(self):
+        cur = db._POOL.cursor(self.db.servers.db)   # pylint: disable=W0212
+        cur.execute('DROP INDEX servers_deleted_ip_idx')
+        self.db.index()
+        with self.assertIndexed():
+            self.assertRaises(exception.NotFound, self.db.servers.show,
+                              ip='foo')
+
+    # -------------------------------------------------------------------------
+    # Schema migration
+
+    @sqlite_only
+    def test_migrate_db(self):
+        # Create a schema version 0 database with untyped columns, string
+        # booleans and no integer ID sequences
+        self.db.delete()
+        cur = db._POOL.cursor(self.db.flavors.db)   # pylint: disable=W0212
+        cur.execute('PRAGMA auto_vacuum = none')
+        for table in self.db.tables():
+            cur.execute('CREATE TABLE %s (%s)' %
+                        (table.table,
+                         ','.join(['%s TEXT' % c for c in table.cols])))
+        for (table, obj) in ((self.db.flavors, flavor1),
+                             (self.db.images, image1),
+                             (self.db.servers,
+                              dict(server1, vcpus='', ram='', disk=''))):
+            cur.execute('INSERT INTO %s VALUES (%s)' %
+                        (table.table, ','.join(['?'] * len(table.cols))),
+                        [str(obj[c]) for c in table.cols])
+        self.assertRaises(exception.Failure, self.db.check)
+
+        self.db.migrate()
+        self.db.check()
+        self.assertEqual(self.db.flavors.list(), list_flavors_resp([flavor1]))
+        self.assertEqual(self.db.images.list(), [create_image_resp(image1)])
+
+        # The server resources are copied from the flavor and counted
+        self.assertEqual(self.db.servers.list(), [show_server_resp(server1)])
+        self.assertEqual(self.db.usage.get(),
+                         {'servers': 1, 'vcpus': 1, 'ram': 512, 'disk': 10,
+                          'images': 1, 'image_bytes': 17})
+
+        # The integer ID sequence continues after the existing rows
+        resp = self.db.flavors.create(id='103', name='new flavor')
+        self.assertEqual(resp['int_id'], 2)
+
+        # The database is switched to incremental vacuum
+        cur.execute('PRAGMA auto_vacuum')
+        self.assertEqual(cur.fetchone()[0], 2)
+        self.assertEqual(self.db.flavors.purge('9999'), 0)
+
+        # Nothing left to do
+        self.db.migrate()
+
+    # -------------------------------------------------------------------------
+    # Purge
+
+    def get_shadow(self, table):
+        """
+        Return the IDs and deleted flags of the archived rows
+        """
+        cur = db._POOL.cursor(table.db)   # pylint: disable=W0212
+        cur.execute('SELECT id, deleted FROM %s' % table.shadow)
+        return [tuple(r) for r in cur.fetchall()]
+
+    def test_purge_db(self):
+        self.db.servers.create(**server1)
+        self.db.servers.delete(id=server1['id'])
+        self.db.flavors.delete(id=flavor1['id'])
+
+        seqs = [r['seq'] for r in self.db.journal.list()]
+
+        # Not old enough
+        resp = self.db.purge(10000)
+        self.assertEqual(resp['rows'], {'servers': 0, 'keypairs': 0,
+                                        'images': 0, 'flavors': 0,
+                                        'journal': 0})
+
+        # Bounded number of rows
+        resp = self.db.purge(30, limit=1)
+        self.assertEqual(resp['rows'], {'servers': 1})
+        self.assertTrue(resp['size_after'] <= resp['size_before'])
+        resp = self.db.purge(30, limit=2)
+        self.assertEqual(resp['rows'], {'servers': 0, 'keypairs': 0,
+                                        'images': 0, 'flavors': 1,
+                                        'journal': 1})
+        resp = self.db.purge(30)
+        self.assertEqual(resp['rows'], {'servers': 0, 'keypairs': 0,
+                                        'images': 0, 'flavors': 0,
+                                        'journal': len(seqs) - 2})
+
+        # The purged rows are archived
+        for (table, obj) in ((self.db.servers, server1),
+                             (self.db.flavors, flavor1)):
+            ids = [r[table.cols.index('id')] for r in table.dump()]
+            self.assertNotIn(obj['id'], ids)
+            self.assertEqual(self.get_shadow(table), [(obj['id'], db.TRUE)])
+
+        self.assertEqual(self.db.flavors.list(), list_flavors_resp([flavor2,
+                                                                    flavor3]))
+
+        # The latest journal record is kept and the sequence continues
+        self.assertEqual([r['seq'] for r in self.db.journal.list()],
+                         [seqs[-1]])
+        self.db.flavors.create(**flavor1)
+        self.assertEqual([r['seq'] for r in self.db.journal.list()],
+                         [seqs[-1], seqs[-1] + 1])
+
+    # -------------------------------------------------------------------------
+    # Backup
+
+    @sqlite_only
+    def test_backup_db(self):
+        self.db.servers.create(**server1)
+        path = self.db.backup()
+        self.assertTrue(path.startswith(CONF.backups_dir))
+        self.assertTrue(self.db.verify(path))
+
+        # Restore the deleted server
+        self.db.servers.delete(id=server1['id'])
+        self.db.restore(path)
+        self.assertTrue(self.db.verify())
+        self.assertEqual(self.db.servers.show(id=server1['id']),
+                         show_server_resp(server1))
+
+    @sqlite_only
+    def test_backup_db_rotate(self):
+        keep = CONF.db_backup_keep
+        CONF.set_option('db_backup_keep', 2)
+        try:
+            os.makedirs(CONF.backups_dir)
+            for name in ('dwarf-20010203040506.db', 'dwarf-20010203040507.db'):
+                self.db.backup(os.path.join(CONF.backups_dir, name))
+            path = self.db.backup()
+            self.assertEqual(sorted(os.listdir(CONF.backups_dir)),
+                             ['dwarf-20010203040507.db',
+                              os.path.basename(path)])
+        finally:
+            CONF.set_option('db_backup_keep', keep)
+
+    @sqlite_only
+    def test_backup_db_corrupt(self):
+        path = os.path.join('/tmp/dwarf', 'corrupt.db')
+        with open(path, 'w') as fh:
+            fh.write('not a database' * 1000)
+        self.assertFalse(self.db.verify(path))
+
+        # The database is left alone
+        self.db.restore(path)
+        self.assertTrue(self.db.verify())
+
     # -------------------------------------------------------------------------
     # Code coverage
 
@@ -222,10 +1093,79 @@ class DbTestCase(utils.TestCase):
 
     def test_delete_cc(self):
         self.db.delete()
+        self.db.delete()
+
+    @sqlite_only
+    def test_migrate_cc(self):
+        self.db.delete()
+        self.db.migrate()
+        self.db.check()
+
+    @sqlite_only
+    def test_backup_cc(self):
+        path = self.db.backup('/tmp/dwarf/backup.db')
+        self.assertEqual(self.db.backup(path), None)
+        self.db.restore('/tmp/dwarf/no_such_backup.db')
+        self.db.delete()
+        self.assertEqual(self.db.backup(), None)
+        self.assertFalse(self.db.verify())
+
+    def test_purge_cc(self):
+        self.db.delete()
+        self.assertEqual(self.db.purge(30), None)
+
+    @sqlite_only
+    def test_index_cc(self):
+        self.db.delete()
+        self.db.index()
 
     def test_dump_cc(self):
         self.db.dump(table='no_such_table')
+        self.db.dump(fmt='no_such_format')
 
     def test_show_cc(self):
         self.assertRaises(exception.NotFound, self.db.images.show,
                           id='no_such_id')
+
+
+class MemoryDbTestCase(DbTestCase):
+    """
+    Run the database tests against the memory engine
+    """
+
+    db_engine = 'memory'
+
+    def get_shadow(self, table):
+        store = db._MEMORY[table.db][table.table]   # pylint: disable=W0212
+        return [(r['id'], r['deleted']) for r in store.shadow]
+
+    def test_memory_no_file(self):
+        self.db.servers.create(**server1)
+        self.assertFalse(os.path.exists(CONF.dwarf_db))
+
+    def test_memory_not_initialized(self):
+        self.db.delete()
+        self.assertRaises(exception.Failure, self.db.flavors.list)
+
+        # Created on startup
+        self.db.check()
+        self.assertEqual(self.db.flavors.list(),
+                         list_flavors_resp([flavor1, flavor2, flavor3]))
+
+    def test_memory_interface(self):
+        # The memory tables don't inherit the sqlite schema operations
+        for table in self.db.tables() + self.db.extra_tables():
+            for method in ('init_sequence', 'init_shadow', 'init_indexes',
+                           'rebuild', 'select_sql'):
+                self.assertFalse(hasattr(table, method))
+
+    def test_memory_unsupported(self):
+        self.assertEqual(self.db.backup(), None)
+        self.assertFalse(self.db.verify())
+
+    def test_bad_engine(self):
+        CONF.set_option('db_engine', 'foo')
+        try:
+            self.assertRaises(exception.Failure, db.Controller)
+        finally:
+            CONF.set_option('db_engine', self.db_engine)
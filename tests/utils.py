@@ -32,6 +32,7 @@ from copy import deepcopy
 from tests import data
 
 from dwarf import api_server
+from dwarf import config
 from dwarf import db
 from dwarf import task
 from dwarf import utils
@@ -40,6 +41,7 @@ from dwarf.compute import keypairs
 from dwarf.compute import servers
 from dwarf.image import images
 
+CONF = config.Config()
 LOG = logging.getLogger(__name__)
 
 json_render = utils.json_render
@@ -47,6 +49,9 @@ json_render = utils.json_render
 
 class TestCase(unittest.TestCase):
 
+    # Database storage engine
+    db_engine = CONF.db_engine
+
     def __init__(self, *args, **kwargs):
         super(TestCase, self).__init__(*args, **kwargs)
         self.maxDiff = None
@@ -83,6 +88,7 @@ class TestCase(unittest.TestCase):
         os.makedirs('/tmp/dwarf/instances/_base')
 
         # Initialize the database
+        CONF.set_option('db_engine', self.db_engine)
         self.db = db.Controller()
         self.db.init()
 
@@ -92,9 +98,16 @@ class TestCase(unittest.TestCase):
         """
         super(TestCase, self).tearDown()
 
+        # Finish the queued server operations
+        servers.Controller().wait()
+
         # Kill all running tasks (just in case)
         task.stop_all(wait=True)
 
+        # Drop the memory database
+        if self.db_engine == 'memory':
+            self.db.delete()
+
         # Purge the temp directory tree
         if os.path.exists('/tmp/dwarf'):
             shutil.rmtree('/tmp/dwarf')